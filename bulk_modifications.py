@@ -0,0 +1,278 @@
+#=====================================================================
+# bulk payload modifications
+#
+# runs a payload_modifications list (see modifications.py) over many assets without
+# loading them: every supported operation becomes one jsonb UPDATE per chunk of asset pks,
+# operations without an SQL form (text append, increase/decrease, nested move/copy,
+# deletion of file fields, '+' items that also move/copy) load the chunk and run in Python.
+# A plain copy shares the list with its source for the rest of a routing run, so when '+' or '~>'
+# items follow it, everything from the copy on runs in Python (jsonb copies are independent).
+# Operations keep their order; a chunk is one transaction, an error rolls back the whole chunk,
+# files of deleted variables are removed after the chunk commits.
+# Like queryset.update, post_save isn't sent: permission caches of changed assets are
+# invalidated here and the search index is updated unless reindex is off.
+#=====================================================================
+
+import json
+import time
+import datetime
+from psycopg2.extras import Json
+from django.db import connection, transaction
+from nexus.modifications import (get_compiled_modifications, ModificationContext, AddValueOperation, DeleteOperation,
+    MoveOperation, CopyOperation, CreateOperation, MetaSingulariseOperation, MetaPluraliseOperation, AppendTextOperation,
+    delete_file_paths)
+from nexus.parallel import run_chunks, iterate_chunks
+
+BULK_CHUNK_SIZE = 1000 #assets per chunk and transaction
+
+
+def get_operation_sql(operation, file_keys):
+    """
+        (assignments, assignment params, condition, condition params) of an UPDATE doing what
+        operation.apply does, None if the operation has to run in Python;
+        conditions select rows apply wouldn't skip, so updated rows are the changed ones
+    """
+    if isinstance(operation, DeleteOperation):
+        if operation.key in file_keys:
+            #files are removed from storage by Python
+            return None
+        return ("payload = payload - %s::text", [operation.key], "payload ? %s::text", [operation.key])
+
+    if isinstance(operation, MoveOperation):
+        if operation.new_subkey is not None:
+            return None
+        source = 'meta' if operation.from_meta else 'payload'
+        target = 'meta' if operation.to_meta else 'payload'
+        if source == target:
+            assignments = "%s = (%s - %%s::text) || jsonb_build_object(%%s::text, %s->%%s::text)" % (source, source, source)
+            params = [operation.old_key, operation.new_key, operation.old_key]
+        else:
+            assignments = "%s = %s || jsonb_build_object(%%s::text, %s->%%s::text), %s = %s - %%s::text" % (target, target, source, source, source)
+            params = [operation.new_key, operation.old_key, operation.old_key]
+        return (assignments, params, "%s ? %%s::text AND %s IS NOT NULL" % (source, target), [operation.old_key])
+
+    if isinstance(operation, CopyOperation):
+        if operation.old_subkey:
+            return None
+        return ("payload = payload || jsonb_build_object(%s::text, payload->%s::text)", [operation.new_key, operation.old_key],
+            "payload ? %s::text", [operation.old_key])
+
+    if isinstance(operation, CreateOperation):
+        return ("payload = payload || jsonb_build_object(%s::text, %s::jsonb)", [operation.key, Json([operation.value])],
+            "payload IS NOT NULL AND NOT payload ? %s::text", [operation.key])
+
+    if isinstance(operation, AddValueOperation):
+        if operation.kind is None or operation.then is not None:
+            return None
+        condition = "payload IS NOT NULL AND (NOT payload ? %s::text OR jsonb_typeof(payload->%s::text) = 'array')"
+        condition_params = [operation.key, operation.key]
+        if operation.kind == 'meta':
+            value, value_params = "jsonb_build_array(meta->%s::text)", [operation.value]
+            condition += " AND meta ? %s::text"
+            condition_params.append(operation.value)
+        elif operation.kind == 'ASSET_ID':
+            value, value_params = "jsonb_build_array(%s)" % connection.ops.quote_name(get_pk_column()), []
+        elif operation.kind == 'DATETIME_NOW':
+            value, value_params = "%s::jsonb", [Json([str(datetime.datetime.now())])]
+        elif operation.kind == 'DATETIME_NOW_FORMATTED':
+            value, value_params = "%s::jsonb", [Json([datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')])]
+        else:
+            value, value_params = "%s::jsonb", [Json([operation.value])]
+        return ("payload = payload || jsonb_build_object(%%s::text, COALESCE(payload->%%s::text, '[]'::jsonb) || %s)" % value,
+            [operation.key, operation.key]+value_params, condition, condition_params)
+
+    if isinstance(operation, MetaSingulariseOperation):
+        return ("meta = meta || jsonb_build_object(%s::text, meta->%s::text->0)", [operation.key, operation.key],
+            "jsonb_typeof(meta->%s::text) = 'array' AND jsonb_array_length(meta->%s::text) > 0", [operation.key, operation.key])
+
+    if isinstance(operation, MetaPluraliseOperation):
+        return ("meta = meta || jsonb_build_object(%s::text, jsonb_build_array(meta->%s::text))", [operation.key, operation.key],
+            "meta ? %s::text AND jsonb_typeof(meta->%s::text) <> 'array'", [operation.key, operation.key])
+
+    return None
+
+
+def get_list_sharing_start(operations):
+    #index of the first plain copy followed by an in-place change of a list ('+', '~>'), None if there's none
+    for index, operation in enumerate(operations):
+        copy_operation = operation.then if isinstance(operation, AddValueOperation) else operation
+        if not isinstance(copy_operation, CopyOperation) or copy_operation.old_subkey:
+            continue
+        for later in operations[index+1:]:
+            if isinstance(later, (AddValueOperation, AppendTextOperation)):
+                return index
+    return None
+
+
+def get_pk_column():
+    from nexus.models import Asset
+    return Asset._meta.pk.column
+
+
+class BulkModificationPlan:
+    """
+        compiled modifications split into steps: ('sql', [operation]) or ('python', [operations]),
+        consecutive Python operations share one load of the chunk
+    """
+    def __init__(self, modifications):
+        from nexus.models import MasterField
+        self.compiled = get_compiled_modifications(modifications)
+        self.operations = self.compiled.operations
+        #deletions of file and compound fields remove files, they stay in Python
+        self.file_keys = set()
+        for sysname, properties in MasterField.objects.filter(sysname__in=self.compiled.delete_keys).values_list('sysname','properties'):
+            properties = properties or dict()
+            if properties.get('is_filefield',False) or properties.get('field_compound',False):
+                self.file_keys.add(sysname)
+        #from here on the lists shared by a copy have to stay in memory, see get_list_sharing_start
+        self.python_from = get_list_sharing_start(self.operations)
+        self.steps = list()
+        for index, operation in enumerate(self.operations):
+            in_python = self.python_from is not None and index >= self.python_from
+            if not in_python and get_operation_sql(operation, self.file_keys) is not None:
+                self.steps.append(('sql', [index]))
+            elif len(self.steps) > 0 and self.steps[-1][0] == 'python':
+                self.steps[-1][1].append(index)
+            else:
+                self.steps.append(('python', [index]))
+
+    def is_sql(self, index):
+        return any(mode == 'sql' and index in indexes for mode, indexes in self.steps)
+
+
+def run_sql_operation(operation, file_keys, pks):
+    #pks of updated rows
+    from nexus.models import Asset
+    assignments, assignment_params, condition, condition_params = get_operation_sql(operation, file_keys)
+    pk_column = connection.ops.quote_name(get_pk_column())
+    sql = "UPDATE %s SET %s WHERE %s = ANY(%%s) AND %s RETURNING %s" % (
+        connection.ops.quote_name(Asset._meta.db_table), assignments, pk_column, condition, pk_column)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, assignment_params+[list(pks)]+condition_params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_state(asset):
+    return json.dumps([asset.payload, asset.meta], sort_keys=True, default=str)
+
+
+def run_python_operations(operations, pks, dry_run, master_fields, storage_paths, deferred_files):
+    """
+        loads the chunk under row locks and applies operations to every asset, paths of files
+        to delete are added to deferred_files; returns (rows applied per operation, pks of changed assets)
+    """
+    from nexus.models import Asset
+    assets = list(Asset.objects.filter(pk__in=pks).defer(None).select_related('operator').select_for_update(of=('self',)).order_by('pk'))
+    applied = [0]*len(operations)
+    changed = list()
+    for asset in assets:
+        state = get_state(asset)
+        context = ModificationContext(asset, dry_run)
+        context.master_fields = master_fields
+        context.storage_paths = storage_paths
+        context.deferred_files = deferred_files
+        for position, operation in enumerate(operations):
+            try:
+                if operation.apply(asset, context):
+                    applied[position] += 1
+            except Exception as e:
+                raise Exception("asset #%s, %s: %s" % (asset.pk, operation.modification, e))
+        if get_state(asset) != state:
+            changed.append(asset)
+    if len(changed) > 0:
+        Asset.objects.bulk_update(changed, ['payload','meta'])
+    return applied, [asset.pk for asset in changed]
+
+
+def invalidate_changed_assets(pks, reindex=False):
+    #what post_save of Asset would do
+    from nexus.models import Asset, Nexus_permission_access
+    from nexus import permissions
+    if permissions.access_table_enabled():
+        Nexus_permission_access.objects.filter(asset_id__in=pks).delete()
+    for pk in pks:
+        permissions.invalidate_asset_decisions(Asset(pk=pk))
+    if reindex:
+        from common.elasticsearch import asset_to_es
+        for asset in Asset.objects.filter(pk__in=pks).defer(None).iterator():
+            try:
+                asset_to_es(asset)
+            except Exception as e:
+                print("bulk modifications: failed to index asset #%s: %s" % (asset.pk, e))
+
+
+# set in the parent before the pool is forked, read by modify_chunk in workers
+_plan = None
+
+
+def modify_chunk(chunk):
+    """
+        chunk is (asset pks, dry_run, reindex); returns rows applied per operation
+        and the number of changed assets
+    """
+    pks, dry_run, reindex = chunk
+    applied = [0]*len(_plan.operations)
+    changed = set()
+    master_fields = dict()
+    storage_paths = dict()
+    deferred_files = list()
+    with transaction.atomic():
+        for mode, indexes in _plan.steps:
+            if mode == 'sql':
+                updated = run_sql_operation(_plan.operations[indexes[0]], _plan.file_keys, pks)
+                applied[indexes[0]] += len(updated)
+                changed.update(updated)
+            else:
+                step_applied, step_changed = run_python_operations([_plan.operations[index] for index in indexes], pks, dry_run,
+                    master_fields, storage_paths, deferred_files)
+                for index, count in zip(indexes, step_applied):
+                    applied[index] += count
+                changed.update(step_changed)
+        if dry_run:
+            transaction.set_rollback(True)
+        elif len(deferred_files) > 0:
+            #a rolled back chunk keeps its files
+            transaction.on_commit(lambda: delete_file_paths(deferred_files))
+    if not dry_run and len(changed) > 0:
+        invalidate_changed_assets(changed, reindex)
+    return {'applied':applied, 'changed':len(changed)}
+
+
+def bulk_modify_payloads(queryset, modifications, processes=1, chunk_size=BULK_CHUNK_SIZE, dry_run=False, reindex=True, verbose=True):
+    """
+        applies payload_modifications to every asset of queryset, nothing is saved with dry_run;
+        returns totals {'assets','changed','failed','failed_chunks','operations','seconds'},
+        operations lists {'modification','operation','mode','rows'} in order
+    """
+    global _plan
+    _plan = BulkModificationPlan(modifications)
+    asset_pks = queryset.order_by('pk').values_list('pk',flat=True).iterator(chunk_size=chunk_size)
+    chunks = ((pks, dry_run, reindex) for pks in iterate_chunks(asset_pks, chunk_size))
+
+    totals = {'assets':0,'changed':0,'failed':0,'failed_chunks':0}
+    applied = [0]*len(_plan.operations)
+    start = time.time()
+    for chunk, result, seconds in run_chunks(modify_chunk, chunks, processes=processes):
+        pks = chunk[0]
+        totals['assets'] += len(pks)
+        if isinstance(result, Exception):
+            totals['failed_chunks'] += 1
+            totals['failed'] += len(pks)
+            print("bulk modifications: assets %s-%s failed: %s" % (pks[0], pks[-1], result))
+            continue
+        applied = [total+count for total, count in zip(applied, result['applied'])]
+        totals['changed'] += result['changed']
+        if verbose:
+            elapsed = time.time()-start
+            print("bulk modifications: %d assets, %.1f assets/s, chunk %s-%s: %d changed in %.2fs" % (
+                totals['assets'], totals['assets']/max(elapsed, 0.001), pks[0], pks[-1], result['changed'], seconds))
+    totals['operations'] = list()
+    for index, operation in enumerate(_plan.operations):
+        totals['operations'].append({
+            'modification':operation.modification,
+            'operation':operation.name,
+            'mode':'sql' if _plan.is_sql(index) else 'python',
+            'rows':applied[index],
+        })
+    totals['seconds'] = time.time()-start
+    return totals
@@ -128,6 +128,13 @@ class AssetFilterBackend(filters.BaseFilterBackend):
             else:
                 queryset=queryset.filter(stationinroute__station__id=int(station))
 
+        permitted_action = request.query_params.get('permitted_action', None)
+        if permitted_action:
+            #only assets current user has permission for, e.g. permitted_action=download
+            from nexus.models import get_client_ip
+            from nexus.permissions import filter_visible_assets
+            queryset = filter_visible_assets(queryset, request.user, permitted_action, ip_address=get_client_ip(request))
+
         if 'fulltext_query' in request.query_params:
             """
                 fulltext search utilizes elasticsearch, not queryset filtering, therefore it is processed separately, 
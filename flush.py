@@ -0,0 +1,96 @@
+#=====================================================================
+# flush engine for Route.flush and Station.flush
+#
+# asset pks are streamed from the database in chunks; every asset is loaded
+# with stationinroute/station/type and processed in its own short transaction
+# holding the lock of that asset only (select_for_update, an asset locked by
+# someone else or moved away is skipped and reported), so a failure or a slow
+# perform doesn't keep the rest of the chunk locked.
+# Chunks run inline or in a process pool (see parallel.py).
+#=====================================================================
+
+import time
+from django.db import transaction
+from nexus.parallel import run_chunks, iterate_chunks
+
+FLUSH_CHUNK_SIZE = 200 #assets per chunk and transaction
+FLUSH_MAX_LISTED_FAILURES = 20 #failures and skipped assets printed per chunk, the rest is only counted
+
+
+def flush_chunk(chunk):
+    """
+        chunk is (kind, owner pk, asset pks); kind 'route' calls Route.asset_action,
+        'station' calls Station.perform for every asset still in the route/station;
+        returns the number of processed assets, pks of skipped assets and failures of the chunk
+    """
+    from nexus.models import Asset, Route, Station
+    kind, owner_pk, asset_pks = chunk
+    result = {'processed':0,'skipped':list(),'failed':list()}
+
+    assets = Asset.objects.defer(None).select_related('stationinroute__station','type')
+    if kind == 'route':
+        owner = Route.objects.get(pk=owner_pk)
+        assets = assets.filter(stationinroute__route_id=owner_pk)
+    else:
+        owner = Station.objects.get(pk=owner_pk)
+        assets = assets.filter(stationinroute__station_id=owner_pk)
+    assets = assets.select_for_update(skip_locked=True, of=('self',))
+
+    for asset_pk in asset_pks:
+        try:
+            with transaction.atomic():
+                asset = assets.filter(pk=asset_pk).first()
+                if asset is None:
+                    #locked by someone else or moved away since the pks were read
+                    result['skipped'].append(asset_pk)
+                    continue
+                if kind == 'route':
+                    owner.asset_action(asset)
+                else:
+                    owner.perform(asset)
+            result['processed'] += 1
+        except Exception as e:
+            result['failed'].append((asset_pk, str(e)))
+    return result
+
+
+def flush_assets(kind, owner, processes=1, chunk_size=FLUSH_CHUNK_SIZE, verbose=True):
+    """
+        runs flush_chunk over every asset of a route (kind='route') or station (kind='station');
+        returns totals {'assets','processed','skipped','skipped_assets','failed','failed_chunks','seconds'},
+        skipped_assets are pks of assets that were locked or moved away, flush them again later
+    """
+    from nexus.models import Asset
+    assets = Asset.objects.all()
+    if kind == 'route':
+        assets = assets.filter(stationinroute__route_id=owner.pk)
+    else:
+        assets = assets.filter(stationinroute__station_id=owner.pk)
+    asset_pks = assets.order_by('pk').values_list('pk',flat=True).iterator(chunk_size=chunk_size)
+    chunks = ((kind, owner.pk, pks) for pks in iterate_chunks(asset_pks, chunk_size))
+
+    totals = {'assets':0,'processed':0,'skipped':0,'skipped_assets':list(),'failed':0,'failed_chunks':0}
+    start = time.time()
+    for chunk, result, seconds in run_chunks(flush_chunk, chunks, processes=processes):
+        asset_pks = chunk[2]
+        totals['assets'] += len(asset_pks)
+        if isinstance(result, Exception):
+            totals['failed_chunks'] += 1
+            totals['failed'] += len(asset_pks)
+            print("flush %s #%s: assets %s-%s failed: %s" % (kind, owner.pk, asset_pks[0], asset_pks[-1], result))
+            continue
+        totals['processed'] += result['processed']
+        totals['skipped'] += len(result['skipped'])
+        totals['skipped_assets'] += result['skipped']
+        totals['failed'] += len(result['failed'])
+        if verbose:
+            elapsed = time.time()-start
+            print("flush %s #%s: %d assets, %.1f assets/s, chunk %s-%s: %d processed, %d skipped, %d failed in %.2fs" % (
+                kind, owner.pk, totals['assets'], totals['assets']/max(elapsed, 0.001), asset_pks[0], asset_pks[-1],
+                result['processed'], len(result['skipped']), len(result['failed']), seconds))
+            if len(result['skipped']) > 0:
+                print("    skipped (locked or moved): %s" % ', '.join('#'+str(pk) for pk in result['skipped'][:FLUSH_MAX_LISTED_FAILURES]))
+            for asset_pk, error in result['failed'][:FLUSH_MAX_LISTED_FAILURES]:
+                print("    asset #%s: %s" % (asset_pk, error))
+    totals['seconds'] = time.time()-start
+    return totals
@@ -0,0 +1,256 @@
+import json
+import ipaddress
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.contrib.auth.models import Group
+from django.db.models import Count
+from nexus.models import Asset, Station
+from nexus import permissions
+
+
+TARGET_KINDS = permissions.PermissionRuleIndex.target_kinds
+FLAGS = ['is_creator','is_operator','is_supervisor','is_authenticated_user']
+
+
+def rule_signature(rule, with_ip_range=True):
+    #everything that decides whether and how a rule matches; logging and descriptions are left out
+    signature = [rule.action, rule.is_default, rule.is_prohibition, rule.user_id, rule.group_id]
+    signature += [getattr(rule, kind+'_id') for kind in TARGET_KINDS]
+    signature += [getattr(rule, flag) for flag in FLAGS]
+    signature.append(json.dumps(rule.payload_value or dict(), sort_keys=True))
+    signature += [rule.datetime_start, rule.datetime_end]
+    if with_ip_range:
+        signature.append(rule.ip_network if rule.ip_network is not None else rule.ip_range or None)
+    return tuple(signature)
+
+
+class Command(BaseCommand):
+    help = (
+        'Analyzes Nexus_permission rules: duplicates, rules shadowed by more general rules that always win, '
+        'rules that can never match, dormant and expired rules and ip_range rules that can be merged; estimates per-check candidate reduction'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', type=int, default=500, help='assets used to estimate candidate set sizes')
+        parser.add_argument('--verbose-list', action='store_true', help='list every rule found, not only counts and first items')
+
+    def list_items(self, items, limit=20):
+        if self.verbose_list:
+            return items
+        return items[:limit]
+
+    def sr_targets(self, index, rule):
+        #station and route implied by rule's stationinroute
+        if rule.stationinroute_id is not None and rule.stationinroute_id in index.stationinroutes:
+            return index.stationinroutes[rule.stationinroute_id]
+        return (rule.station_id, rule.route_id)
+
+    def covers(self, index, general, rule):
+        """
+            True if general matches every check rule matches: each condition of general is None/False
+            or implied by the corresponding condition of rule
+        """
+        sr_station_id, sr_route_id = self.sr_targets(index, rule)
+        for kind in TARGET_KINDS:
+            general_id = getattr(general, kind+'_id')
+            if general_id is None:
+                continue
+            rule_id = getattr(rule, kind+'_id')
+            if kind == 'station' and rule_id is None:
+                rule_id = sr_station_id
+            if kind == 'route' and rule_id is None:
+                rule_id = sr_route_id
+            if general_id != rule_id:
+                return False
+        if general.user_id is not None and general.user_id != rule.user_id:
+            return False
+        if general.group_id is not None and general.group_id != rule.group_id:
+            return False
+        for flag in FLAGS:
+            if getattr(general, flag) and not getattr(rule, flag):
+                return False
+        if general.payload_value and json.dumps(general.payload_value, sort_keys=True) != json.dumps(rule.payload_value or dict(), sort_keys=True):
+            return False
+        if general.ip_range:
+            if general.ip_network is None or rule.ip_network is None:
+                return False
+            if general.ip_network.version != rule.ip_network.version or not rule.ip_network.subnet_of(general.ip_network):
+                return False
+        return True
+
+    def find_never_matching(self, index):
+        """
+            (never, dormant, expired): pk -> reasons; never-matching rules are dead, dormant rules only can't
+            match with the current members and operators and wake up when somebody is added,
+            expired rules are past datetime_end or have an empty window, but checks don't look at the window,
+            so they still decide
+        """
+        never = dict()
+        dormant = dict()
+        expired = dict()
+        now = timezone.now()
+        group_sizes = dict(Group.objects.annotate(members=Count('user')).values_list('id','members'))
+        station_operators = dict(Station.objects.annotate(operators_count=Count('operators')).values_list('id','operators_count'))
+        route_stations = set(index.stationinroutes.values())
+
+        for rule in index.rules.values():
+            reasons = list()
+            if rule.ip_range and rule.ip_network is None:
+                reasons.append('ip_range %s is not a valid network' % rule.ip_range)
+            if any(isinstance(predicate, permissions.PayloadNeverMatches) for predicate in rule.payload_predicates):
+                reasons.append('payload_value %s is malformed' % json.dumps(rule.payload_value))
+            if rule.station_id is not None and rule.route_id is not None and (rule.station_id, rule.route_id) not in route_stations:
+                reasons.append('station #%s is not in route #%s' % (rule.station_id, rule.route_id))
+            if rule.stationinroute_id is not None and rule.stationinroute_id in index.stationinroutes:
+                sr_station_id, sr_route_id = index.stationinroutes[rule.stationinroute_id]
+                if rule.station_id is not None and rule.station_id != sr_station_id:
+                    reasons.append('stationinroute #%s is not at station #%s' % (rule.stationinroute_id, rule.station_id))
+                if rule.route_id is not None and rule.route_id != sr_route_id:
+                    reasons.append('stationinroute #%s is not in route #%s' % (rule.stationinroute_id, rule.route_id))
+            if len(reasons) > 0:
+                never[rule.pk] = reasons
+                continue
+
+            reasons = list()
+            if rule.group_id is not None and group_sizes.get(rule.group_id, 0) == 0:
+                reasons.append('group #%s currently has no members' % rule.group_id)
+            if rule.is_operator and rule.station_id is not None and station_operators.get(rule.station_id, 0) == 0:
+                reasons.append('is_operator rule for station #%s, which currently has no operators' % rule.station_id)
+            if len(reasons) > 0:
+                dormant[rule.pk] = reasons
+            reasons = list()
+            if rule.datetime_end and rule.datetime_end < now:
+                reasons.append('datetime_end %s has passed' % rule.datetime_end)
+            if rule.datetime_start and rule.datetime_end and rule.datetime_start > rule.datetime_end:
+                reasons.append('datetime_start is after datetime_end')
+            if len(reasons) > 0:
+                expired[rule.pk] = reasons
+        return never, dormant, expired
+
+    def find_duplicates(self, index, skip):
+        #pk of duplicate -> pk of the rule it duplicates (the lowest pk wins, so the rest never decide)
+        duplicates = dict()
+        first = dict()
+        for rule in sorted(index.rules.values(), key=lambda rule: rule.pk):
+            if rule.pk in skip:
+                continue
+            signature = rule_signature(rule)
+            if signature in first:
+                duplicates[rule.pk] = first[signature]
+            else:
+                first[signature] = rule.pk
+        return duplicates
+
+    def find_shadowed(self, index, skip):
+        #pk of shadowed rule -> pk of the rule that always wins over it
+        shadowed = dict()
+        by_action = dict()
+        for rule in index.rules.values():
+            if rule.pk not in skip:
+                by_action.setdefault(rule.action, list()).append(rule)
+        for action, rules in by_action.items():
+            rules.sort(key=permissions._precedence)
+            for i, rule in enumerate(rules):
+                #only rules earlier in precedence order can win over this one
+                for general in rules[:i]:
+                    if self.covers(index, general, rule):
+                        shadowed[rule.pk] = general.pk
+                        break
+        return shadowed
+
+    def find_ip_merges(self, index, skip):
+        #rules equal except for ip_range, whose networks collapse into fewer networks
+        groups = dict()
+        for rule in index.rules.values():
+            if rule.pk in skip or rule.ip_network is None:
+                continue
+            groups.setdefault(rule_signature(rule, with_ip_range=False), list()).append(rule)
+        merges = list()
+        for rules in groups.values():
+            if len(rules) < 2:
+                continue
+            for version in [4, 6]:
+                networks = [rule.ip_network for rule in rules if rule.ip_network.version == version]
+                if len(networks) < 2:
+                    continue
+                collapsed = list(ipaddress.collapse_addresses(networks))
+                if len(collapsed) < len(networks):
+                    merges.append({
+                        'rules':sorted(rule.pk for rule in rules if rule.ip_network.version == version),
+                        'ip_ranges':[str(network) for network in networks],
+                        'merged':[str(network) for network in collapsed],
+                    })
+        return merges
+
+    def estimate_candidates(self, index, removed, merge_savings, sample):
+        assets = list(Asset.objects.all().order_by('-pk')[:sample])
+        actions = sorted(index.actions.keys())
+        before = 0
+        after = 0
+        checks = 0
+        for asset in assets:
+            targets = index.resolve_targets(asset=asset)
+            for action in actions:
+                candidates = index.candidates(action, targets)
+                before += len(candidates)
+                remaining = [rule for rule in candidates if rule.pk not in removed]
+                after += len(remaining)
+                #every merge turns several candidates into fewer ones
+                for merge in merge_savings:
+                    merged_pks = set(merge['rules'])
+                    matched = len([rule for rule in remaining if rule.pk in merged_pks])
+                    if matched > 1:
+                        after -= matched - min(matched, len(merge['merged']))
+                checks += 1
+        return before, after, checks
+
+    def handle(self, *args, **options):
+        self.verbose_list = options['verbose_list']
+        #fresh copy of the rules; the shared index version is left alone, workers keep their indexes
+        index = permissions.PermissionRuleIndex.load()
+        self.stdout.write("%d rules, %d actions" % (len(index.rules), len(index.actions)))
+
+        never, dormant, expired = self.find_never_matching(index)
+        self.stdout.write("\nrules that can never match: %d" % len(never))
+        for pk in self.list_items(sorted(never)):
+            self.stdout.write("  #%d: %s" % (pk, '; '.join(never[pk])))
+
+        #not removable: adding a member or an operator makes them match again
+        self.stdout.write("\ndormant rules (can't match now, may match later): %d" % len(dormant))
+        for pk in self.list_items(sorted(dormant)):
+            self.stdout.write("  #%d: %s" % (pk, '; '.join(dormant[pk])))
+
+        #not removable either: removing them changes results of checks made today
+        self.stdout.write("\nexpired but still enforced rules (checks ignore the time window): %d" % len(expired))
+        for pk in self.list_items(sorted(expired)):
+            self.stdout.write("  #%d: %s" % (pk, '; '.join(expired[pk])))
+
+        duplicates = self.find_duplicates(index, set(never))
+        self.stdout.write("\nduplicate rules: %d" % len(duplicates))
+        for pk in self.list_items(sorted(duplicates)):
+            self.stdout.write("  #%d duplicates #%d" % (pk, duplicates[pk]))
+
+        shadowed = self.find_shadowed(index, set(never) | set(duplicates))
+        self.stdout.write("\nshadowed rules (a more general rule always wins over them): %d" % len(shadowed))
+        for pk in self.list_items(sorted(shadowed)):
+            winner = index.rules[shadowed[pk]]
+            effect = 'same result' if winner.is_prohibition == index.rules[pk].is_prohibition else 'opposite result, rule is dead'
+            self.stdout.write("  #%d is shadowed by #%d (%s)" % (pk, winner.pk, effect))
+
+        removed = set(never) | set(duplicates) | set(shadowed)
+        merges = self.find_ip_merges(index, removed)
+        merge_savings = sum(len(merge['rules'])-len(merge['merged']) for merge in merges)
+        self.stdout.write("\nip_range rules that can be merged: %d groups, %d rules less" % (len(merges), merge_savings))
+        for merge in self.list_items(merges):
+            self.stdout.write("  rules %s: %s -> %s" % (', '.join('#'+str(pk) for pk in merge['rules']), ', '.join(merge['ip_ranges']), ', '.join(merge['merged'])))
+
+        logged = [pk for pk in removed if index.rules[pk].logging]
+        if len(logged) > 0:
+            self.stdout.write(self.style.WARNING("\n%d of removable rules have logging set, check logging of the rules that replace them" % len(logged)))
+
+        self.stdout.write("\nremovable rules: %d of %d (%.1f%%), %d more after ip_range merges" % (len(removed), len(index.rules), 100.0*len(removed)/max(len(index.rules),1), merge_savings))
+
+        before, after, checks = self.estimate_candidates(index, removed, merges, options['sample'])
+        if checks > 0:
+            self.stdout.write("candidate rules per check over %d asset/action pairs: %.1f -> %.1f (%.1f%% less)" % (
+                checks, before/float(checks), after/float(checks), 100.0*(before-after)/max(before,1)))
@@ -0,0 +1,180 @@
+import sys
+import csv
+import gzip
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from nexus.models import Asset, Station
+from nexus import permissions
+from nexus.parallel import run_chunks, iterate_chunks
+
+
+# set in the parent before the pool is forked, read by audit_chunk in workers
+_snapshot = None
+
+
+def audit_chunk(chunk):
+    """
+        evaluates every user of the snapshot against a columnar chunk of assets
+        (ids, type ids, stationinroute ids, payloads, creator id sets);
+        returns rows (asset_id, user_id, action, result, permission_id)
+    """
+    index = _snapshot['index']
+    users = _snapshot['users']
+    all_results = _snapshot['all_results']
+    ip_rule_pks = index.ip_ranges.lookup(_snapshot['ip_address'])
+    rows = list()
+
+    for asset_id, type_id, sr_id, payload, creator_ids in zip(*chunk):
+        station_id, route_id = index.stationinroutes.get(sr_id, (None, None))
+        targets = (asset_id, sr_id, station_id, route_id, type_id)
+        payload = payload or dict()
+
+        for action in _snapshot['actions']:
+            #everything that doesn't depend on the user is evaluated once per asset
+            candidates = list()
+            for rule in index.candidates(action, targets):
+                if rule.ip_range and rule.pk not in ip_rule_pks:
+                    continue
+                if not rule.matches_payload(payload):
+                    continue
+                candidates.append(rule)
+            if len(candidates) == 0 and not all_results:
+                continue
+            rule_user_ids = set(rule.user_id for rule in candidates)
+            rule_group_ids = set(rule.group_id for rule in candidates)
+
+            #users that look the same to the candidates share the decision
+            decisions = dict()
+            for user_id, group_ids, operated_station_ids, supervised_station_ids, is_authenticated_user in users:
+                subject = {
+                    'user_id':user_id if user_id in rule_user_ids else None,
+                    'group_ids':group_ids & rule_group_ids,
+                    'is_creator':user_id is not None and user_id in creator_ids,
+                    'is_operator':station_id in operated_station_ids,
+                    'is_supervisor':station_id in supervised_station_ids,
+                    'is_authenticated_user':is_authenticated_user,
+                }
+                key = tuple(sorted(subject.items(), key=lambda item: item[0]))
+                if key not in decisions:
+                    decisions[key] = permissions._resolve_rules([rule for rule in candidates if rule.matches_subject(subject)])
+                result, result_permission = decisions[key]
+                if result or all_results:
+                    rows.append((asset_id, user_id, action, int(result), result_permission.pk if result_permission else None))
+    return rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes who can do what with every asset as CSV (asset, user, action, result, deciding permission), '
+        'evaluating columnar snapshots of rules, users and assets in a process pool'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--action', action='append', help='permission action, may be repeated (default: download)')
+        parser.add_argument('--user', action='append', help='username, may be repeated (default: all active users)')
+        parser.add_argument('--anonymous', action='store_true', help='include anonymous user (empty user_id)')
+        parser.add_argument('--ip', default=None, help='ip address the users are assumed to come from, ip_range rules never match without it')
+        parser.add_argument('--type', type=int, action='append', help='asset type pk, may be repeated')
+        parser.add_argument('--route', type=int, action='append', help='route pk, may be repeated')
+        parser.add_argument('--all-results', action='store_true', help='write denied pairs too, not only granted ones')
+        parser.add_argument('--output', default='-', help='csv file, compressed if it ends with .gz; - for stdout')
+        parser.add_argument('--processes', type=int, default=None, help='worker processes (default: cpu count), 1 runs inline')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='assets per chunk, lower it when auditing many users')
+
+    def load_users(self, options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(username__in=options['user'])
+        else:
+            users = users.filter(is_active=True)
+        users = dict(users.values_list('pk','username'))
+
+        group_ids = dict()
+        for user_id, group_id in User.groups.through.objects.filter(user_id__in=list(users.keys())).values_list('user_id','group_id').iterator():
+            group_ids.setdefault(user_id, set()).add(group_id)
+        operated = dict()
+        for station_id, user_id in Station.operators.through.objects.filter(user_id__in=list(users.keys())).values_list('station_id','user_id').iterator():
+            operated.setdefault(user_id, set()).add(station_id)
+        supervised = dict()
+        for station_id, user_id in Station.supervisors.through.objects.filter(user_id__in=list(users.keys())).values_list('station_id','user_id').iterator():
+            supervised.setdefault(user_id, set()).add(station_id)
+
+        snapshot = list()
+        for user_id in sorted(users.keys()):
+            snapshot.append((user_id, frozenset(group_ids.get(user_id, ())), frozenset(operated.get(user_id, ())), frozenset(supervised.get(user_id, ())), True))
+        if options['anonymous']:
+            snapshot.append((None, frozenset(), frozenset(), frozenset(), False))
+        return snapshot, users
+
+    def asset_chunks(self, options, index):
+        #columnar chunks; payload and meta are sent to workers only if some rule needs them
+        need_payload = any(len(rule.payload_predicates) > 0 for rule in index.rules.values())
+        need_creators = any(rule.is_creator for rule in index.rules.values())
+        assets = Asset.objects.all().order_by('pk')
+        if options['type']:
+            assets = assets.filter(type_id__in=options['type'])
+        if options['route']:
+            assets = assets.filter(route_id__in=options['route'])
+        fields = ['pk','type_id','stationinroute_id']
+        if need_payload:
+            fields.append('payload')
+        if need_creators:
+            fields.append('meta')
+        rows = assets.values_list(*fields)
+        for chunk in iterate_chunks(rows.iterator(chunk_size=options['chunk_size']), options['chunk_size']):
+            columns = list(zip(*chunk))
+            columns.append(columns.pop(3) if need_payload else (None,)*len(chunk))
+            columns.append(tuple(permissions.get_creator_ids(meta) for meta in columns.pop(3)) if need_creators else (frozenset(),)*len(chunk))
+            yield columns
+
+    def handle(self, *args, **options):
+        global _snapshot
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        #fresh copy of the rules; the shared index version is left alone, workers keep their indexes
+        index = permissions.PermissionRuleIndex.load()
+        users, usernames = self.load_users(options)
+        if len(users) == 0:
+            raise CommandError('no users to audit')
+        _snapshot = {
+            'index':index,
+            'users':users,
+            'actions':options['action'] or ['download'],
+            'ip_address':options['ip'],
+            'all_results':options['all_results'],
+        }
+
+        if options['output'] == '-':
+            output = sys.stdout
+        elif options['output'].endswith('.gz'):
+            output = gzip.open(options['output'], 'wt', newline='')
+        else:
+            output = open(options['output'], 'w', newline='')
+
+        writer = csv.writer(output)
+        writer.writerow(['asset_id','user_id','username','action','result','permission_id'])
+        start = time.time()
+        assets_count = 0
+        rows_count = 0
+        failed = 0
+        try:
+            for chunk, rows, seconds in run_chunks(audit_chunk, self.asset_chunks(options, index), processes=options['processes']):
+                chunk_size = len(chunk[0])
+                assets_count += chunk_size
+                if isinstance(rows, Exception):
+                    failed += 1
+                    self.stderr.write("assets %s-%s failed: %s" % (chunk[0][0], chunk[0][-1], rows))
+                    continue
+                for asset_id, user_id, action, result, permission_id in rows:
+                    writer.writerow([asset_id, user_id if user_id is not None else '', usernames.get(user_id, ''), action, result, permission_id if permission_id is not None else ''])
+                rows_count += len(rows)
+                elapsed = time.time()-start
+                self.stderr.write("%d assets, %d rows, %.0f assets/s, last chunk %.2fs" % (assets_count, rows_count, assets_count/max(elapsed, 0.001), seconds))
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        self.stderr.write("done: %d assets x %d users x %d actions in %.1fs, %d rows, %d failed chunks" % (
+            assets_count, len(users), len(_snapshot['actions']), time.time()-start, rows_count, failed))
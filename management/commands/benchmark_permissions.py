@@ -0,0 +1,286 @@
+import time
+import random
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.contrib.auth.models import User,Group,AnonymousUser
+from nexus.models import Asset, AssetType, Route, Station, StationInRoute, Nexus_permission
+from nexus import permissions
+
+
+ACTIONS = ['read','download','edit']
+
+
+class SyntheticPermissionData:
+    """
+        users, groups, a route with stations, assets and a mix of permissions of varying depth
+        (targets, groups, users, roles, payload_value, ip_range, defaults and prohibitions).
+        Everything is created with bulk_create, so no signals (elasticsearch etc.) are fired;
+        meant to be created inside a transaction that is rolled back
+    """
+    def __init__(self, users=50, groups=10, stations=10, assets=1000, rules=2000, seed=1):
+        self.counts = {'users':users,'groups':groups,'stations':stations,'assets':assets,'rules':rules}
+        self.random = random.Random(seed)
+        self.prefix = 'bench_'+uuid.uuid4().hex[:8]+'_'
+
+    def random_ip(self):
+        return '10.%d.%d.%d' % (self.random.randint(0,15), self.random.randint(0,255), self.random.randint(1,254))
+
+    def build(self):
+        rnd = self.random
+        Group.objects.bulk_create([Group(name=self.prefix+'group'+str(i)) for i in range(self.counts['groups'])])
+        self.groups = list(Group.objects.filter(name__startswith=self.prefix))
+        User.objects.bulk_create([User(username=self.prefix+'user'+str(i)) for i in range(self.counts['users'])])
+        self.users = list(User.objects.filter(username__startswith=self.prefix))
+        for user in self.users:
+            user.groups.set(rnd.sample(self.groups, rnd.randint(0, min(3, len(self.groups)))))
+
+        self.asset_type = AssetType.objects.create(type_name=self.prefix+'type', sysname=self.prefix+'type')
+        self.route = Route.objects.create(sysname=self.prefix+'route', route_name=self.prefix+'route')
+        Station.objects.bulk_create([Station(station_name=self.prefix+'station'+str(i)) for i in range(self.counts['stations'])])
+        self.stations = list(Station.objects.filter(station_name__startswith=self.prefix))
+        for station in self.stations:
+            station.operators.set(rnd.sample(self.users, min(2, len(self.users))))
+            station.supervisors.set(rnd.sample(self.users, min(1, len(self.users))))
+        StationInRoute.objects.bulk_create([StationInRoute(station=station, route=self.route) for station in self.stations])
+        self.stationinroutes = list(StationInRoute.objects.filter(route=self.route))
+
+        assets = list()
+        for i in range(self.counts['assets']):
+            sr = rnd.choice(self.stationinroutes)
+            payload = {
+                'license':[rnd.choice(['public','restricted','Public '])],
+                'year':[rnd.randint(1990, 2030)],
+                'title':['synthetic asset '+str(i)],
+                'access':[{'level':rnd.choice(['open','closed'])}],
+                'embargo_date':[str(rnd.randint(2015, 2030))+'-01-01'],
+            }
+            meta = {'creator':rnd.choice(self.users).pk}
+            assets.append(Asset(type=self.asset_type, route=self.route, stationinroute=sr, payload=payload, meta=meta))
+        Asset.objects.bulk_create(assets)
+        self.assets = list(Asset.objects.filter(type=self.asset_type).select_related('stationinroute'))
+
+        rules = list()
+        for i in range(self.counts['rules']):
+            rules.append(self.random_rule())
+        Nexus_permission.objects.bulk_create(rules)
+        #bulk_create doesn't send post_save; the rules are uncommitted, so only this process needs them
+        permissions.reload_rule_index()
+
+    def random_rule(self):
+        rnd = self.random
+        rule = Nexus_permission(permission_action_sysname=rnd.choice(ACTIONS))
+        rule.is_prohibition = rnd.random() < 0.2
+        rule.is_default = rnd.random() < 0.03
+
+        #target depth
+        depth = rnd.choice(['none','asset_type','route','station','stationinroute','asset','asset'])
+        if depth == 'asset_type':
+            rule.asset_type = self.asset_type
+        elif depth == 'route':
+            rule.route = self.route
+        elif depth == 'station':
+            rule.station = rnd.choice(self.stations)
+        elif depth == 'stationinroute':
+            rule.stationinroute = rnd.choice(self.stationinroutes)
+        elif depth == 'asset':
+            rule.asset = rnd.choice(self.assets)
+
+        #conditions
+        condition = rnd.random()
+        if condition < 0.15:
+            rule.group = rnd.choice(self.groups)
+        elif condition < 0.25:
+            rule.user = rnd.choice(self.users)
+        elif condition < 0.35:
+            rule.is_authenticated_user = True
+        elif condition < 0.4:
+            rule.is_creator = True
+        elif condition < 0.45:
+            rule.is_operator = True
+
+        if rnd.random() < 0.3:
+            rule.payload_value = rnd.choice([
+                {'license':{'cmp_op':'=','cmp_val':'public'}},
+                {'year':{'cmp_op':'>','cmp_val':rnd.randint(1990, 2030)}},
+                {'year':{'cmp_op':'<','cmp_val':rnd.randint(1990, 2030)}},
+                {'title':''},
+                {'access.level':{'cmp_op':'=','cmp_val':'open'}},
+                {'embargo_date':{'cmp_op':'<','cmp_val':'DATETIME_PLUSMONTHS_12','datetime_formats':['%Y-%m-%d']}},
+            ])
+        if rnd.random() < 0.1:
+            rule.ip_range = '10.%d.%d.0/24' % (rnd.randint(0,15), rnd.randint(0,255))
+        return rule
+
+    def subjects(self, count):
+        #mix of anonymous and authenticated users with client addresses
+        result = list()
+        for i in range(count):
+            if self.random.random() < 0.5:
+                user = AnonymousUser()
+            else:
+                user = User.objects.get(pk=self.random.choice(self.users).pk)
+            user.ip_address = self.random_ip()
+            result.append(user)
+        return result
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(p/100.0*(len(values)-1))))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks permission checks: queries per check, latency percentiles and throughput of perform_check, '
+        'bulk and cached paths. Runs over existing assets or, with --synthetic, over generated data that is rolled back'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--action', default='read', help='permission action to check')
+        parser.add_argument('--assets', type=int, default=100, help='number of assets to check')
+        parser.add_argument('--user', default=None, help='username, anonymous user if omitted; ignored with --synthetic')
+        parser.add_argument('--synthetic', action='store_true', help='generate users, stations, assets and permissions')
+        parser.add_argument('--synthetic-assets', type=int, default=1000)
+        parser.add_argument('--synthetic-rules', type=int, default=2000)
+        parser.add_argument('--synthetic-users', type=int, default=50)
+        parser.add_argument('--synthetic-groups', type=int, default=10)
+        parser.add_argument('--synthetic-stations', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--compare', action='store_true', help='also run staged and ordered queryset resolution and compare results')
+        parser.add_argument('--keep', action='store_true', help='commit synthetic data instead of rolling it back')
+
+    def get_user(self, username):
+        if not username:
+            return AnonymousUser()
+        return User.objects.get(username=username)
+
+    def measure(self, name, check, items):
+        #check(item) is called for every item; returns results and prints queries, percentiles and throughput
+        durations = list()
+        results = list()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for item in items:
+                check_start = time.perf_counter()
+                results.append(check(item))
+                durations.append(time.perf_counter() - check_start)
+            total = time.perf_counter() - start
+        count = max(len(items),1)
+        self.stdout.write("%-24s %6d checks  %8.2f queries/check  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  %9.1f checks/s" % (
+            name, len(items), len(queries.captured_queries)/float(count),
+            percentile(durations,50)*1000, percentile(durations,90)*1000, percentile(durations,99)*1000,
+            len(items)/total if total > 0 else 0))
+        return results
+
+    def measure_bulk(self, name, check, chunks):
+        #check(chunk) returns {pk: bool}; latency is per chunk divided by its length
+        durations = list()
+        results = dict()
+        checks = 0
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for chunk in chunks:
+                check_start = time.perf_counter()
+                results.update(check(chunk))
+                durations.append((time.perf_counter() - check_start)/max(len(chunk),1))
+                checks += len(chunk)
+            total = time.perf_counter() - start
+        self.stdout.write("%-24s %6d checks  %8.2f queries/check  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  %9.1f checks/s" % (
+            name, checks, len(queries.captured_queries)/float(max(checks,1)),
+            percentile(durations,50)*1000, percentile(durations,90)*1000, percentile(durations,99)*1000,
+            checks/total if total > 0 else 0))
+        return results
+
+    def report_mismatches(self, name, reference, results):
+        mismatches = [i for i in range(len(reference)) if reference[i] != results[i]]
+        if len(mismatches) > 0:
+            self.stdout.write(self.style.ERROR("%s differs from perform_check in %d of %d checks" % (name, len(mismatches), len(reference))))
+        else:
+            self.stdout.write(self.style.SUCCESS("%s: same results as perform_check" % name))
+
+    def run_suite(self, action, pairs, compare):
+        #pairs is a list of (user, asset)
+        permissions.get_rule_index()
+        self.stdout.write("rule index: %d rules, %d stationinroutes" % (len(permissions.get_rule_index().rules), len(permissions.get_rule_index().stationinroutes)))
+
+        with override_settings(NEXUS_PERMISSION_DECISION_CACHE=False):
+            reference = self.measure('perform_check', lambda pair: permissions.perform_check(pair[0], None, None, None, None, pair[1], action, False), pairs)
+
+            if compare:
+                def staged(pair):
+                    user, asset = pair
+                    perms = permissions.get_permissions_list(action=action,asset=asset,_stationinroute=asset.stationinroute,_station=asset.stationinroute.station,_route=asset.stationinroute.route,_asset_type=asset.type,user=user)
+                    return permissions._resolve_queryset_by_stages(perms)[0]
+                def ordered(pair):
+                    user, asset = pair
+                    perms = permissions.get_permissions_list(action=action,asset=asset,_stationinroute=asset.stationinroute,_station=asset.stationinroute.station,_route=asset.stationinroute.route,_asset_type=asset.type,user=user)
+                    return permissions._resolve_queryset(perms)[0]
+                self.report_mismatches('staged queryset', reference, self.measure('staged queryset', staged, pairs))
+                self.report_mismatches('ordered queryset', reference, self.measure('ordered queryset', ordered, pairs))
+
+            #bulk path: assets of the same user are checked together
+            by_user = dict()
+            for user, asset in pairs:
+                by_user.setdefault(id(user), (user, list()))[1].append(asset)
+            bulk = self.measure_bulk('check_permissions_bulk', lambda chunk: dict(((id(chunk[0]), pk), result) for pk, result in permissions.check_permissions_bulk(chunk[0], chunk[1], action).items()), list(by_user.values()))
+            bulk_results = [bulk[(id(user), asset.pk)] for user, asset in pairs]
+            self.report_mismatches('check_permissions_bulk', reference, bulk_results)
+
+        with override_settings(NEXUS_PERMISSION_DECISION_CACHE=True):
+            for asset in set(asset for user, asset in pairs):
+                permissions.invalidate_asset_decisions(asset)
+            check = lambda pair: permissions.perform_check(pair[0], None, None, None, None, pair[1], action, False)
+            self.report_mismatches('decision cache, cold', reference, self.measure('decision cache, cold', check, pairs))
+            self.report_mismatches('decision cache, warm', reference, self.measure('decision cache, warm', check, pairs))
+
+        for user in set(user for user, asset in pairs):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                count = Asset.objects.visible_to(user, action).count()
+                duration = time.perf_counter() - start
+            self.stdout.write("%-24s user %-24s %6d assets  %3d queries  %7.2fms" % ('visible_to', str(user)[:24], count, len(queries.captured_queries), duration*1000))
+            break
+
+        self.stdout.write("permission log: %d written, %d dropped" % (permissions.permission_log.written, permissions.permission_log.dropped))
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if not options['synthetic']:
+            user = self.get_user(options['user'])
+            assets = list(Asset.objects.all().select_related('stationinroute').order_by('-pk')[:options['assets']])
+            permissions.load_deferred_asset_fields(assets)
+            self.stdout.write("%d existing assets, action '%s', user %s" % (len(assets), action, user))
+            self.run_suite(action, [(user, asset) for asset in assets], options['compare'])
+            return
+
+        data = SyntheticPermissionData(
+            users=options['synthetic_users'],
+            groups=options['synthetic_groups'],
+            stations=options['synthetic_stations'],
+            assets=options['synthetic_assets'],
+            rules=options['synthetic_rules'],
+            seed=options['seed'],
+        )
+        with transaction.atomic():
+            start = time.perf_counter()
+            data.build()
+            self.stdout.write("synthetic data built in %.1fs: %s" % (time.perf_counter()-start, ', '.join('%s=%d' % item for item in data.counts.items())))
+
+            assets = data.random.sample(data.assets, min(options['assets'], len(data.assets)))
+            subjects = data.subjects(max(1, len(assets)//10))
+            pairs = [(data.random.choice(subjects), asset) for asset in assets]
+            self.run_suite(action, pairs, options['compare'])
+
+            #nothing of the synthetic data must stay in the log buffer or in compiled rules
+            with permissions.permission_log.lock:
+                permissions.permission_log.entries = list()
+            if not options['keep']:
+                transaction.set_rollback(True)
+        if options['keep']:
+            permissions.invalidate_rule_index()
+        else:
+            permissions.reload_rule_index()
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from nexus.models import Asset, StationInRoute
+from nexus.modifications import get_compiled_modifications
+from nexus.bulk_modifications import bulk_modify_payloads, BULK_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        'Applies payload_modifications to many assets at once as jsonb UPDATEs in chunked transactions, '
+        'operations without SQL form run in Python per asset; reports rows changed per operation'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modification', action='append', help='payload modification, may be repeated, applied in order')
+        parser.add_argument('--variant', default=None, help='<stationinroute pk>:<routing index>, use payload_modifications of that routing variant')
+        parser.add_argument('--route', type=int, action='append', help='route pk, may be repeated')
+        parser.add_argument('--stationinroute', type=int, action='append', help='stationinroute pk, may be repeated')
+        parser.add_argument('--type', type=int, action='append', help='asset type pk, may be repeated')
+        parser.add_argument('--dry-run', action='store_true', help='roll every chunk back, only count rows')
+        parser.add_argument('--no-reindex', action='store_true', help="don't update search index of changed assets")
+        parser.add_argument('--processes', type=int, default=1, help='worker processes, 1 runs inline')
+        parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE, help='assets per chunk and transaction')
+        parser.add_argument('--quiet', action='store_true', help='print only totals')
+
+    def get_modifications(self, options):
+        if bool(options['modification']) == bool(options['variant']):
+            raise CommandError('give either --modification or --variant')
+        if options['modification']:
+            return options['modification']
+        try:
+            sr_pk, index = options['variant'].split(':')
+            route_variant = StationInRoute.objects.get(pk=int(sr_pk)).properties['routing'][int(index)]
+        except StationInRoute.DoesNotExist:
+            raise CommandError('no such stationinroute')
+        except Exception:
+            raise CommandError('--variant must be <stationinroute pk>:<routing index> of an existing routing variant')
+        if 'payload_modifications' not in route_variant:
+            raise CommandError('routing variant has no payload_modifications')
+        return route_variant['payload_modifications']
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        modifications = self.get_modifications(options)
+        errors = get_compiled_modifications(modifications).errors
+        if len(errors) > 0:
+            raise CommandError('\n'.join(errors))
+
+        assets = Asset.objects.all()
+        if options['route']:
+            assets = assets.filter(route_id__in=options['route'])
+        if options['stationinroute']:
+            assets = assets.filter(stationinroute_id__in=options['stationinroute'])
+        if options['type']:
+            assets = assets.filter(type_id__in=options['type'])
+
+        totals = bulk_modify_payloads(assets, modifications, processes=options['processes'], chunk_size=options['chunk_size'],
+            dry_run=options['dry_run'], reindex=not options['no_reindex'], verbose=not options['quiet'])
+        for operation in totals['operations']:
+            self.stdout.write("%8d rows  %-6s %-16s %s" % (operation['rows'], operation['mode'], operation['operation'], operation['modification']))
+        self.stdout.write("%d assets in %.1fs (%.1f assets/s): %d changed, %d failed, %d failed chunks%s" % (
+            totals['assets'], totals['seconds'], totals['assets']/max(totals['seconds'], 0.001),
+            totals['changed'], totals['failed'], totals['failed_chunks'], ' (dry run, nothing saved)' if options['dry_run'] else ''))
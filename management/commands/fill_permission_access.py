@@ -0,0 +1,49 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from nexus.models import Asset
+from nexus import permissions
+from nexus.parallel import iterate_chunks
+
+
+class Command(BaseCommand):
+    help = (
+        'Fills Nexus_permission_access with decisions of anonymous, authenticated and group audiences; '
+        'checks never write the table, run this after enabling it and after bulk changes that bypass signals'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--action', action='append', help='permission action, may be repeated (default: every action of the rules)')
+        parser.add_argument('--type', type=int, action='append', help='asset type pk, may be repeated')
+        parser.add_argument('--route', type=int, action='append', help='route pk, may be repeated')
+        parser.add_argument('--chunk-size', type=int, default=500, help='assets per transaction')
+
+    def handle(self, *args, **options):
+        if not permissions.access_table_enabled():
+            raise CommandError('access table is disabled, set %s = True' % permissions.ACCESS_TABLE_SETTING)
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        index = permissions.get_rule_index()
+        actions = options['action'] or sorted(index.actions.keys())
+        assets = Asset.objects.all().defer(None).order_by('pk')
+        if options['type']:
+            assets = assets.filter(type_id__in=options['type'])
+        if options['route']:
+            assets = assets.filter(route_id__in=options['route'])
+
+        start = time.time()
+        assets_count = 0
+        rows_count = 0
+        for chunk in iterate_chunks(assets.iterator(chunk_size=options['chunk_size']), options['chunk_size']):
+            written = permissions.fill_access_table(chunk, actions, index)
+            if written is None:
+                #rules changed while the chunk was computed
+                index = permissions.get_rule_index()
+                written = permissions.fill_access_table(chunk, actions, index)
+                if written is None:
+                    raise CommandError('rules keep changing, try again later')
+            assets_count += len(chunk)
+            rows_count += written
+            self.stderr.write("%d assets, %d rows, %.0f assets/s" % (assets_count, rows_count, assets_count/max(time.time()-start, 0.001)))
+
+        self.stdout.write("done: %d assets x %d actions in %.1fs, %d rows" % (assets_count, len(actions), time.time()-start, rows_count))
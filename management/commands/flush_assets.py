@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from nexus.models import Route, Station
+from nexus.flush import FLUSH_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Flushes a route (asset_action) or a station (perform) for all its assets in chunks, optionally in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--route', type=int, help='route pk')
+        parser.add_argument('--station', type=int, help='station pk')
+        parser.add_argument('--processes', type=int, default=1, help='worker processes, 1 runs inline')
+        parser.add_argument('--chunk-size', type=int, default=FLUSH_CHUNK_SIZE, help='assets per chunk and transaction')
+        parser.add_argument('--quiet', action='store_true', help='print only totals')
+
+    def handle(self, *args, **options):
+        if bool(options['route']) == bool(options['station']):
+            raise CommandError('give either --route or --station')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        try:
+            if options['route']:
+                owner = Route.objects.get(pk=options['route'])
+            else:
+                owner = Station.objects.get(pk=options['station'])
+        except (Route.DoesNotExist, Station.DoesNotExist):
+            raise CommandError('no such route/station')
+
+        totals = owner.flush(processes=options['processes'], chunk_size=options['chunk_size'], verbose=not options['quiet'])
+        self.stdout.write("%d assets in %.1fs (%.1f assets/s): %d processed, %d skipped (locked or moved), %d failed, %d failed chunks" % (
+            totals['assets'], totals['seconds'], totals['assets']/max(totals['seconds'], 0.001),
+            totals['processed'], totals['skipped'], totals['failed'], totals['failed_chunks']))
+        if len(totals['skipped_assets']) > 0:
+            self.stdout.write("skipped assets: %s" % ' '.join(str(pk) for pk in totals['skipped_assets']))
@@ -0,0 +1,95 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from nexus.models import Asset
+from nexus.simulator import RoutingSimulator, simulate_rows, get_asset_rows, SIMULATION_CHUNK_SIZE, SIMULATION_MAX_HOPS
+from nexus import routing
+
+
+class Command(BaseCommand):
+    help = (
+        'Dry-runs automatic routing of assets (or synthetic payloads) with saved or proposed StationInRoute.properties '
+        'and reports destinations, hop counts, loops and evaluation cost; nothing is written'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--route', type=int, help='simulate assets of the route')
+        parser.add_argument('--stationinroute', type=int, help='simulate assets of the stationinroute')
+        parser.add_argument('--limit', type=int, default=None, help='simulate at most that many assets')
+        parser.add_argument('--synthetic', help='json file with a list of {"stationinroute","type","payload","meta"} to simulate instead of real assets')
+        parser.add_argument('--properties', help='json file {stationinroute pk: properties} used instead of saved properties')
+        parser.add_argument('--max-hops', type=int, default=SIMULATION_MAX_HOPS)
+        parser.add_argument('--processes', type=int, default=1, help='worker processes, 1 runs inline')
+        parser.add_argument('--chunk-size', type=int, default=SIMULATION_CHUNK_SIZE)
+
+    def load_json(self, file_name):
+        try:
+            with open(file_name) as f:
+                return json.load(f)
+        except Exception as e:
+            raise CommandError('cannot read %s: %s' % (file_name, e))
+
+    def get_rows(self, options):
+        if options['synthetic']:
+            rows = list()
+            for item in self.load_json(options['synthetic']):
+                rows.append((None, int(item['type']), int(item['stationinroute']), item.get('payload',dict()), item.get('meta',dict()), None))
+            return rows[:options['limit']] if options['limit'] else rows
+        if not options['route'] and not options['stationinroute']:
+            raise CommandError('give --route, --stationinroute or --synthetic')
+        assets = Asset.objects.all()
+        if options['route']:
+            assets = assets.filter(stationinroute__route_id=options['route'])
+        if options['stationinroute']:
+            assets = assets.filter(stationinroute_id=options['stationinroute'])
+        if options['limit']:
+            assets = assets.order_by('pk')[:options['limit']]
+            return list(assets.values_list('pk','type_id','stationinroute_id','payload','meta','operator_id'))
+        return get_asset_rows(assets, options['chunk_size'])
+
+    def handle(self, *args, **options):
+        properties = self.load_json(options['properties']) if options['properties'] else None
+        simulator = RoutingSimulator(properties=properties, max_hops=options['max_hops'])
+        start = time.time()
+
+        def progress(report, seconds):
+            self.stderr.write("%d assets simulated, %.0f assets/s" % (report.assets, report.assets/max(time.time()-start, 0.001)))
+
+        report = simulate_rows(simulator, self.get_rows(options), processes=options['processes'], chunk_size=options['chunk_size'], progress=progress)
+        elapsed = time.time()-start
+
+        self.stdout.write("%d assets in %.1fs, %d failed" % (report.assets, elapsed, len(report.failed)))
+        self.stdout.write("\ndestinations:")
+        for sr_pk, count in report.destinations.most_common():
+            sr = simulator.stationinroutes.get(sr_pk, None)
+            self.stdout.write("  %6d  #%s %s" % (count, sr_pk, str(sr) if sr else ''))
+        self.stdout.write("\nhops per asset:")
+        for hops in sorted(report.hops):
+            self.stdout.write("  %3d hops: %d" % (hops, report.hops[hops]))
+        self.stdout.write("\nrouting stopped by:")
+        for stop, count in report.stops.most_common():
+            self.stdout.write("  %s: %d" % (stop, count))
+        if len(report.loops) > 0:
+            self.stdout.write(self.style.WARNING("\nloops (first %d):" % len(report.loops)))
+            for asset_pk, path in report.loops:
+                self.stdout.write("  asset #%s: %s" % (asset_pk, ' -> '.join('#'+str(pk) for pk in path)))
+        for asset_pk, error in report.failed[:20]:
+            self.stderr.write("asset #%s failed: %s" % (asset_pk, error))
+
+        if options['route']:
+            graph = simulator.graph
+            cycles = graph.find_cycles(options['route'])
+            unreachable = graph.find_unreachable(options['route'])
+            self.stdout.write("\nroute graph: %s%d automatic routing cycles, %d unreachable stationinroutes (saved properties)" % (
+                'at least ' if len(cycles) >= routing.ROUTE_GRAPH_MAX_CYCLES else '', len(cycles), len(unreachable)))
+            for cycle in cycles[:20]:
+                self.stdout.write("  cycle: %s" % ' -> '.join('#'+str(pk) for pk in cycle+cycle[:1]))
+            for pk in unreachable:
+                self.stdout.write("  unreachable: #%s %s" % (pk, str(simulator.stationinroutes.get(pk, ''))))
+
+        hops = report.total_hops()
+        self.stdout.write("\nevaluation cost: %d routing variants checked, %.3f ms per asset, %.3f ms requirement checks and %.3f ms modifications per hop" % (
+            report.evaluations,
+            1000.0*(report.check_seconds+report.modification_seconds)/max(report.assets,1),
+            1000.0*report.check_seconds/max(hops,1),
+            1000.0*report.modification_seconds/max(hops,1)))
@@ -7,10 +7,13 @@ import os
 import sys
 import datetime
 import codecs
+import hashlib
+import threading
 from psycopg2.extras import Json
-from django.db import models
+from django.db import models, DatabaseError
 from django.http import FileResponse
 from django.dispatch import receiver
+from django.core.signals import request_started, request_finished
 from django.contrib.postgres.fields import JSONField
 from django.contrib.auth.models import User, Group,AnonymousUser
 from nexus.custom_stations import *
@@ -67,6 +70,14 @@ class AssetManager(models.Manager):
     def get_queryset(self):
         return super(AssetManager, self).get_queryset().defer('payload', 'meta')
 
+    def visible_to(self, user, action):
+        #assets the action is permitted on for the user, same result as Nexus_permission.check_permissions per asset
+        from nexus.permissions import filter_visible_assets
+        return filter_visible_assets(self.get_queryset(), user, action)
+
+#message of the DatabaseError django raises itself when a save with update_fields finds no row
+UPDATE_FIELDS_NO_ROWS = 'Save with update_fields did not affect any rows.'
+
 class Asset(models.Model):
     meta_help_text = (
         "creator(int) - creator user's pk<br>"
@@ -94,12 +105,87 @@ class Asset(models.Model):
 
     objects = AssetManager()
 
+    #fields compared with their loaded/saved state to find out what save() has to write
+    tracked_fields = ['type','route','stationinroute','operator','payload','meta']
+    json_fields = ['payload','meta']
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Asset, cls).from_db(db, field_names, values)
+        instance._remember_state()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        #also loads deferred payload and meta on first access
+        super(Asset, self).refresh_from_db(using=using, fields=fields)
+        self._remember_state(fields)
+
+    def _get_field_state(self, field_name):
+        if field_name in self.json_fields:
+            try:
+                return hashlib.md5(json.dumps(getattr(self, field_name), sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            except:
+                #not serializable - always written
+                return object()
+        return getattr(self, self._meta.get_field(field_name).attname)
+
+    def _get_state(self, fields=None):
+        #states of loaded tracked fields; deferred fields that were never loaded are not in __dict__
+        state = dict()
+        for field_name in (fields or self.tracked_fields):
+            if field_name in self.tracked_fields and self._meta.get_field(field_name).attname in self.__dict__:
+                state[field_name] = self._get_field_state(field_name)
+        return state
+
+    def _remember_state(self, fields=None, state=None):
+        if not hasattr(self, '_saved_state'):
+            self._saved_state = dict()
+        self._saved_state.update(state if state is not None else self._get_state(fields))
+
+    def get_dirty_fields(self, state=None):
+        saved_state = getattr(self, '_saved_state', dict())
+        if state is None:
+            state = self._get_state()
+        return [field_name for field_name in self.tracked_fields if field_name in state and (field_name not in saved_state or saved_state[field_name] != state[field_name])]
+
+    def save(self, *args, **kwargs):
+        #routing steps defer saves and write the asset once, see routing.deferred_asset_saves
+        if getattr(self, '_defer_save', False) and self.pk is not None:
+            self._save_pending = True
+            return
+        #existing assets write only changed fields, unchanged ones are not saved at all (no query, no signals);
+        #save(force=True) writes every field and sends signals anyway, e.g. to reindex an unchanged asset
+        force = kwargs.pop('force', False)
+        tracked_save = not force and self.pk is not None and not self._state.adding and len(args) == 0 and kwargs.get('update_fields', None) is None and not kwargs.get('force_insert', False)
+        state = None
+        if tracked_save:
+            state = self._get_state()
+            dirty_fields = self.get_dirty_fields(state)
+            if len(dirty_fields) == 0:
+                count_asset_write(self, None, skipped=True)
+                return
+            kwargs['update_fields'] = dirty_fields
+        try:
+            super(Asset, self).save(*args, **kwargs)
+        except DatabaseError as e:
+            #raised by django, not by the database, when the row was deleted meanwhile;
+            #a full save inserts it again as it did before update_fields were used
+            if not tracked_save or type(e) is not DatabaseError or str(e) != UPDATE_FIELDS_NO_ROWS:
+                raise
+            kwargs.pop('update_fields')
+            super(Asset, self).save(*args, **kwargs)
+        count_asset_write(self, kwargs.get('update_fields', None))
+        self._remember_state(state=state)
+
 
     def get_fields(self, user):
         fields_ordered_list = list()
         fieldset = list()
 
-        if ((user==self.operator) and (user is not None)) or (user in self.stationinroute.station.supervisors.all())  or (user in self.stationinroute.station.operators.all()):
+        from nexus.permissions import get_user_permission_context, get_stationinroute_station_id
+        user_context = get_user_permission_context(user)
+        station_id = get_stationinroute_station_id(self.stationinroute_id)
+        if ((user==self.operator) and (user is not None)) or user_context.supervises_station(station_id) or user_context.operates_station(station_id):
             #operator and supervisor get station-defined editable and appendable fields from payload
             field_templates = self.stationinroute.station.get_field_templates(self.type.sysname)
             try:
@@ -161,6 +247,59 @@ class Asset(models.Model):
 
  
 
+#=====================================================================
+# asset write instrumentation: saves, skipped no-op saves and written fields
+# per request (or per management command run), printed at request end
+# if NEXUS_LOG_ASSET_WRITES is set
+#=====================================================================
+
+ASSET_WRITES_SETTING = 'NEXUS_LOG_ASSET_WRITES'
+_asset_writes = threading.local()
+
+
+def get_asset_write_stats():
+    stats = getattr(_asset_writes, 'stats', None)
+    if stats is None:
+        stats = reset_asset_write_stats()
+    return stats
+
+
+def reset_asset_write_stats():
+    _asset_writes.stats = {'saves':0,'skipped':0,'full_saves':0,'fields':dict(),'assets':set()}
+    return _asset_writes.stats
+
+
+def count_asset_write(asset, update_fields, skipped=False):
+    #update_fields None is a save of every field (new asset or explicit save arguments)
+    stats = get_asset_write_stats()
+    if skipped:
+        stats['skipped'] += 1
+        return
+    stats['saves'] += 1
+    stats['assets'].add(asset.pk)
+    if update_fields is None:
+        stats['full_saves'] += 1
+        return
+    for field_name in update_fields:
+        stats['fields'][field_name] = stats['fields'].get(field_name, 0)+1
+
+
+@receiver(request_started)
+def asset_writes_request_started(sender, **kwargs):
+    reset_asset_write_stats()
+
+
+@receiver(request_finished)
+def asset_writes_request_finished(sender, **kwargs):
+    from django.conf import settings
+    if not getattr(settings, ASSET_WRITES_SETTING, False):
+        return
+    stats = get_asset_write_stats()
+    if stats['saves'] > 0 or stats['skipped'] > 0:
+        print("asset writes: %d saves of %d assets, %d full, %d skipped as unchanged, fields %s" % (
+            stats['saves'], len(stats['assets']), stats['full_saves'], stats['skipped'], stats['fields']))
+
+
 @receiver(models.signals.pre_delete)
 def delete_asset_files(sender, instance, **kwargs):
     if not isinstance(instance, Asset):
@@ -238,6 +377,30 @@ class Nexus_permission(models.Model):
         from nexus.permissions import perform_check
         return perform_check(user, asset_type, route, station, stationinroute, asset, action, debug)
 
+    @classmethod
+    async def acheck_permissions(cls, user=None, asset_type=None, route=None, station=None, stationinroute=None, asset=None, action=None):
+        #check_permissions for async views
+        from nexus.permissions import aperform_check
+        return await aperform_check(user, asset_type, route, station, stationinroute, asset, action)
+
+    @classmethod
+    def check_permissions_bulk(cls, user=None, assets=list(), action=None):
+        #returns {asset.pk: bool}
+        from nexus.permissions import check_permissions_bulk
+        return check_permissions_bulk(user, assets, action)
+
+    @classmethod
+    def explain_check(cls, user=None, asset_type=None, route=None, station=None, stationinroute=None, asset=None, action=None):
+        #dict with rules eliminated by every stage, winner, timings and queries, see permissions.explain_check
+        from nexus.permissions import explain_check
+        return explain_check(user, asset_type, route, station, stationinroute, asset, action)
+
+    @classmethod
+    def check_asset_access(cls, user=None, asset=None, action=None):
+        #same as check_permissions for an asset, uses Nexus_permission_access if it is enabled
+        from nexus.permissions import check_asset_access
+        return check_asset_access(user, asset, action)
+
 
     def __str__(self):
             str_repr = "#"+str(self.pk)+" "
@@ -261,6 +424,106 @@ class Nexus_permission(models.Model):
                 str_repr+= "[IP="+str(self.ip_range)+"]"
             return str_repr
 
+class Nexus_permission_access(models.Model):
+    #materialized decisions of Nexus_permission for users without personal rules, see permissions.check_asset_access
+    AUDIENCE_CHOICES = (
+        ('anonymous','anonymous'),
+        ('authenticated','authenticated'),
+        ('group','group'),
+    )
+    asset = models.ForeignKey(Asset,related_name='+',on_delete=models.CASCADE)
+    permission_action_sysname = models.CharField(max_length=100,blank=True,null=True,)
+    audience = models.CharField(max_length=20,choices=AUDIENCE_CHOICES,)
+    group = models.ForeignKey(Group,blank=True,null=True,related_name='+',on_delete=models.CASCADE)
+    entry_result = models.BooleanField(default=False,)
+    permission = models.ForeignKey('Nexus_permission',blank=True,null=True,related_name='+',on_delete=models.SET_NULL)
+    rule_index_version = models.CharField(max_length=32,blank=True,default='',)
+
+    class Meta:
+        index_together = (('asset','permission_action_sysname','audience','group'),)
+
+def get_permission_access_fields(instance):
+    #fields of a permission deciding which Nexus_permission_access rows it may change
+    from nexus.permissions import ACCESS_RULE_FIELDS
+    return dict((field, getattr(instance, field)) for field in ACCESS_RULE_FIELDS)
+
+@receiver(models.signals.pre_save, sender=Nexus_permission)
+def permission_access_remember(sender, instance, **kwargs):
+    #rows decided by the permission before the change are invalidated too
+    from nexus.permissions import ACCESS_RULE_FIELDS, access_table_enabled
+    instance._access_fields_before = None
+    if instance.pk is not None and access_table_enabled():
+        instance._access_fields_before = Nexus_permission.objects.filter(pk=instance.pk).values(*ACCESS_RULE_FIELDS).first()
+
+@receiver(models.signals.post_save, sender=Asset)
+def permission_asset_update(sender, instance, **kwargs):
+    #stored and cached decisions of the asset
+    from nexus.permissions import invalidate_access_table, invalidate_asset_decisions
+    invalidate_access_table(instance)
+    invalidate_asset_decisions(instance)
+
+@receiver(models.signals.post_save, sender=Nexus_permission)
+def permission_rule_index_update(sender, instance, **kwargs):
+    #compiled rules copy permissions, see permission_stationinroute_update for station/route of stationinroutes
+    from nexus.permissions import invalidate_rule_index, invalidate_access_rules
+    invalidate_rule_index()
+    rules_fields = [get_permission_access_fields(instance)]
+    if getattr(instance, '_access_fields_before', None):
+        rules_fields.append(instance._access_fields_before)
+    invalidate_access_rules(rules_fields)
+
+@receiver(models.signals.pre_delete)
+def permission_rule_index_check_asset(sender, instance, **kwargs):
+    #permissions referencing the object become wider once the reference is set to null, remember them
+    from nexus.permissions import ACCESS_RULE_FIELDS, invalidate_access_stationinroute
+    nulled_fields = ((Asset,'asset'),(AssetType,'asset_type'),(Route,'route'),(Station,'station'),(StationInRoute,'stationinroute'),(User,'user'),(Group,'group'))
+    for model, field in nulled_fields:
+        if isinstance(instance, model):
+            rules_fields = list(Nexus_permission.objects.filter(**{field:instance}).values(*ACCESS_RULE_FIELDS))
+            for rule_fields in rules_fields:
+                if field+'_id' in rule_fields:
+                    rule_fields[field+'_id'] = None
+            instance._nulled_permission_fields = rules_fields
+            #most assets are not permission targets
+            instance._is_permission_target = len(rules_fields) > 0
+            break
+    if isinstance(instance, StationInRoute):
+        invalidate_access_stationinroute(instance.pk)
+
+@receiver(models.signals.post_delete)
+def permission_rule_index_delete(sender, instance, **kwargs):
+    #targets are set to null on delete without saving the permission, so post_save of Nexus_permission is not sent
+    from nexus.permissions import invalidate_rule_index, invalidate_access_rules
+    if isinstance(instance, Asset):
+        if getattr(instance, '_is_permission_target', True):
+            invalidate_rule_index()
+            invalidate_access_rules(getattr(instance, '_nulled_permission_fields', list()))
+        return
+    if isinstance(instance, Nexus_permission):
+        invalidate_rule_index()
+        invalidate_access_rules([get_permission_access_fields(instance)])
+        return
+    if not isinstance(instance, (StationInRoute, Station, Route, AssetType, User, Group)):
+        return
+    invalidate_rule_index()
+    invalidate_access_rules(getattr(instance, '_nulled_permission_fields', list()))
+
+@receiver(models.signals.m2m_changed, sender=User.groups.through)
+def permission_user_groups_update(sender, instance, action, reverse, pk_set, **kwargs):
+    #cached group ids of users, see permissions.get_user_group_ids
+    from nexus.permissions import invalidate_user_group_ids
+    if not reverse:
+        if action in ['post_add','post_remove','post_clear']:
+            invalidate_user_group_ids([instance.pk])
+        return
+    #group side: pk_set holds users, clear doesn't tell which ones - remember them before
+    if action == 'pre_clear':
+        instance._cleared_user_ids = list(instance.user_set.values_list('id',flat=True))
+    elif action == 'post_clear':
+        invalidate_user_group_ids(getattr(instance, '_cleared_user_ids', list()))
+    elif action in ['post_add','post_remove']:
+        invalidate_user_group_ids(pk_set or list())
+
 class MasterField(models.Model):
     default_settings = dict()
     default_settings["title"] = "TITLE_NOT_SET"
@@ -337,7 +600,7 @@ class FileStorage(models.Model):
         if user == asset.operator:
             can_download = True
         if not can_download:
-            can_download = Nexus_permission.check_permissions(user=user,asset=asset,action='download')
+            can_download = Nexus_permission.check_asset_access(user=user,asset=asset,action='download')
         if debug:
             print('can_download=',can_download)
         if not can_download:
@@ -398,7 +661,7 @@ class FileStorage(models.Model):
         if request.user == asset.operator:
             can_read = True
         if not can_read:
-            can_read = Nexus_permission.check_permissions(user=user,asset=asset,action='read')
+            can_read = Nexus_permission.check_asset_access(user=user,asset=asset,action='read')
         if isinstance(user,AnonymousUser):
             user=None
 
@@ -504,371 +767,36 @@ class Route(models.Model):
 
         if debug:
             print('<<< asset_action end')
-    def flush(self):
-        for asset in Asset.objects.filter(stationinroute__route=self):
-            self.asset_action(asset)
+    def flush(self,processes=1,chunk_size=None,verbose=True):
+        #asset_action for every asset of the route in chunks, see flush.py
+        from nexus.flush import flush_assets, FLUSH_CHUNK_SIZE
+        return flush_assets('route',self,processes=processes,chunk_size=chunk_size or FLUSH_CHUNK_SIZE,verbose=verbose)
 
     #returns a list of possible routes with is_validated indicating a route with fulfilled requirements
 
 
+    #requirements are compiled into predicates, see routing.py
     def _check_atomic_requirement(self, asset, requirement):
-        payload = asset.payload
-        debug = False
+        from nexus.routing import compile_atomic_requirement
+        result = compile_atomic_requirement(requirement).check(asset)
         if asset.meta.get('debug',False):
-            debug = True
-        if debug:
-            print(">",self,requirement)
-        result = dict()
-        result['is_validated'] = False
-        result['title'] = requirement['title']
-        if requirement['sysname'] == 'STATION_FORMFILL':
-            if debug:
-                print('station_formfill: checking required fields')
-            try:
-                if debug:
-                    print("checking asset.payload for required_fields presence")
-                    print('asset.payload:',asset.payload)
-                    print('required_fields:',asset.stationinroute.station.properties['field_templates'][asset.type.sysname].get('required_fields',[]))
-                
-                result['is_validated'] = True
-                for key in asset.stationinroute.station.properties['field_templates'][asset.type.sysname].get('required_fields',[]):
-                    if '.' not in key:
-                        if debug:
-                            print('checking',key)
-                        if key not in payload:
-                            if debug:
-                                print('not in payload, return false')
-                            result['is_validated'] = False
-                            return result
-                        if debug:
-                            print('in payload, keep on checking')
-                    else:#compound requirement
-                        master = key.split('.')[0]
-                        subkey = key.split('.')[1]
-                        if debug:
-                            print('checking compound',key)
-                        if master not in payload:
-                            if debug:
-                                print('not in payload, return false')
-                            result['is_validated'] = False
-                            return result
-                        else:
-                            for item in payload[master]:
-                                if subkey not in item or item[subkey].strip() == '':
-                                    if debug:
-                                        print('subkey is not in payload or empty, return false')
-                                    result['is_validated'] = False
-                        if debug:
-                            print('in payload, keep on checking')
-
-                        
-            except Exception as e:
-                print("ERROR checking sttion_formfill requirement",e)
-
-            if debug:    
-                print("returning",result)
-            return result
-        if '.' in requirement['sysname']: #dictionary requirement 
-            if debug:
-                print('requirement is dictionary:',requirement['sysname'])
-
-            payload_key_name = requirement['sysname'].split('.')[0]
-            dictionary_key_name = requirement['sysname'].split('.')[1]
-            if payload_key_name not in payload:
-                if debug:
-                    print('field',payload_key_name,'not in payload')
-                result['is_validated'] = False
-
-            else:
-                for dict_value in payload[payload_key_name]:
-                    if isinstance(dict_value,dict):
-                        if debug:
-                            print('payload value is a dict, ok')
-
-                        if dictionary_key_name in dict_value:
-                            if debug:
-                                print('subkey',dictionary_key_name,' found in value, ok')
-
-                            if 'value_equals' in requirement:
-                                if debug:
-                                    print('requirement is value_equals')
-                                if isinstance(dict_value[dictionary_key_name],str) and isinstance(requirement['value_equals'],str):
-                                    if debug:
-                                        print('requirement value is string and  is to be compared respectively, current result is',str(result['is_validated']))
-
-                                    #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                                    if dict_value[dictionary_key_name].strip().lower() == requirement['value_equals'].strip().lower():
-                                        if debug:
-                                            print('comparison success:',dict_value[dictionary_key_name].strip().lower(),'=',requirement['value_equals'].strip().lower())
-
-                                        result['is_validated'] = True
-                                else:
-                                    if debug:
-                                        print('requirement value is not a string')
-
-                                    if dict_value[dictionary_key_name] == requirement['value_equals']:
-                                        if debug:
-                                            print('comparison success:',str(dict_value[dictionary_key_name]),'=',str(requirement['value_equals']))
-
-                                        result['is_validated'] = True
-                            elif 'value_equals_any' in requirement:
-                                if debug:
-                                    print('requirement is value_equals_any')
-                                for requirement_variant in requirement['value_equals_any']:
-                                    if isinstance(dict_value[dictionary_key_name],str) and isinstance(requirement_variant,str):
-                                        if debug:
-                                            print('requirement value is string and  is to be compared respectively, current result is',str(result['is_validated']))
-
-                                        #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                                        if dict_value[dictionary_key_name].strip().lower() == requirement_variant.strip().lower():
-                                            if debug:
-                                                print('comparison success:',dict_value[dictionary_key_name].strip().lower(),'=',requirement_variant.strip().lower())
-
-                                            result['is_validated'] = True
-                                            break
-                                    else:
-                                        if debug:
-                                            print('requirement value is not a string')
-
-                                        if dict_value[dictionary_key_name] == requirement_variant:
-                                            if debug:
-                                                print('comparison success:',str(dict_value[dictionary_key_name]),'=',str(requirement_variant))
-
-                                            result['is_validated'] = True
-                                            break
-                            elif 'value_not_equals' in requirement:
-                                if debug:
-                                    print('requirement is value_not_equals')
-                                if isinstance(dict_value[dictionary_key_name],str) and isinstance(requirement['value_not_equals'],str):
-                                    #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                                    if dict_value[dictionary_key_name].strip().lower() != requirement['value_not_equals'].strip().lower():
-                                        result['is_validated'] = True
-                                else:
-                                    if dict_value[dictionary_key_name] != requirement['value_not_equals']:
-                                        result['is_validated'] = True
-
-
-                            elif 'value_equals_payload_value' in requirement:
-                                if debug:
-                                    print('requirement is value_equals_payload_value')
-                                #comparing only first items
-                                if '.' in requirement['value_equals_payload_value']:
-                                    payload_key = requirement['value_equals_payload_value'].split('.')[0]
-                                    payload_subkey = requirement['value_equals_payload_value'].split('.')[1]
-                                    value_to_compare = None
-                                    try:
-                                        value_to_compare = payload[payload_key][0][payload_subkey]
-                                    except:
-                                        value_to_compare = None
-                                else:
-                                    value_to_compare = None
-                                    try:
-                                        value_to_compare = payload[requirement['value_equals_payload_value']][0]
-                                    except:
-                                        value_to_compare = None
-        
-
-                                if isinstance(dict_value[dictionary_key_name],str) and isinstance(value_to_compare,str):
-                                    #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                                    if dict_value[dictionary_key_name].strip().lower() == value_to_compare.strip().lower():
-                                        result['is_validated'] = True
-                                else:
-                                    if dict_value[dictionary_key_name] == value_to_compare:
-                                        result['is_validated'] = True
-
-
-
-                            elif 'value_greater' in requirement:
-                                if debug:
-                                    print('requirement is value_greater')
-                                pass
-                            elif 'value_less' in requirement:
-                                if debug:
-                                    print('requirement is value_less')
-                                pass
-                            elif 'item_count_equals' in requirement:
-                                if debug:
-                                    print('requirement is item_count_equals')
-                                #print("compared len(payload[",requirement['sysname'],'])=',len(payload[requirement['sysname']]),'= requirement[compare_value]=',requirement['compare_value'])
-                                if len(payload[requirement['sysname']]) == requirement['item_count_equals']:
-                                    result['is_validated']=True
-                            elif 'item_count_greater' in requirement:
-                                if debug:
-                                    print('requirement is item_count_greater')
-                                #print("compared len(payload[",requirement['sysname'],'])=',len(payload[requirement['sysname']]),'> requirement[compare_value]=',requirement['compare_value'])
-                                if len(payload[requirement['sysname']]) > requirement['item_count_greater']:
-                                    result['is_validated']=True
-                            elif 'item_count_less' in requirement:
-                                if debug:
-                                    print('requirement is item_count_less')
-                                #print("compared len(payload[",requirement['sysname'],'])=',len(payload[requirement['sysname']]),'< requirement[compare_value]=',requirement['compare_value'])
-                                if len(payload[requirement['sysname']]) < requirement['item_count_less']:
-                                    result['is_validated']=True
-                            else: # trivial presence in payload is checked
-                                if debug:
-                                    print('requirement is plain presence')
-                                result['is_validated'] = True
-                        
-            
-        else: # non-dictionary requirement
-            #print("non-dictionary requirement")
-            if 'value_equals' in requirement:
-                #print('value_equals')
-                if requirement['sysname'] in payload:
-                    for item in payload[requirement['sysname']]:
-                        if isinstance(item,str) and isinstance(requirement['value_equals'],str):
-                            #print('{{{{{string comparison:',requirement['sysname'],requirement['value_equals'],'}}}}}')
-                            #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                            if item.strip().lower() == requirement['value_equals'].strip().lower():
-                                result['is_validated'] = True
-                        else:
-                            print('{{{{{non-string comparison:',requirement['sysname'],'(',item,')',requirement['value_equals'],'}}}}}')
-                            if item == requirement['value_equals']:
-                                #print('{{{{{',item,'=',requirement['value_equals'],'}}}}}')
-                                result['is_validated'] = True
-            elif 'value_equals_any' in requirement:
-                #print('value_equals')
-                if requirement['sysname'] in payload:
-                    for item in payload[requirement['sysname']]:
-                        for requirement_variant in requirement['value_equals_any']:
-                            if isinstance(item,str) and isinstance(requirement_variant,str):
-                                #print('{{{{{string comparison:',requirement['sysname'],requirement['value_equals'],'}}}}}')
-                                #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                                if item.strip().lower() == requirement_variant.strip().lower():
-                                    result['is_validated'] = True
-                                    break
-                            else:
-                                print('{{{{{non-string comparison:',requirement['sysname'],'(',item,')',requirement['value_equals'],'}}}}}')
-                                if item == requirement_variant:
-                                    #print('{{{{{',item,'=',requirement['value_equals'],'}}}}}')
-                                    result['is_validated'] = True
-                                    break
-            elif 'value_absent' in requirement:
-                #print('value_absent')
-                if requirement['sysname'] not in payload:
-                    result['is_validated'] = True
-
-            elif 'value_not_equals' in requirement:
-                #print('value_equals')
-                if requirement['sysname'] in payload:
-                    for item in payload[requirement['sysname']]:
-                        if isinstance(item,str) and isinstance(requirement['value_not_equals'],str):
-                            #print('{{{{{string comparison:',requirement['sysname'],requirement['value_equals'],'}}}}}')
-                            #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                            if item.strip().lower() != requirement['value_not_equals'].strip().lower():
-                                result['is_validated'] = True
-                        else:
-                            #print('{{{{{non-string comparison:',requirement['sysname'],requirement['value_equals'],'}}}}}')
-                            if item != requirement['value_not_equals']:
-                                result['is_validated'] = True
-                else:
-                    result['is_validated'] = True
-                                
-            elif 'value_equals_payload_value' in requirement:
-                #print('value_equals_payload_value')
-                #comparing only first items
-                if '.' in requirement['value_equals_payload_value']:
-                    payload_key = requirement['value_equals_payload_value'].split('.')[0]
-                    payload_subkey = requirement['value_equals_payload_value'].split('.')[1]
-                    value_to_compare = None
-                    try:
-                        value_to_compare = payload[payload_key][0][payload_subkey]
-                    except:
-                        value_to_compare = None
-                else:
-                    value_to_compare = None
-                    try:
-                        value_to_compare = payload[requirement['value_equals_payload_value']][0]
-                    except:
-                        value_to_compare = None
-        
-                item = payload[requirement['sysname']][0]
-                if isinstance(item,str) and isinstance(value_to_compare,str):
-                    #string comparison, must be held case-insensitive and without trailing/leading whitespaces
-                    if item.strip().lower() == value_to_compare.strip().lower():
-                        result['is_validated'] = True
-                else:
-                    if item == value_to_compare:
-                        result['is_validated'] = True
-
-
-            elif 'value_greater' in requirement:
-                pass
-            elif 'value_less' in requirement:
-                pass
-            elif 'item_count_equals' in requirement:
-                if len(payload[requirement['sysname']]) == requirement['item_count_equals']:
-                    result['is_validated']=True
-            elif 'item_count_greater' in requirement:
-                #print(".compared len(payload[",requirement['sysname'],'])=',len(payload[requirement['sysname']]),'and requirement[compare_value]=',requirement['compare_value'])
-                if len(payload[requirement['sysname']]) > requirement['item_count_greater']:
-                    result['is_validated']=True
-            elif 'item_count_less' in requirement:
-                if len(payload[requirement['sysname']]) < requirement['item_count_less']:
-                    result['is_validated']=True
-            else: # trivial presence in payload is checked
-                if requirement['sysname'] in payload:
-                    result['is_validated'] = True
-
-            #print("_check atomic_requirement returns ",result)
-        if debug:
-            print('check result is ',str(result))
+            print(">",self,requirement,'check result is ',str(result))
         return result
         
     def _check_tuple_requirement(self,asset, requirement):
-        bad_result = dict()
-        bad_result['is_validated'] = False
-        bad_result['title'] = requirement['title']
-
-        for requirement_variant in requirement['sysname']:
-            mock_requirement = dict()
-            mock_requirement['sysname'] = requirement_variant
-            for key in requirement:
-                if key != 'sysname':
-                    mock_requirement[key] = requirement[key]
-            variant_result = self._check_atomic_requirement(asset, mock_requirement)
-            if variant_result['is_validated']:
-                #any variant validated means the whole tuple requirement is validated
-                return variant_result
-        
-        #false result by default
-        return bad_result
+        from nexus.routing import AnyOfRequirementPredicate
+        return AnyOfRequirementPredicate(requirement).check(asset)
 
     def _check_requirement(self, asset, requirement):
-        if isinstance(requirement['sysname'],tuple) or isinstance(requirement['sysname'],list):
-            return self._check_tuple_requirement(asset, requirement)
-        else:
-            return self._check_atomic_requirement(asset, requirement)
+        from nexus.routing import compile_requirement
+        return compile_requirement(requirement).check(asset)
 
     def _check_route_variant(self, asset, route_variant):
-        route_result = dict()
-        route_result['destination_id'] = route_variant['destination_id']
-        route_result['auto_route'] = route_variant['auto_route']
-        route_result['requirements'] = list()
-        if 'payload_modifications' in route_variant:
-            route_result['payload_modifications'] = route_variant['payload_modifications']
-        if 'asset_type_modifications' in route_variant:
-            route_result['asset_type_modifications'] = route_variant['asset_type_modifications']
-
-        total_requirements = 0
-        fulfilled_requirements = 0
-
-        for requirement in route_variant.get('requirements',list()):
-            #print("about to check requirement",requirement)
-            requirement_check_result = self._check_requirement(asset, requirement)
-            route_result['requirements'].append(requirement_check_result)
-            total_requirements+=1
-            if requirement_check_result['is_validated'] == True:
-                fulfilled_requirements+=1
-
-        if total_requirements == fulfilled_requirements:
-            route_result['is_validated'] = True
-        else:
-            route_result['is_validated'] = False
-        
-        return route_result
+        from nexus.routing import CompiledRouteVariant
+        return CompiledRouteVariant(route_variant).check(asset)
 
     def check_routing_requirements(self,asset):
+        from nexus.routing import get_compiled_routing, get_route_graph
         debug=False
         if debug:
             print("route.check_routing_requirements: checking routing requirements for asset #%i" % asset.pk)
@@ -880,10 +808,12 @@ class Route(models.Model):
                 print("no routing described in station properties, exiting")
             return result
 
-        for route in sr.properties['routing']:
+        payload = asset.payload
+        for compiled_route in get_compiled_routing(sr):
+            route = compiled_route.config
             if debug:
                 print("checking ",route)
-            route_variant = self._check_route_variant(asset, route)
+            route_variant = compiled_route.check(asset, payload)
             route_variant['auto_route'] = route.get('auto_route',False)
             route_variant['suspend_further_routing'] = route.get('suspend_further_routing',False)
 
@@ -900,7 +830,10 @@ class Route(models.Model):
                 dest_ = route['destination_id']
 
 
-            if sr.station.properties.get('force_return',False) and StationInRoute.objects.get(pk=dest_) != sr.pk:
+            #a StationInRoute never equals sr.pk, so force_return invalidates every existing destination
+            if sr.station.properties.get('force_return',False):
+                if get_route_graph().get_node(dest_) is None:
+                    raise StationInRoute.DoesNotExist("StationInRoute matching query does not exist.")
                 route_variant['is_validated'] = False
             result.append(route_variant)
         
@@ -1059,7 +992,7 @@ class Route(models.Model):
         asset.save()
         print("resulting asset type is",asset.type.pk)
 
-    def process_payload_modifications(self,route_variant, asset):
+    def process_payload_modifications(self,route_variant, asset, dry_run=False):
         "payload_modifications(list) - list of payload variables' names that should be manipulated before next station arrival<br>"
         "    +<variable_name>=[<string>|BOOL_<val>|INT_<val>|DATETIME_NOW|DATETIME_NOW_FORMATTED|ASSET_ID] means that the variable must be added<br>"
         "    -<variable_name> means that the variable must be deleted if exists<br>"
@@ -1080,298 +1013,32 @@ class Route(models.Model):
         "   var#CREATE exits if encounters existing value"
         if 'payload_modifications' not in route_variant:
             return
-        debug = False
+        #parsed once per modification list, see modifications.py
+        from nexus.modifications import get_compiled_modifications
         if asset.meta.get('debug',False):
-            debug = True
-        if debug:
             print("payload modifications start for ",asset.pk)
-        for modification in route_variant['payload_modifications']:
-            if debug:
-                print(modification)
-            if modification.startswith('+'):
-                if debug:
-                    print("modification starts with +:",modification)
-                key = modification[1:].split('=')[0]
-                if debug:
-                    print("key:",key)
-                try:
-                    value_serialized = modification.split('+'+key+'=',1)[1]
-                    if debug:
-                        print("value:",value_serialized)
-
-                    if value_serialized.startswith('#META#'):
-                        if debug:
-                            print('#META# case, looking for ',value_serialized.replace('#META#','').strip(),'in meta')
-                        if value_serialized.replace('#META#','').strip() in asset.meta:
-                            value = asset.meta[value_serialized.replace('#META#','').strip()]
-                            if debug:
-                                print('found, value = ',value)
-                        else:
-                            if debug:
-                                print('value is absent in meta, meta keys:',str(asset.meta.keys()))
-
-                    elif value_serialized.startswith('BOOL_'):
-                        if value_serialized.replace('BOOL_','').strip() in ['True','true']:
-                            value = True
-                        if value_serialized.replace('BOOL_','').strip() in ['False','false']:
-                            value = False
-                    elif value_serialized.startswith('INT_'):
-                        value = ast.literal_eval(value_serialized.replace('BOOL_','').strip())
-                    elif value_serialized == 'DATETIME_NOW':
-                        value = str(datetime.datetime.now())
-                    elif value_serialized == 'ASSET_ID':
-                        value = asset.pk
-                        if debug:
-                            print("ASSET_ID:",value)
-                    elif value_serialized == 'DATETIME_NOW_FORMATTED':
-                        value = datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')
-                    else:#str
-                        value = value_serialized
-                    
-                    if key in asset.payload:
-                        asset.payload[key].append(value)
-                    else:
-                        asset.payload[key] = [value]
-                except:
-                    continue
-            if modification.startswith('-'):
-                key = modification[1:]
-                if key not in asset.payload:
-                    continue
-                try:
-                    mf = MasterField.objects.get(sysname=key)
-                    if not mf.properties.get('field_compound',False):
-                        if mf.properties.get('is_filefield',False):
-                            for value in asset.payload[key]:
-                                file_dict = value
-                                file_path = FileStorage.objects.get(pk=int(file_dict['storage'])).path+str(asset.pk)+'/'+file_dict['uuid']
-                                #logger.debug(file_path)
-                                try:
-                                    shutil.rmtree(file_path)
-                                    #logger.debug('deleted')
-                                except:
-                                    #logger.debug('error deleting file')
-                                    pass
-
-                    else:
-                        #compound field
-                        for dictvalue in asset.payload[key]:
-                            for subkey in dictvalue:
-                                try:
-                                    sub_mf = MasterField.objects.get(sysname=subkey)
-                                    if sub_mf.properties.get('is_filefield',False):
-                                        file_dict = dictvalue[subkey]
-                                        file_path = FileStorage.objects.get(pk=int(file_dict['storage'])).path+str(asset.pk)+'/'+file_dict['uuid']
-                                        try:
-                                            shutil.rmtree(file_path)
-                                        except:
-                                            pass
-
-                                except:
-                                    pass
-
-                except:
-                    pass
-                dump = asset.payload.pop(key,None)
-                #print("done")
-                continue
-            if modification.startswith('#META_SINGULARISE#'):
-                key=modification.replace('#META_SINGULARISE#','')
-                if key not in asset.meta:
-                    continue
-                if not isinstance(asset.meta[key],list):
-                    continue
-                if len(asset.meta[key])<1:
-                    continue
-                asset.meta[key]=asset.meta[key][0]    
-                continue
-            if modification.startswith('#META_PLURALISE#'):
-                if debug:
-                    print('#META_PLURALISE#')
-                key=modification.replace('#META_PLURALISE#','')
-                if key not in asset.meta:
-                    continue
-                if isinstance(asset.meta[key],list):
-                    continue
-                asset.meta[key]=[asset.meta[key]]    
-                continue
-            if '->' in modification:
-                if debug:
-                    print('-> modification:',modification)
-                key_names = modification.split('->')
-                old_key = key_names[0]
-                new_key = key_names[1]
-                from_meta=False
-                if old_key.startswith('#META#'):
-                    old_key=old_key.replace('#META#','')
-                    from_meta=True
-                to_meta=False
-                if new_key.startswith('#META#'):
-                    new_key=new_key.replace('#META#','')
-                    to_meta=True
-                if debug:
-                    print("from_meta:",from_meta,",to_meta:",to_meta)
-                    
-                if from_meta:
-                    if old_key not in asset.meta:
-                        continue
-                else:
-                    if old_key not in asset.payload:
-                        continue
-                        
-                if '.' not in new_key:
-                    if from_meta and to_meta:
-                        asset.meta[new_key] = asset.meta.pop(old_key)
-                    elif from_meta:
-                        asset.payload[new_key] = asset.meta.pop(old_key)
-                    elif to_meta:
-                        asset.meta[new_key] = asset.payload.pop(old_key)
-                    else:
-                        asset.payload[new_key] = asset.payload.pop(old_key)
-                else:
-                    if debug:
-                        print('"." encountered in new_key:',new_key,'(modification:',modification,',old_key:',old_key,')')
-                    key_parts = new_key.split('.')
-                    new_key = key_parts[0]
-                    new_subkey = key_parts[1]
-                    if debug:
-                        print('key:',new_key,',subkey:',new_subkey)
-                    values_list=list()
-                    if from_meta:
-                        for value in asset.meta[old_key]:
-                            new_item = {}
-                            new_item[new_subkey] = value
-                            values_list.append(new_item)
-                    else:
-                        for value in asset.payload[old_key]:
-                            new_item = {}
-                            new_item[new_subkey] = value
-                            values_list.append(new_item)
-                    if debug:
-                        print('prepared values_list:',values_list)
-                    
-                    if to_meta:
-                        asset.meta[new_key] = values_list
-                    else:
-                        asset.payload[new_key] = values_list
-                    if debug:
-                        print('set',new_key,' with values_list')
-                    if from_meta:
-                        dump = asset.meta.pop(old_key,None)
-                    else:
-                        dump = asset.payload.pop(old_key,None)
-                    if debug:
-                        print('removed old_key')
-                    
-                #print("done")
-                continue
-            if '~>' in modification:
-                key_names = modification.split('#FORMAT:')[0].split('~>')
-                old_key = key_names[0]
-                new_key = key_names[1]
-                if old_key not in asset.payload:
-                    continue
-                if new_key not in asset.payload:
-                    asset.payload[new_key] = [""]
-                if len(asset.payload[new_key]) < 1:
-                    continue
-                if not isinstance(asset.payload[new_key][-1],str):
-                    continue
-
-                result_str = asset.payload[new_key][-1]
-                
-                try:
-                    str_format = modification.split('#FORMAT:')[1]
-                except:
-                    str_format = ""
-                #XNBUD VAR
-                try:
-                    username = asset.operator.username
-                except:
-                    username = ""
-
-                current_datetime = datetime.datetime.now().strftime("%d.%m.%Y %H:%M")
-
-                for item in asset.payload[old_key]:
-                    new_str = str_format
-                    new_str = new_str.replace('%U',username)
-                    new_str = new_str.replace('%D',current_datetime)
-                    new_str = new_str.replace('%VAR',str(item))
-                    new_str = new_str.replace('%X','')
-                    result_str+=new_str
-                    
-                asset.payload[new_key][-1] = result_str
-                if '%X' in str_format:
-                    dump = asset.payload.pop(old_key, None)
-                    
-                continue
-            if '+>' in modification:
-                key_names = modification.split('+>')
-                old_key = key_names[0]
-                new_key = key_names[1]
-                if '.' in old_key:
-                    key_parts = old_key.split('.')
-                    old_key = key_parts[0]
-                    old_subkey = key_parts[1]
-                else:
-                    old_subkey = None
-
-                if old_key not in asset.payload:
-                    continue
-                if not old_subkey:
-                    #non-nested value, copy whole
-                    asset.payload[new_key] = asset.payload[old_key]
-                else:
-                    #nested value, copy it
-                    values_list = list()
-                    for value in asset.payload[old_key]:
-                        values_list.append(value[old_subkey])
-
-                    asset.payload[new_key] = values_list
-                continue
-            if '#DECREASE' in modification:
-                var_name = modification.split('#')[0]
-                if var_name not in asset.payload:
-                    continue
-                modified_values = list()
-                for value in asset.payload[var_name]:
-                    if isinstance(value,int):
-                        modified_values.append(value-1)
-                    else:
-                        modified_values.append(value)
-                asset.payload[var_name] = modified_values
-                continue
-            if '#INCREASE' in modification:
-                var_name = modification.split('#')[0]
-                if var_name not in asset.payload:
-                    continue
-                modified_values = list()
-                for value in asset.payload[var_name]:
-                    if isinstance(value,int):
-                        modified_values.append(value+1)
-                    else:
-                        modified_values.append(value)
-                asset.payload[var_name] = modified_values
-
-
-                #print("done")
-                continue
-            if '#CREATE:' in modification:
-                var_name = modification.split('#')[0]
-                var_value = modification.split('#CREATE:')[1]
-                if var_name in asset.payload:
-                    continue
-
-                asset.payload[var_name] = [var_value]
+        get_compiled_modifications(route_variant['payload_modifications']).run(asset, dry_run=dry_run)
+        if not dry_run:
+            asset.save()
 
 
-                #print("done")
-                continue
-        asset.save()
+    def route_asset(self,asset,destination_id=None,suspend_further_routing=False):
+        #a step of routing scheduler, returns None if called while routing is in progress
+        from nexus.routing import schedule_routing_step
+        result = schedule_routing_step(self._route_asset,asset,destination_id=destination_id,suspend_further_routing=suspend_further_routing)
+        if result and result.get('status') == 200:
+            #auto routing may have moved the asset further
+            result['station_id'] = asset.stationinroute.station.pk
+        return result
 
+    def _route_asset(self,asset,destination_id=None,suspend_further_routing=False):
+        from nexus.routing import deferred_asset_saves
+        with deferred_asset_saves(asset):
+            return self._route_asset_step(asset,destination_id,suspend_further_routing)
 
-    def route_asset(self,asset,destination_id=None,suspend_further_routing=False):
+    def _route_asset_step(self,asset,destination_id=None,suspend_further_routing=False):
         #print(">route.route_asset: routing asset #",asset.pk,"to destination_id=",destination_id)
+        from nexus.routing import register_routing_hop, schedule_routing_step, RoutingLimitExceeded
         debug=False
         if asset.meta.get('debug',False):
             debug = True
@@ -1419,6 +1086,14 @@ class Route(models.Model):
                         #print("route leads to target destination",str(destination_id))
                         next_sr = StationInRoute.objects.get(pk=item['destination_id'])
                         asset.stationinroute = next_sr
+                        if sr != next_sr:
+                            try:
+                                register_routing_hop(asset)
+                            except RoutingLimitExceeded as e:
+                                print('route_asset: routing stopped,',e)
+                                asset.stationinroute = sr
+                                result['message'] = str(e)
+                                return result
                         asset.save()
 
                         self.process_payload_modifications(item, asset)
@@ -1470,7 +1145,8 @@ class Route(models.Model):
                             if debug:
                                 print('--- route_asset calls process_notifications')
                           
-                            self.process_notifications(record,debug=debug)
+                            #queued after the assign step, so notifications see the asset after assign/perform/auto routing like before
+                            schedule_routing_step(self.process_notifications,record,debug=debug)
 
 
 
@@ -1502,6 +1178,14 @@ class Route(models.Model):
 
                     next_sr = StationInRoute.objects.get(pk=dest_)
                     asset.stationinroute = next_sr
+                    if sr != next_sr:
+                        try:
+                            register_routing_hop(asset)
+                        except RoutingLimitExceeded as e:
+                            print('route_asset: routing stopped,',e)
+                            asset.stationinroute = sr
+                            result['message'] = str(e)
+                            return result
                     asset.save()
 
                     self.process_payload_modifications(item, asset)
@@ -1550,7 +1234,8 @@ class Route(models.Model):
                         if debug:
                             print('--- route_asset calls process_notifications')
 
-                        self.process_notifications(record)
+                        #queued after the assign step, so notifications see the asset after assign/perform/auto routing like before
+                        schedule_routing_step(self.process_notifications,record)
 
                     #next_sr.station.assign_asset(asset)
                     result['status'] = 200
@@ -1570,73 +1255,57 @@ class Route(models.Model):
 
     def rewind_asset(self,asset):
         print("route.rewind_asset: routing asset #%i" % asset.pk)
+        from nexus.routing import get_route_graph
         if hasattr(self,'route_stations'):
-            for route_station in self.route_stations.all():
-                if route_station == asset.stationinroute:
-                    if route_station.can_route_back:
-                        try:
-                            sr=asset.stationinroute
-                            last_record = RouteRecord.objects.filter(route=self).filter(asset=asset).filter(is_a_rewind=False).order_by('-record_datetime')[1]
-                            last_record.station.assign_asset(asset,last_record.operator)
+            node = get_route_graph().get_node(asset.stationinroute_id)
+            if node is not None and node.route_id == self.pk:
+                if node.can_route_back:
+                    try:
+                        sr=asset.stationinroute
+                        last_record = RouteRecord.objects.filter(route=self).filter(asset=asset).filter(is_a_rewind=False).order_by('-record_datetime')[1]
+                        last_record.station.assign_asset(asset,last_record.operator)
 
-                            next_sr = asset.stationinroute
-                            record = RouteRecord()
-                            record.route = self
-                            record.stationinroute = sr
-                            record.next_stationinroute = next_sr
-                            record.asset = asset
+                        next_sr = asset.stationinroute
+                        record = RouteRecord()
+                        record.route = self
+                        record.stationinroute = sr
+                        record.next_stationinroute = next_sr
+                        record.asset = asset
 
-                            if sr.station.classname=='Station': #human-operated station, put operator in record
-                                if not asset.operator:
-                                    if sr.station.properties.get('creator_operator',False) or (sr.properties.get('allow_adding_assets',False) and sr.station.properties.get('non_operator_adding_assets',False)):
-                                        try:
-                                            record.operator = User.objects.get(pk=asset.meta['creator'])
-                                        except:
-                                            record.operator = None
-                                    else:
+                        if sr.station.classname=='Station': #human-operated station, put operator in record
+                            if not asset.operator:
+                                if sr.station.properties.get('creator_operator',False) or (sr.properties.get('allow_adding_assets',False) and sr.station.properties.get('non_operator_adding_assets',False)):
+                                    try:
+                                        record.operator = User.objects.get(pk=asset.meta['creator'])
+                                    except:
                                         record.operator = None
                                 else:
-                                    record.operator = asset.operator
+                                    record.operator = None
                             else:
-                                record.operator = None
+                                record.operator = asset.operator
+                        else:
+                            record.operator = None
 
-                            record.is_a_rewind = True
-                            record.save()
-                            return True
-                        except:
-                            return False
-                    else:
+                        record.is_a_rewind = True
+                        record.save()
+                        return True
+                    except:
                         return False
+                else:
+                    return False
 
             return False
         else:
             return False
 
     def get_stations_list(self):
-        stations = list()
-        route = self
-
-        try:
-            #station = route.route_stations.all().filter(next_station_in_route=None)[0]
-
-
-            station = route.route_stations.filter(previous_station__isnull=True).filter(properties__allow_adding_assets=True).first()
-        except:
-            station = None
-
-        while station:
-            #prevent route from adopting stations from other routes - this can happen if route station leads to some other route's station
-            if station.route != route:
-                break
-            #stations.insert(0,station)
-            stations.append(station)
-            try:
-                #station = station.previous_station.all()[0]
-                station = station.next_station_in_route
-            except:
-                station = None
-
-        return stations
+        #stationinroutes along next_station_in_route, the chain is taken from the route graph (see routing.py)
+        from nexus.routing import get_route_graph
+        chain = get_route_graph().get_stations_chain(self.pk)
+        if len(chain) == 0:
+            return list()
+        stationinroutes = StationInRoute.objects.in_bulk(chain)
+        return [stationinroutes[pk] for pk in chain if pk in stationinroutes]
 
     def __str__(self):
         return "" + self.route_name
@@ -1700,6 +1369,65 @@ class StationInRoute(models.Model):
     def __str__(self):
         return "" + self.route.route_name + ", " + self.station.station_name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(StationInRoute, cls).from_db(db, field_names, values)
+        instance._saved_routing = instance._get_routing_state()
+        return instance
+
+    def _get_routing_state(self):
+        try:
+            return json.dumps((self.properties or dict()).get('routing', None), sort_keys=True, default=str)
+        except:
+            return None
+
+    def validate_routing_config(self):
+        """
+            compiles routing the way Route.check_routing_requirements uses it; raises ValidationError
+            for broken items, returns warnings (payload_modifications items skipped at runtime, they
+            don't block saving) and keeps them in routing_warnings for admin and API views to show
+        """
+        from django.core.exceptions import ValidationError
+        from nexus.routing import validate_routing
+        errors, warnings = validate_routing(self.properties)
+        self.routing_warnings = warnings
+        if len(errors) > 0:
+            raise ValidationError({'properties':errors})
+        return warnings
+
+    def clean(self):
+        self.validate_routing_config()
+
+    def save(self, *args, **kwargs):
+        #every path saving changed routing (admin, API, code) validates it; unchanged routing isn't checked again
+        if self._state.adding or getattr(self, '_saved_routing', None) != self._get_routing_state():
+            self.validate_routing_config()
+        super(StationInRoute, self).save(*args, **kwargs)
+        self._saved_routing = self._get_routing_state()
+
+@receiver(models.signals.post_save, sender=StationInRoute)
+def permission_stationinroute_update(sender, instance, **kwargs):
+    #compiled rules copy station/route of every stationinroute
+    from nexus.permissions import invalidate_rule_index, invalidate_access_stationinroute
+    invalidate_rule_index()
+    invalidate_access_stationinroute(instance.pk)
+
+@receiver(models.signals.post_save, sender=StationInRoute)
+@receiver(models.signals.post_delete, sender=StationInRoute)
+def routing_requirements_update(sender, instance, **kwargs):
+    #compiled routing requirements are cached per stationinroute, see routing.get_compiled_routing
+    from nexus.routing import invalidate_routing
+    invalidate_routing(instance)
+
+@receiver(models.signals.post_save)
+@receiver(models.signals.post_delete)
+def route_graph_update(sender, instance, **kwargs):
+    #route graph holds links, routing edges and force_return of stations, see routing.get_route_graph
+    if not isinstance(instance, (StationInRoute, Station, Route)):
+        return
+    from nexus.routing import invalidate_route_graph
+    invalidate_route_graph()
+
 class RouteRecord(models.Model):
     route = models.ForeignKey('Route',related_name='+',on_delete=models.CASCADE)
     stationinroute = models.ForeignKey('StationInRoute',related_name='+',on_delete=models.CASCADE)
@@ -1785,9 +1513,10 @@ class Station(models.Model):
 
 
 
-    def flush(self):
-        for asset in Asset.objects.filter(stationinroute__station=self):
-            self.perform(asset)
+    def flush(self,processes=1,chunk_size=None,verbose=True):
+        #perform for every asset of the station in chunks, see flush.py
+        from nexus.flush import flush_assets, FLUSH_CHUNK_SIZE
+        return flush_assets('station',self,processes=processes,chunk_size=chunk_size or FLUSH_CHUNK_SIZE,verbose=verbose)
     
     def get_field_templates(self, asset_type_sysname,asset_payload=None):
         field_templates = dict()
@@ -1844,6 +1573,12 @@ class Station(models.Model):
                 return field_templates
 
     def assign_asset(self,asset,rewind_to_operator=None,suspend_further_routing=False):
+        #a step of routing scheduler, queued if called while routing is in progress
+        from nexus.routing import schedule_routing_step
+        schedule_routing_step(self._assign_asset,asset,rewind_to_operator=rewind_to_operator,suspend_further_routing=suspend_further_routing)
+
+    def _assign_asset(self,asset,rewind_to_operator=None,suspend_further_routing=False):
+        from nexus.routing import deferred_asset_saves
         debug=False
         if asset.meta.get('debug',False):
             debug=True
@@ -1992,22 +1727,24 @@ class Station(models.Model):
                     asset.operator = None
 
 
-        asset.save()
-        asset_history_record = dict()
-        asset_history_record['datetime'] = str(datetime.datetime.now())
-        asset_history_record['action'] = 'ASSIGN'
-        if asset.operator:
-            asset_history_record['operator'] = asset.operator.pk
-        else:
-            asset_history_record['operator'] = 0
+        #operator and history are written with a single save
+        with deferred_asset_saves(asset):
+            asset.save()
+            asset_history_record = dict()
+            asset_history_record['datetime'] = str(datetime.datetime.now())
+            asset_history_record['action'] = 'ASSIGN'
+            if asset.operator:
+                asset_history_record['operator'] = asset.operator.pk
+            else:
+                asset_history_record['operator'] = 0
 
-        asset_history_record['stationinroute'] = self.pk
+            asset_history_record['stationinroute'] = self.pk
 
-        if 'history' not in asset.meta:
-            asset.meta['history'] = list()
-        asset.meta['history'].append(asset_history_record)
+            if 'history' not in asset.meta:
+                asset.meta['history'] = list()
+            asset.meta['history'].append(asset_history_record)
 
-        asset.save()
+            asset.save()
         
         if asset.operator and self.properties.get('notify_operator',False):
     
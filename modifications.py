@@ -0,0 +1,534 @@
+#=====================================================================
+# compiled payload modifications
+#
+# payload_modifications list of a routing variant is parsed once into operations,
+# compiled lists are cached per process by their content (see get_compiled_modifications).
+# Semantics are those of the former parsing loop of Route.process_payload_modifications,
+# including that a '+' modification which succeeded is checked for '->', '~>', '+>',
+# '#DECREASE', '#INCREASE' and '#CREATE:' too.
+# MasterField and FileStorage lookups of '-' modifications are resolved in bulk
+# before the operations run.
+#=====================================================================
+
+import ast
+import copy
+import shutil
+import datetime
+import threading
+from collections import OrderedDict
+
+MODIFICATIONS_CACHE_SIZE = 2000 #distinct modification lists kept compiled
+#INT_ values never parsed in the former loop (it stripped 'BOOL_'), so those items were skipped;
+#live routing keeps skipping them unless this setting is True
+PARSE_INT_SETTING = 'NEXUS_PARSE_INT_MODIFICATIONS'
+
+
+class PayloadOperation:
+    name = None
+
+    def __init__(self, modification):
+        self.modification = modification
+        self.errors = list()
+
+    def apply(self, asset, context):
+        #returns False if the modification was skipped
+        raise NotImplementedError
+
+    def __str__(self):
+        return "%s %s" % (self.name, self.modification)
+
+
+class AddValueOperation(PayloadOperation):
+    """
+        +key=value appends value to the payload list of key
+    """
+    name = 'add'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        self.then = None #operation of the same modification that runs after a successful add
+        self.key = modification[1:].split('=')[0]
+        self.kind = None
+        self.value = None
+        if '=' not in modification:
+            self.errors.append("'=' is missing")
+            return
+        value_serialized = modification.split('+'+self.key+'=',1)[1]
+        if value_serialized.startswith('#META#'):
+            self.kind = 'meta'
+            self.value = value_serialized.replace('#META#','').strip()
+        elif value_serialized.startswith('BOOL_'):
+            value = value_serialized.replace('BOOL_','').strip()
+            if value in ['True','true']:
+                self.kind, self.value = 'constant', True
+            elif value in ['False','false']:
+                self.kind, self.value = 'constant', False
+            else:
+                self.errors.append("BOOL_ value must be True or False")
+        elif value_serialized.startswith('INT_'):
+            from django.conf import settings
+            if not getattr(settings, PARSE_INT_SETTING, False):
+                self.errors.append("INT_ values are skipped, set %s to add them" % PARSE_INT_SETTING)
+                return
+            try:
+                self.kind, self.value = 'constant', ast.literal_eval(value_serialized.replace('INT_','').strip())
+            except Exception as e:
+                self.errors.append("INT_ value can't be parsed: %s" % e)
+        elif value_serialized in ['DATETIME_NOW','ASSET_ID','DATETIME_NOW_FORMATTED']:
+            self.kind = value_serialized
+        else:
+            self.kind, self.value = 'constant', value_serialized
+
+    def get_value(self, asset):
+        #raises KeyError if there's nothing to add
+        if self.kind == 'meta':
+            return asset.meta[self.value]
+        if self.kind == 'DATETIME_NOW':
+            return str(datetime.datetime.now())
+        if self.kind == 'ASSET_ID':
+            return asset.pk
+        if self.kind == 'DATETIME_NOW_FORMATTED':
+            return datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+        if isinstance(self.value, (list, dict, set)):
+            return copy.deepcopy(self.value)
+        return self.value
+
+    def apply(self, asset, context):
+        if self.kind is None:
+            return False
+        try:
+            value = self.get_value(asset)
+            if self.key in asset.payload:
+                asset.payload[self.key].append(value)
+            else:
+                asset.payload[self.key] = [value]
+        except:
+            if context.debug:
+                print("skipped:", self.modification)
+            return False
+        if self.then is not None:
+            self.then.apply(asset, context)
+        return True
+
+
+class DeleteOperation(PayloadOperation):
+    """
+        -key removes key from the payload, files of file fields are deleted from storage
+    """
+    name = 'delete'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        self.key = modification[1:]
+        if self.key == '':
+            self.errors.append("variable name is missing")
+
+    def delete_files(self, asset, context):
+        master_field = context.get_master_field(self.key)
+        if master_field is None:
+            return
+        try:
+            if not master_field.get('field_compound',False):
+                if master_field.get('is_filefield',False):
+                    for file_dict in asset.payload[self.key]:
+                        context.delete_file(file_dict)
+            else:
+                for dictvalue in asset.payload[self.key]:
+                    for subkey in dictvalue:
+                        try:
+                            sub_master_field = context.get_master_field(subkey)
+                            if sub_master_field is not None and sub_master_field.get('is_filefield',False):
+                                context.delete_file(dictvalue[subkey])
+                        except:
+                            pass
+        except:
+            pass
+
+    def apply(self, asset, context):
+        if self.key not in asset.payload:
+            return False
+        if not context.dry_run:
+            self.delete_files(asset, context)
+        asset.payload.pop(self.key, None)
+        return True
+
+
+class MetaSingulariseOperation(PayloadOperation):
+    name = 'meta_singularise'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        self.key = modification.replace('#META_SINGULARISE#','')
+
+    def apply(self, asset, context):
+        value = asset.meta.get(self.key, None)
+        if not isinstance(value, list) or len(value) < 1:
+            return False
+        asset.meta[self.key] = value[0]
+        return True
+
+
+class MetaPluraliseOperation(PayloadOperation):
+    name = 'meta_pluralise'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        self.key = modification.replace('#META_PLURALISE#','')
+
+    def apply(self, asset, context):
+        if self.key not in asset.meta or isinstance(asset.meta[self.key], list):
+            return False
+        asset.meta[self.key] = [asset.meta[self.key]]
+        return True
+
+
+class MoveOperation(PayloadOperation):
+    """
+        old->new renames a variable, #META# prefix on either side means meta;
+        old->new.subkey moves every value into a dict under subkey
+    """
+    name = 'move'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        key_names = modification.split('->')
+        self.old_key = key_names[0]
+        self.new_key = key_names[1]
+        self.from_meta = False
+        if self.old_key.startswith('#META#'):
+            self.old_key = self.old_key.replace('#META#','')
+            self.from_meta = True
+        self.to_meta = False
+        if self.new_key.startswith('#META#'):
+            self.new_key = self.new_key.replace('#META#','')
+            self.to_meta = True
+        self.new_subkey = None
+        if '.' in self.new_key:
+            key_parts = self.new_key.split('.')
+            self.new_key = key_parts[0]
+            self.new_subkey = key_parts[1]
+        if self.old_key == '' or self.new_key == '':
+            self.errors.append("variable name is missing")
+
+    def apply(self, asset, context):
+        source = asset.meta if self.from_meta else asset.payload
+        target = asset.meta if self.to_meta else asset.payload
+        if self.old_key not in source:
+            return False
+        if self.new_subkey is None:
+            target[self.new_key] = source.pop(self.old_key)
+        else:
+            target[self.new_key] = [{self.new_subkey:value} for value in source[self.old_key]]
+            source.pop(self.old_key, None)
+        return True
+
+
+class AppendTextOperation(PayloadOperation):
+    """
+        old~>new#FORMAT:... appends every value of old to the last value of new as formatted text
+    """
+    name = 'append_text'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        key_names = modification.split('#FORMAT:')[0].split('~>')
+        self.old_key = key_names[0]
+        self.new_key = key_names[1]
+        parts = modification.split('#FORMAT:')
+        self.str_format = parts[1] if len(parts) > 1 else ""
+        if self.old_key == '' or self.new_key == '':
+            self.errors.append("variable name is missing")
+
+    def apply(self, asset, context):
+        if self.old_key not in asset.payload:
+            return False
+        if self.new_key not in asset.payload:
+            asset.payload[self.new_key] = [""]
+        if len(asset.payload[self.new_key]) < 1:
+            return False
+        if not isinstance(asset.payload[self.new_key][-1], str):
+            return False
+
+        str_format = self.str_format
+        if '%U' in str_format:
+            try:
+                username = asset.operator.username
+            except:
+                username = ""
+            str_format = str_format.replace('%U', username)
+        if '%D' in str_format:
+            str_format = str_format.replace('%D', datetime.datetime.now().strftime("%d.%m.%Y %H:%M"))
+
+        result_str = asset.payload[self.new_key][-1]
+        for item in asset.payload[self.old_key]:
+            result_str += str_format.replace('%VAR',str(item)).replace('%X','')
+        asset.payload[self.new_key][-1] = result_str
+        if '%X' in self.str_format:
+            asset.payload.pop(self.old_key, None)
+        return True
+
+
+class CopyOperation(PayloadOperation):
+    """
+        old+>new copies a variable, old.subkey+>new copies subkey of every value
+    """
+    name = 'copy'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        key_names = modification.split('+>')
+        self.old_key = key_names[0]
+        self.new_key = key_names[1]
+        self.old_subkey = None
+        if '.' in self.old_key:
+            key_parts = self.old_key.split('.')
+            self.old_key = key_parts[0]
+            self.old_subkey = key_parts[1]
+        if self.old_key == '' or self.new_key == '':
+            self.errors.append("variable name is missing")
+
+    def apply(self, asset, context):
+        if self.old_key not in asset.payload:
+            return False
+        if not self.old_subkey:
+            #non-nested value, the list is shared like it always was
+            asset.payload[self.new_key] = asset.payload[self.old_key]
+        else:
+            asset.payload[self.new_key] = [value[self.old_subkey] for value in asset.payload[self.old_key]]
+        return True
+
+
+class ChangeNumberOperation(PayloadOperation):
+    """
+        var#INCREASE, var#DECREASE
+    """
+    def __init__(self, modification, delta):
+        super().__init__(modification)
+        self.name = 'increase' if delta > 0 else 'decrease'
+        self.delta = delta
+        self.key = modification.split('#')[0]
+        if self.key == '':
+            self.errors.append("variable name is missing")
+
+    def apply(self, asset, context):
+        if self.key not in asset.payload:
+            return False
+        asset.payload[self.key] = [value+self.delta if isinstance(value, int) else value for value in asset.payload[self.key]]
+        return True
+
+
+class CreateOperation(PayloadOperation):
+    """
+        var#CREATE:value creates var unless it exists
+    """
+    name = 'create'
+
+    def __init__(self, modification):
+        super().__init__(modification)
+        self.key = modification.split('#')[0]
+        self.value = modification.split('#CREATE:')[1]
+        if self.key == '':
+            self.errors.append("variable name is missing")
+
+    def apply(self, asset, context):
+        if self.key in asset.payload:
+            return False
+        asset.payload[self.key] = [self.value]
+        return True
+
+
+def delete_file_paths(file_paths):
+    for file_path in file_paths:
+        try:
+            shutil.rmtree(file_path)
+        except:
+            pass
+
+
+def _compile_infix_modification(modification):
+    #checks that follow a '+' modification as well, in the order of the former loop
+    if '->' in modification:
+        return MoveOperation(modification)
+    if '~>' in modification:
+        return AppendTextOperation(modification)
+    if '+>' in modification:
+        return CopyOperation(modification)
+    if '#DECREASE' in modification:
+        return ChangeNumberOperation(modification, -1)
+    if '#INCREASE' in modification:
+        return ChangeNumberOperation(modification, 1)
+    if '#CREATE:' in modification:
+        return CreateOperation(modification)
+    return None
+
+
+def compile_modification(modification):
+    #operation of a single payload_modifications item, None if the item does nothing
+    if modification.startswith('+'):
+        operation = AddValueOperation(modification)
+        operation.then = _compile_infix_modification(modification)
+        return operation
+    if modification.startswith('-'):
+        return DeleteOperation(modification)
+    if modification.startswith('#META_SINGULARISE#'):
+        return MetaSingulariseOperation(modification)
+    if modification.startswith('#META_PLURALISE#'):
+        return MetaPluraliseOperation(modification)
+    return _compile_infix_modification(modification)
+
+
+class ModificationContext:
+    """
+        state of one run over an asset: MasterField properties (sysname -> properties or None)
+        and FileStorage paths, loaded in bulk
+    """
+    def __init__(self, asset, dry_run=False):
+        self.asset = asset
+        self.dry_run = dry_run
+        self.debug = bool((asset.meta or dict()).get('debug',False))
+        self.master_fields = dict()
+        self.storage_paths = dict()
+        #list that collects file paths instead of deleting them right away, see bulk_modifications
+        self.deferred_files = None
+
+    def load_master_fields(self, sysnames):
+        from nexus.models import MasterField
+        sysnames = set(sysname for sysname in sysnames if isinstance(sysname, str) and sysname not in self.master_fields)
+        if len(sysnames) == 0:
+            return
+        found = dict()
+        for sysname, properties in MasterField.objects.filter(sysname__in=sysnames).values_list('sysname','properties'):
+            #sysname is expected to be unique, duplicates were skipped by MasterField.objects.get
+            found[sysname] = None if sysname in found else (properties or dict())
+        for sysname in sysnames:
+            self.master_fields[sysname] = found.get(sysname, None)
+
+    def load_storage_paths(self, storage_ids):
+        from nexus.models import FileStorage
+        storage_ids = set(storage_ids)-set(self.storage_paths.keys())
+        if len(storage_ids) == 0:
+            return
+        self.storage_paths.update(FileStorage.objects.filter(pk__in=storage_ids).values_list('pk','path'))
+
+    def get_master_field(self, sysname):
+        if sysname not in self.master_fields:
+            self.load_master_fields([sysname])
+        return self.master_fields.get(sysname, None)
+
+    def get_storage_path(self, storage_id):
+        #raises KeyError for unknown storages
+        storage_id = int(storage_id)
+        if storage_id not in self.storage_paths:
+            self.load_storage_paths([storage_id])
+        return self.storage_paths[storage_id]
+
+    def delete_file(self, file_dict):
+        file_path = self.get_storage_path(file_dict['storage'])+str(self.asset.pk)+'/'+file_dict['uuid']
+        if self.deferred_files is not None:
+            self.deferred_files.append(file_path)
+            return
+        delete_file_paths([file_path])
+
+    def prefetch(self, keys):
+        #master fields of keys about to be deleted, of subkeys of their compound values and storages of their files
+        payload = self.asset.payload
+        keys = [key for key in keys if key in payload]
+        if len(keys) == 0:
+            return
+        self.load_master_fields(keys)
+        file_values = list()
+        subkeys = set()
+        for key in keys:
+            master_field = self.master_fields.get(key)
+            if master_field is None or not isinstance(payload[key], list):
+                continue
+            if master_field.get('field_compound',False):
+                for dictvalue in payload[key]:
+                    if isinstance(dictvalue, dict):
+                        subkeys.update(dictvalue.keys())
+            elif master_field.get('is_filefield',False):
+                file_values += payload[key]
+        self.load_master_fields(subkeys)
+        for key in keys:
+            master_field = self.master_fields.get(key)
+            if master_field is None or not master_field.get('field_compound',False) or not isinstance(payload[key], list):
+                continue
+            for dictvalue in payload[key]:
+                if isinstance(dictvalue, dict):
+                    for subkey, value in dictvalue.items():
+                        sub_master_field = self.master_fields.get(subkey)
+                        if sub_master_field is not None and sub_master_field.get('is_filefield',False):
+                            file_values.append(value)
+        storage_ids = set()
+        for file_dict in file_values:
+            try:
+                storage_ids.add(int(file_dict['storage']))
+            except:
+                pass
+        self.load_storage_paths(storage_ids)
+
+
+class CompiledModifications:
+    """
+        compiled payload_modifications list; errors are the problems found while compiling,
+        broken items are skipped at runtime
+    """
+    def __init__(self, modifications):
+        self.modifications = modifications
+        self.operations = list()
+        self.errors = list()
+        if not isinstance(modifications, (list, tuple)):
+            self.errors.append("payload_modifications must be a list")
+            return
+        for index, modification in enumerate(modifications):
+            if not isinstance(modification, str):
+                self.errors.append("payload_modifications[%d] %r: must be a string" % (index, modification))
+                continue
+            operation = compile_modification(modification)
+            if operation is None:
+                self.errors.append("payload_modifications[%d] %r: unknown modification" % (index, modification))
+                continue
+            for error in operation.errors:
+                self.errors.append("payload_modifications[%d] %r: %s" % (index, modification, error))
+            self.operations.append(operation)
+        self.delete_keys = [operation.key for operation in self.operations if isinstance(operation, DeleteOperation)]
+
+    def run(self, asset, dry_run=False):
+        #dry_run keeps files of deleted variables
+        context = ModificationContext(asset, dry_run)
+        if not dry_run and len(self.delete_keys) > 0:
+            context.prefetch(self.delete_keys)
+        for operation in self.operations:
+            if context.debug:
+                print(operation)
+            operation.apply(asset, context)
+        return context
+
+
+_compiled_modifications = OrderedDict() #tuple of modifications -> CompiledModifications
+_compiled_modifications_lock = threading.Lock()
+
+
+def get_compiled_modifications(modifications):
+    """
+        compiled payload_modifications list, cached per process by its content
+        so every routing variant with the same list shares it
+    """
+    if not isinstance(modifications, (list, tuple)):
+        return CompiledModifications(modifications)
+    try:
+        key = tuple(modifications)
+        hash(key)
+    except TypeError:
+        return CompiledModifications(modifications)
+    with _compiled_modifications_lock:
+        compiled = _compiled_modifications.get(key, None)
+        if compiled is not None:
+            _compiled_modifications.move_to_end(key)
+            return compiled
+    compiled = CompiledModifications(modifications)
+    with _compiled_modifications_lock:
+        _compiled_modifications[key] = compiled
+        while len(_compiled_modifications) > MODIFICATIONS_CACHE_SIZE:
+            _compiled_modifications.popitem(last=False)
+    return compiled
@@ -0,0 +1,118 @@
+#=====================================================================
+# process pool helpers for management commands that go through the whole repository.
+# Workers are forked, so whatever the parent loaded before the pool was created (rule index,
+# snapshots kept in module globals) is shared with them without pickling. Database connections
+# are closed before forking, every worker opens its own.
+#=====================================================================
+
+import os
+import time
+import multiprocessing
+from collections import deque
+from django.db import connections
+
+DEFAULT_WINDOW_PER_PROCESS = 2 #chunks in flight per worker, bounds memory of pending input and results
+
+
+def close_db_connections():
+    #a connection inherited by a forked process shares the socket with its parent
+    for connection in connections.all():
+        try:
+            connection.close()
+        except Exception as e:
+            print("parallel: failed to close connection", connection.alias, e)
+
+
+def _init_worker(initializer, initargs):
+    #connections copied from the parent are already closed, make sure they're not reused
+    for connection in connections.all():
+        connection.connection = None
+    if initializer:
+        initializer(*initargs)
+
+
+def get_pool_context():
+    #fork keeps parent's module state; where fork isn't available chunks are processed inline
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+
+def run_chunks(func, chunks, processes=None, window=None, initializer=None, initargs=()):
+    """
+        calls func(chunk) for every item of chunks and yields (chunk, result, seconds) in input order.
+        chunks may be a generator (e.g. reading a queryset), it is consumed only as workers get free,
+        so at most window chunks are pending at a time. processes=1 runs everything in this process.
+        Exceptions of func are yielded as result, one failed chunk doesn't stop the others.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    context = get_pool_context() if processes > 1 else None
+
+    if context is None:
+        if initializer:
+            initializer(*initargs)
+        for chunk in chunks:
+            start = time.time()
+            try:
+                result = func(chunk)
+            except Exception as e:
+                result = e
+            yield chunk, result, time.time()-start
+        return
+
+    if window is None:
+        window = processes*DEFAULT_WINDOW_PER_PROCESS
+    close_db_connections()
+    pool = context.Pool(processes, initializer=_init_worker, initargs=(initializer, initargs))
+    pending = deque()
+    try:
+        chunks = iter(chunks)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((chunk, pool.apply_async(_timed_call, (func, chunk))))
+            if len(pending) == 0:
+                break
+            chunk, async_result = pending.popleft()
+            try:
+                result, seconds = async_result.get()
+            except Exception as e:
+                result, seconds = e, 0
+            yield chunk, result, seconds
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _timed_call(func, chunk):
+    start = time.time()
+    try:
+        result = func(chunk)
+    except Exception as e:
+        #exception is sent back to the parent, traceback is printed by the worker
+        import traceback
+        traceback.print_exc()
+        result = e
+    return result, time.time()-start
+
+
+def iterate_chunks(iterable, chunk_size):
+    #lists of up to chunk_size items
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
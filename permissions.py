@@ -1,66 +1,236 @@
+import copy
+import time
+import atexit
+import json
+import uuid
+import hashlib
 import ipaddress
+import threading
+from collections import OrderedDict
+from bisect import bisect_right
+from asgiref.sync import sync_to_async
 from django.db.models import Q
-from django.contrib.auth.models import User,AnonymousUser
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.dispatch import receiver
+from django.contrib.auth.models import User,Group,AnonymousUser
+from django.utils.functional import LazyObject, empty
 from dateutil.relativedelta import relativedelta
 from datetime import datetime
 
-def get_user_info(user,asset,stationinroute,station):
-    is_creator = False
-    is_operator = False
-    is_supervisor = False
-    is_authenticated_user = False
-    ip_address = None
+USER_CONTEXT_MAX_AGE = 60 #seconds a context is reused outside of requests (management commands, threads, workers)
 
-    if user: 
-        is_authenticated_user = user.is_authenticated
+_request_state = threading.local()
 
-        if hasattr(user,'ip_address'):
-            ip_address = user.ip_address
 
-        if asset:
-            if 'creator' in asset.meta:
-                try:
-                    operator = User.objects.get(pk=asset.meta['creator'])
-                    if user == operator:
-                        is_creator = True
-                except:
-                    pass
-            if 'creator_str' in asset.meta:
-                try:
-                    operator = User.objects.get(pk=int(asset.meta['creator_str']))
-                    if user == operator:
-                        is_creator = True
-                except:
-                    pass
-            if 'publication_creators' in asset.meta:
-                for cr in asset.meta['publication_creators']:
-                    if cr['pk'] == user.pk:
-                        is_creator = True
-
-            if asset.stationinroute:
-                if user in asset.stationinroute.station.operators.all():
-                    is_operator = True
-                if user in asset.stationinroute.station.supervisors.all():
-                    is_supervisor = True
+@receiver(request_started)
+def start_permission_request(sender, **kwargs):
+    #contexts kept on user objects are not reused by the next request of the thread
+    _request_state.generation = getattr(_request_state, 'generation', 0)+1
 
 
-        if stationinroute:
-            if user in stationinroute.station.operators.all():
-                is_operator = True
-            if user in stationinroute.station.supervisors.all():
-                is_supervisor = True
+class UserPermissionContext:
+    """
+        user's groups and station/route roles, loaded once and reused by every permission
+        check and serializer within a request; get_user_permission_context keeps it on the user object
+        while is_current
+    """
+    def __init__(self, user):
+        self.source = user
+        self.generation = getattr(_request_state, 'generation', 0)
+        self.created = time.time()
+        self.index_version = _rule_index.version if _rule_index else None
+        #anonymous users are treated as no user by permission rules
+        self.user = None if (not user or isinstance(user,AnonymousUser)) else user
+        self.user_id = self.user.pk if self.user else None
+        self.is_authenticated_user = bool(user.is_authenticated) if user else False
+        self._group_ids = None
+        self._operated_station_ids = None
+        self._supervised_station_ids = None
+        self._supervised_route_ids = None
+        self._ip_address = None
+        self._ip_address_given = False
+
+    def is_current(self):
+        #roles and memberships may change while the user object lives on
+        if self.generation != getattr(_request_state, 'generation', 0):
+            return False
+        if time.time()-self.created > USER_CONTEXT_MAX_AGE:
+            return False
+        index = _rule_index
+        if index is not None and index.version != self.index_version:
+            if self.index_version is not None:
+                return False
+            #created before the first check of the process loaded the index
+            self.index_version = index.version
+        return True
+
+    @property
+    def ip_address(self):
+        #set on the user by views, may be assigned after the context is created
+        if self._ip_address_given:
+            return self._ip_address
+        return getattr(self.source, 'ip_address', None)
+
+    def with_ip_address(self, ip_address):
+        #same roles seen from ip_address; the user object is shared by the whole request, so it isn't changed
+        context = copy.copy(self)
+        context._ip_address = ip_address
+        context._ip_address_given = True
+        return context
 
+    @property
+    def group_ids(self):
+        #only groups referenced by permissions, membership in the rest doesn't change any check
+        if self._group_ids is None:
+            self._group_ids = frozenset()
+            if self.user:
+                self._group_ids = get_user_group_ids(self.user_id) & get_rule_index().group_ids
+        return self._group_ids
+
+    @property
+    def operated_station_ids(self):
+        if self._operated_station_ids is None:
+            self._operated_station_ids = frozenset()
+            if self.user:
+                self._operated_station_ids = frozenset(self.user.nexus_stations.values_list('id',flat=True))
+        return self._operated_station_ids
+
+    @property
+    def supervised_station_ids(self):
+        if self._supervised_station_ids is None:
+            self._supervised_station_ids = frozenset()
+            if self.user:
+                self._supervised_station_ids = frozenset(self.user.nexus_stations_supervised.values_list('id',flat=True))
+        return self._supervised_station_ids
+
+    @property
+    def supervised_route_ids(self):
+        if self._supervised_route_ids is None:
+            self._supervised_route_ids = frozenset()
+            if self.user:
+                self._supervised_route_ids = frozenset(self.user.nexus_routes_supervised.values_list('id',flat=True))
+        return self._supervised_route_ids
+
+    def operates_station(self, station_id):
+        return station_id in self.operated_station_ids
+
+    def supervises_station(self, station_id):
+        return station_id in self.supervised_station_ids
+
+    def supervises_route(self, route_id):
+        return route_id in self.supervised_route_ids
+
+    def is_creator(self, asset):
+        if not self.user:
+            return False
+        return self.user_id in get_creator_ids(asset.meta)
+
+    def get_user_info(self, asset=None, stationinroute=None, station=None, asset_station_id=None):
+        is_creator = False
+        station_ids = set()
+        if asset:
+            is_creator = self.is_creator(asset)
+            if asset_station_id is None and asset.stationinroute_id is not None:
+                asset_station_id = get_stationinroute_station_id(asset.stationinroute_id)
+            station_ids.add(asset_station_id)
+        if stationinroute:
+            station_ids.add(stationinroute.station_id)
         if station:
-            if user in station.operators.all():
-                is_operator = True
-            if user in station.supervisors.all():
-                is_supervisor = True
-    return {'is_operator':is_operator,'is_supervisor':is_supervisor,'is_creator':is_creator,'is_authenticated_user':is_authenticated_user,'ip_address':ip_address}
+            station_ids.add(station.pk)
+        station_ids.discard(None)
+
+        return {
+            'is_operator':any(self.operates_station(station_id) for station_id in station_ids),
+            'is_supervisor':any(self.supervises_station(station_id) for station_id in station_ids),
+            'is_creator':is_creator,
+            'is_authenticated_user':self.is_authenticated_user,
+            'ip_address':self.ip_address,
+        }
+
+    def get_subject(self, user_info):
+        #user_info extended with what PermissionRule.matches_subject needs
+        subject = dict(user_info)
+        subject['user_id'] = self.user_id
+        subject['group_ids'] = self.group_ids
+        return subject
+
+
+def get_creator_ids(meta):
+    #user pks of meta creator, legacy creator_str and publication_creators
+    creator_ids = set()
+    meta = meta or dict()
+    for key in ['creator','creator_str']:
+        if key in meta:
+            try:
+                creator_ids.add(int(meta[key]))
+            except:
+                pass
+    if 'publication_creators' in meta:
+        for cr in meta['publication_creators']:
+            try:
+                creator_ids.add(cr['pk'])
+            except:
+                pass
+    return creator_ids
+
+
+def get_user_permission_context(user):
+    if not user:
+        return UserPermissionContext(None)
+    context = getattr(user, '_permission_context', None)
+    if context is None or not context.is_current():
+        context = UserPermissionContext(user)
+        try:
+            user._permission_context = context
+        except AttributeError:
+            pass
+    return context
+
+
+USER_GROUPS_PREFIX = 'nexus:permissions:user_groups:'
+USER_GROUPS_TIMEOUT = 24*60*60 #seconds, memberships are also invalidated by m2m_changed of User.groups
 
-def get_permissions_list(action=None,asset=None,_stationinroute=None,_station=None,_route=None,_asset_type=None,user=None,user_groups=list(),authenticated_user=False,debug=False):
 
-    if asset and asset.pk==1269217:#819786:
-        debug=True
+def get_user_group_ids(user_id):
+    """
+        frozenset of the user's group ids, kept in django cache as a sorted tuple and
+        invalidated by m2m_changed signal of User.groups (see models.py)
+    """
+    key = USER_GROUPS_PREFIX+str(user_id)
+    try:
+        group_ids = cache.get(key)
+    except Exception as e:
+        print("permission user groups: cache is unavailable,", e)
+        group_ids = None
+    if group_ids is None:
+        group_ids = tuple(sorted(Group.objects.filter(user__id=user_id).values_list('id',flat=True)))
+        try:
+            cache.set(key, group_ids, USER_GROUPS_TIMEOUT)
+        except Exception as e:
+            print("permission user groups: cache is unavailable,", e)
+    return frozenset(group_ids)
+
+
+def invalidate_user_group_ids(user_ids):
+    try:
+        cache.delete_many([USER_GROUPS_PREFIX+str(user_id) for user_id in user_ids])
+    except Exception as e:
+        print("permission user groups: cache is unavailable,", e)
+
+
+def get_stationinroute_station_id(stationinroute_id):
+    stationinroutes = get_rule_index().stationinroutes
+    if stationinroute_id in stationinroutes:
+        return stationinroutes[stationinroute_id][0]
+    from nexus.models import StationInRoute
+    return StationInRoute.objects.filter(pk=stationinroute_id).values_list('station_id',flat=True).first()
+
+
+def get_user_info(user,asset,stationinroute,station):
+    return get_user_permission_context(user).get_user_info(asset,stationinroute,station)
+
+def get_permissions_list(action=None,asset=None,_stationinroute=None,_station=None,_route=None,_asset_type=None,user=None,user_groups=list(),authenticated_user=False,debug=False):
 
     is_creator = False
     is_operator = False
@@ -74,10 +244,8 @@ def get_permissions_list(action=None,asset=None,_stationinroute=None,_station=No
             user_groups = user.groups.all()
         except:
             user_groups = list()
-    debug=True
     if debug:
         print("user:",user,"groups:",user_groups)
-    debug=False
     user_info = get_user_info(user,asset,_stationinroute,_station)
     if debug:
         print('\n\n===\n\n',action,user_info,'\n\n===\n\n')
@@ -289,7 +457,6 @@ def get_permissions_list(action=None,asset=None,_stationinroute=None,_station=No
                             
                             #datetime special care: cmp_val is a string starting with DATETIME_, datetime_formats is in perm keys alongside cmp_op and cmp_val
                             if isinstance(asset.payload[key][0], str) and isinstance(cmp_val,str) and cmp_val.startswith('DATETIME_') and 'datetime_formats' in perm.payload_value[key]:
-                                debug=True
                                 if debug:
                                     print('datetime comparison: cmp_op is',cmp_op,',cmp_val is',cmp_val,',datetime formats are',perm.payload_value[key]['datetime_formats'])
                                 found_format = False
@@ -402,47 +569,788 @@ def get_permissions_list(action=None,asset=None,_stationinroute=None,_station=No
     return perms
 
 
-def perform_check(user, asset_type, route, station, stationinroute, asset, action, debug):
-    #print("perform_check start")
-    result = False
-    result_permission = None
-    is_creator = False
-    is_operator = False
-    is_supervisor = False
-    is_authenticated_user = False
-    user_groups = None
+#=====================================================================
+# compiled rule index
+#
+# get_permissions_list is kept for callers that need a queryset; perform_check
+# matches against a per-process compiled copy of Nexus_permission instead.
+# The index is stamped with a version token kept in django cache: post_save and
+# post_delete signals (see models.py) replace the token, every worker notices
+# the change on its next check and rebuilds its copy. Use a shared cache backend,
+# otherwise other workers rely on RULE_INDEX_MAX_AGE only.
+#=====================================================================
 
-    #collect user info
-    user_info = get_user_info(user,asset,stationinroute,station)
-    is_operator = user_info['is_operator']
-    is_supervisor = user_info['is_supervisor']
-    is_creator = user_info['is_creator']
-    is_authenticated_user = user_info['is_authenticated_user']
-    if user:
+RULE_INDEX_VERSION_KEY = 'nexus:permissions:rule_index_version'
+RULE_INDEX_MAX_AGE = 300 #seconds, safety net for updates that bypass signals (queryset.update etc.)
+
+#payload predicates are also translated to sql over this column, see PayloadPredicate.sql
+PAYLOAD_COLUMN = '"nexus_asset"."payload"'
+#characters removed by str.strip()
+STRIP_CHARS = ' \t\n\r\x0b\x0c'
+
+_rule_index = None
+_rule_index_lock = threading.Lock()
+
+
+class PayloadPredicate:
+    """
+        compiled form of a single payload_value item; matches(payload) returns False when
+        the permission must be excluded for the asset - the same way get_permissions_list does it.
+        sql() returns the same condition as (where, params) over PAYLOAD_COLUMN, or None if it
+        can't be expressed in sql and must be evaluated in python
+    """
+    def __init__(self, key):
+        self.key = key
+
+    def matches(self, payload):
+        return True
+
+    def sql(self):
+        return ('TRUE', [])
+
+
+class PayloadNeverMatches(PayloadPredicate):
+    #malformed payload_value items: a permission that can't be evaluated is never granted
+    def matches(self, payload):
+        return False
+
+    def sql(self):
+        return ('FALSE', [])
+
+
+class PayloadKeyPredicate(PayloadPredicate):
+    def __init__(self, key, cmp_op=None, cmp_val=None):
+        self.key = key
+        #None means plain presence check
+        self.cmp_op = cmp_op
+        self.cmp_val = cmp_val
+        if isinstance(cmp_val, str):
+            self.cmp_val_normalized = cmp_val.strip().lower()
+        else:
+            self.cmp_val_normalized = None
+
+    def _compare(self, value):
+        if self.cmp_op is None or self.cmp_op == 'exists':
+            return True
+        if self.cmp_op == '=':
+            if isinstance(value, str):
+                if self.cmp_val_normalized is None:
+                    return False
+                return self.cmp_val_normalized == value.strip().lower()
+            return not (self.cmp_val != value)
+        #strings can't be compared with > and <
+        if isinstance(value, str):
+            return False
         try:
-            user_groups = list(user.groups.all())
+            if self.cmp_op == '>':
+                return not (self.cmp_val >= value)
+            return not (self.cmp_val <= value)
         except:
-            user_groups = list()
+            return False
+
+    def matches(self, payload):
+        values = payload.get(self.key, None)
+        if not values:
+            return False
+        try:
+            value = values[0]
+        except (KeyError, IndexError, TypeError):
+            return False
+        return self._compare(value)
+
+    def _compare_sql(self, value_sql, value_params):
+        #value_sql is jsonb expression of the compared value, it is repeated so are its params
+        if self.cmp_op is None or self.cmp_op == 'exists':
+            return ('TRUE', [])
+        if self.cmp_op == '=':
+            if isinstance(self.cmp_val, str):
+                where = "(jsonb_typeof("+value_sql+") = 'string' AND lower(btrim("+value_sql+" #>> '{}', %s)) = %s)"
+                return (where, value_params+value_params+[STRIP_CHARS, self.cmp_val_normalized])
+            where = "(jsonb_typeof("+value_sql+") <> 'string' AND "+value_sql+" = %s::jsonb)"
+            return (where, value_params+value_params+[json.dumps(self.cmp_val)])
+        #only numbers are compared with > and <
+        if isinstance(self.cmp_val, bool) or not isinstance(self.cmp_val, (int, float)):
+            return None
+        where = "(jsonb_typeof("+value_sql+") = 'number' AND ("+value_sql+" #>> '{}')::numeric "+self.cmp_op+" %s)"
+        return (where, value_params+value_params+[self.cmp_val])
+
+    def sql(self):
+        #payload values are lists, the first item is compared
+        value_sql = PAYLOAD_COLUMN+" -> %s -> 0"
+        value_params = [self.key]
+        compare = self._compare_sql(value_sql, value_params)
+        if compare is None:
+            return None
+        return ("("+value_sql+" IS NOT NULL AND "+compare[0]+")", value_params+compare[1])
+
+
+EMBARGO_CACHE_SIZE = 20000 #parsed payload dates kept in memory
+
+_embargo_dates = OrderedDict()
+_embargo_dates_lock = threading.Lock()
+
+#strptime directives that can be parsed by postgresql to_timestamp: (regex, to_timestamp pattern)
+SQL_DATETIME_DIRECTIVES = {
+    'Y':('(?!0000)[0-9]{4}','YYYY'),
+    'm':('(0?[1-9]|1[0-2])','MM'),
+    'd':('(0?[1-9]|[12][0-9]|3[01])','DD'),
+    'H':('([01]?[0-9]|2[0-3])','HH24'),
+    'M':('[0-5]?[0-9]','MI'),
+    'S':('[0-5]?[0-9]','SS'),
+}
+SQL_DATETIME_LITERALS = '-./: T'
+#(day, month, leap years only) combinations strptime accepts; to_timestamp raises on the rest (2021-02-30)
+SQL_CALENDAR_CASES = (
+    ('(0?[1-9]|1[0-9]|2[0-8])','(0?[1-9]|1[0-2])',False),
+    ('(29|30)','(0?1|0?[3-9]|1[0-2])',False),
+    ('31','(0?[13578]|1[02])',False),
+    ('29','0?2',True),
+)
+SQL_LEAP_YEAR = '([0-9]{2}(0[48]|[2468][048]|[13579][26])|(0[48]|[2468][048]|[13579][26])00)'
+
+
+def _strptime_to_sql(fmt):
+    """
+        (regex, to_timestamp pattern) for a strptime format, None if format has unsupported parts.
+        The regex accepts exactly the values strptime parses, so to_timestamp never fails on a value
+        that passed it; directives must be separated by literals, otherwise the split may differ
+    """
+    parts = list()
+    i = 0
+    while i < len(fmt):
+        if fmt[i] == '%':
+            if i+1 >= len(fmt) or fmt[i+1] not in SQL_DATETIME_DIRECTIVES:
+                return None
+            if len(parts) > 0 and parts[-1][0] == '%':
+                return None
+            parts.append('%'+fmt[i+1])
+            i += 2
+            continue
+        if fmt[i] not in SQL_DATETIME_LITERALS:
+            return None
+        parts.append(fmt[i])
+        i += 1
+
+    directives = [part[1] for part in parts if part.startswith('%')]
+    if 'd' in directives and 'm' in directives:
+        #leap day needs the year, strptime's default year 1900 isn't leap
+        cases = [case for case in SQL_CALENDAR_CASES if not case[2] or 'Y' in directives]
     else:
-        user_groups = list()
+        #missing day is 1, missing month is January: every day of the regex is valid
+        cases = [(SQL_DATETIME_DIRECTIVES['d'][0], SQL_DATETIME_DIRECTIVES['m'][0], False)]
 
-    _stationinroute = stationinroute
-    _station=station
-    _route=route
-    _asset_type=asset_type
+    alternatives = list()
+    for day, month, leap in cases:
+        regex = ''
+        for part in parts:
+            if part == '%d':
+                regex += day
+            elif part == '%m':
+                regex += month
+            elif part == '%Y' and leap:
+                regex += SQL_LEAP_YEAR
+            elif part.startswith('%'):
+                regex += SQL_DATETIME_DIRECTIVES[part[1]][0]
+            else:
+                regex += '\\'+part if part == '.' else part
+        alternatives.append(regex)
+    pattern = ''
+    for part in parts:
+        if part.startswith('%'):
+            pattern += SQL_DATETIME_DIRECTIVES[part[1]][1]
+        else:
+            pattern += '"T"' if part == 'T' else part
+    return ('^('+'|'.join(alternatives)+')$', pattern)
 
-    if asset:
-        if not asset_type:
-            _asset_type=asset.type
-        
-        if not stationinroute:
-            _stationinroute=asset.stationinroute
-        if not route:
-            _route=asset.stationinroute.route
-        if not station:
-            _station = asset.stationinroute.station
-        
-    perms = get_permissions_list(action=action,asset=asset,_stationinroute=_stationinroute,_station=_station,_route=_route,_asset_type=_asset_type,user=user,user_groups=user_groups, debug=debug)
+
+def get_local_timestamp_sql():
+    """
+        sql of the wall clock datetime.now() reads: django sets TZ of the process to TIME_ZONE,
+        while LOCALTIMESTAMP follows the session time zone (UTC with USE_TZ)
+    """
+    from django.conf import settings
+    time_zone = getattr(settings, 'TIME_ZONE', None)
+    if time_zone:
+        return ("(CURRENT_TIMESTAMP AT TIME ZONE %s)", [time_zone])
+    return ("LOCALTIMESTAMP", [])
+
+
+class PayloadDatetimePredicate(PayloadKeyPredicate):
+    """
+        cmp_val is DATETIME_PLUSMONTHS_<n>, payload value is a date string in one of datetime_formats;
+        non-string payload values are compared as plain values, like get_permissions_list does.
+        Payload dates are parsed with every format once, shifted by n months and kept in a bounded
+        LRU cache, so a check is a comparison of the earliest/latest shifted date with now
+    """
+    def __init__(self, key, cmp_op, cmp_val, datetime_formats, datetime_op):
+        super(PayloadDatetimePredicate, self).__init__(key, cmp_op, cmp_val)
+        #only "<" and ">" are checked for dates, any other operator passes
+        self.datetime_op = datetime_op
+        self.datetime_formats = tuple(datetime_formats)
+        self.delta = None
+        self.months = None
+        cmp_val_list = cmp_val.split('_')
+        try:
+            if cmp_val_list[1] == 'PLUSMONTHS':
+                self.months = int(cmp_val_list[2])
+                self.delta = relativedelta(months=self.months)
+        except (IndexError, ValueError):
+            self.delta = None
+            self.months = None
+
+    def get_shifted_dates(self, value):
+        """
+            (earliest, latest) of value parsed with every fitting format and shifted by delta,
+            None if no format fits. The cache key holds the value itself, so a changed payload
+            is parsed again
+        """
+        cache_key = (self.datetime_formats, self.months, value)
+        with _embargo_dates_lock:
+            if cache_key in _embargo_dates:
+                _embargo_dates.move_to_end(cache_key)
+                return _embargo_dates[cache_key]
+
+        moments = list()
+        for fmt in self.datetime_formats:
+            try:
+                moment = datetime.strptime(value, fmt)
+            except:
+                continue
+            if self.delta is not None:
+                moment = moment+self.delta
+            moments.append(moment)
+        shifted = (min(moments), max(moments)) if len(moments) > 0 else None
+
+        with _embargo_dates_lock:
+            _embargo_dates[cache_key] = shifted
+            if len(_embargo_dates) > EMBARGO_CACHE_SIZE:
+                _embargo_dates.popitem(last=False)
+        return shifted
+
+    def _check_shifted(self, shifted, now):
+        if shifted is None:
+            return False
+        if self.delta is None:
+            return True
+        if self.datetime_op == '<':
+            return shifted[0] >= now
+        if self.datetime_op == '>':
+            return shifted[1] <= now
+        return True
+
+    def matches(self, payload):
+        values = payload.get(self.key, None)
+        if not values:
+            return False
+        try:
+            value = values[0]
+        except (KeyError, IndexError, TypeError):
+            return False
+        if not isinstance(value, str):
+            return self._compare(value)
+        return self._check_shifted(self.get_shifted_dates(value), datetime.now())
+
+    def next_flip(self, payload, now):
+        #the moment the check result changes by time alone, None if it doesn't
+        if self.delta is None or self.datetime_op not in ['<','>']:
+            return None
+        try:
+            value = payload[self.key][0]
+        except (KeyError, IndexError, TypeError):
+            return None
+        if not isinstance(value, str):
+            return None
+        shifted = self.get_shifted_dates(value)
+        if shifted is None:
+            return None
+        moment = shifted[0] if self.datetime_op == '<' else shifted[1]
+        if moment > now:
+            return moment
+        return None
+
+    def sql(self):
+        """
+            every format becomes a regex guard and to_timestamp; formats with directives other than
+            SQL_DATETIME_DIRECTIVES can't be translated. The guard rejects impossible dates, so a bad
+            payload value doesn't fit like in python instead of failing the query. Shifted dates are
+            compared with the clock of datetime.now(), see get_local_timestamp_sql
+        """
+        formats = list()
+        for fmt in self.datetime_formats:
+            translated = _strptime_to_sql(fmt)
+            if translated is None:
+                return None
+            formats.append(translated)
+        if len(formats) == 0:
+            return ('FALSE', [])
+
+        value_sql = PAYLOAD_COLUMN+" -> %s -> 0"
+        text_sql = "("+value_sql+" #>> '{}')"
+        fits = list()
+        fits_params = list()
+        checks = list()
+        checks_params = list()
+        for regex, pattern in formats:
+            fits.append(text_sql+" ~ %s")
+            fits_params += [self.key, regex]
+            if self.delta is None or self.datetime_op not in ['<','>']:
+                continue
+            shifted = "(to_timestamp("+text_sql+", %s)::timestamp + %s * interval '1 month')"
+            comparison = ">=" if self.datetime_op == '<' else "<="
+            #to_timestamp is called only for values that fit the regex
+            now = get_local_timestamp_sql()
+            checks.append("(CASE WHEN "+text_sql+" ~ %s THEN "+shifted+" "+comparison+" "+now[0]+" ELSE TRUE END)")
+            checks_params += [self.key, regex, self.key, pattern, self.months]+now[1]
+        date_sql = "(jsonb_typeof("+value_sql+") = 'string' AND ("+" OR ".join(fits)+")"
+        date_params = [self.key]+fits_params
+        if len(checks) > 0:
+            date_sql += " AND "+" AND ".join(checks)
+            date_params += checks_params
+        date_sql += ")"
+
+        #non-string values are compared as plain values
+        compare = self._compare_sql(value_sql, [self.key])
+        if compare is None:
+            compare = ('FALSE', [])
+        where = "("+value_sql+" IS NOT NULL AND ("+date_sql+" OR (jsonb_typeof("+value_sql+") <> 'string' AND "+compare[0]+")))"
+        return (where, [self.key]+date_params+[self.key]+compare[1])
+
+
+class PayloadSubkeyPredicate(PayloadPredicate):
+    #compound requirement, master.sub: only "=" is evaluated, presence is checked for the rest
+    def __init__(self, key, masterkey, subkey, cmp_op=None, cmp_val=None):
+        self.key = key
+        self.masterkey = masterkey
+        self.subkey = subkey
+        self.value_predicate = None
+        if cmp_op == '=':
+            self.value_predicate = PayloadKeyPredicate(subkey, cmp_op, cmp_val)
+
+    def matches(self, payload):
+        values = payload.get(self.masterkey, None)
+        if not values:
+            return False
+        try:
+            first = values[0]
+            if self.subkey not in first:
+                return False
+            if self.value_predicate is None:
+                return True
+            return self.value_predicate._compare(first[self.subkey])
+        except (KeyError, IndexError, TypeError):
+            return False
+
+    def sql(self):
+        first_sql = PAYLOAD_COLUMN+" -> %s -> 0"
+        value_sql = first_sql+" -> %s"
+        value_params = [self.masterkey, self.subkey]
+        where = "(jsonb_typeof("+first_sql+") = 'object' AND "+value_sql+" IS NOT NULL"
+        params = [self.masterkey]+value_params
+        if self.value_predicate is not None:
+            compare = self.value_predicate._compare_sql(value_sql, value_params)
+            where += " AND "+compare[0]
+            params += compare[1]
+        return (where+")", params)
+
+
+def compile_payload_value(payload_value):
+    #returns a list of PayloadPredicate objects, all of them must match
+    predicates = list()
+    if not payload_value:
+        return predicates
+    if not isinstance(payload_value, dict):
+        return [PayloadNeverMatches(None)]
+
+    for key in payload_value:
+        spec = payload_value[key]
+        if isinstance(spec, dict):
+            if not isinstance(spec.get('cmp_op', None), str):
+                predicates.append(PayloadNeverMatches(key))
+                continue
+            cmp_op = raw_op = spec['cmp_op']
+            if cmp_op.lower() == 'exists':
+                cmp_op = 'exists'
+            elif cmp_op not in ['=', '>']:
+                #anything else is treated as "<" by get_permissions_list
+                cmp_op = '<'
+            cmp_val = spec.get('cmp_val', None)
+        else:
+            cmp_op = raw_op = None
+            cmp_val = None
+
+        if '.' in key:
+            key_parts = key.split('.')
+            if len(key_parts) != 2:
+                predicates.append(PayloadNeverMatches(key))
+                continue
+            predicates.append(PayloadSubkeyPredicate(key, key_parts[0], key_parts[1], cmp_op, cmp_val))
+        elif isinstance(cmp_val, str) and cmp_val.startswith('DATETIME_') and 'datetime_formats' in spec:
+            predicates.append(PayloadDatetimePredicate(key, cmp_op, cmp_val, spec['datetime_formats'], raw_op))
+        else:
+            predicates.append(PayloadKeyPredicate(key, cmp_op, cmp_val))
+    return predicates
+
+
+def payload_predicates_sql(predicates):
+    #all predicates joined with AND, None if any of them can't be expressed in sql
+    where = list()
+    params = list()
+    for predicate in predicates:
+        predicate_sql = predicate.sql()
+        if predicate_sql is None:
+            return None
+        where.append(predicate_sql[0])
+        params += predicate_sql[1]
+    if len(where) == 0:
+        return ('TRUE', [])
+    return ('('+' AND '.join(where)+')', params)
+
+
+def filter_by_payload_value(queryset, payload_value):
+    """
+        narrows Asset queryset to the assets payload_value of a permission applies to;
+        returns None if payload_value needs python evaluation (date formats, non-numeric > and <)
+    """
+    payload_sql = payload_predicates_sql(compile_payload_value(payload_value))
+    if payload_sql is None:
+        return None
+    return queryset.extra(where=[payload_sql[0]], params=payload_sql[1])
+
+
+class PermissionRule:
+    """
+        read-only compiled copy of a Nexus_permission row
+    """
+    def __init__(self, perm):
+        self.pk = perm.pk
+        self.is_prohibition = bool(perm.is_prohibition)
+        self.is_default = bool(perm.is_default)
+        self.logging = perm.logging
+        self.action = perm.permission_action_sysname or ''
+
+        self.asset_id = perm.asset_id
+        self.stationinroute_id = perm.stationinroute_id
+        self.station_id = perm.station_id
+        self.route_id = perm.route_id
+        self.asset_type_id = perm.asset_type_id
+
+        self.datetime_start = perm.datetime_start
+        self.datetime_end = perm.datetime_end
+        self.user_id = perm.user_id
+        self.group_id = perm.group_id
+        self.is_creator = bool(perm.is_creator)
+        self.is_operator = bool(perm.is_operator)
+        self.is_supervisor = bool(perm.is_supervisor)
+        self.is_authenticated_user = bool(perm.is_authenticated_user)
+
+        self.payload_value = perm.payload_value
+        self.payload_predicates = compile_payload_value(perm.payload_value)
+        self.payload_sql = payload_predicates_sql(self.payload_predicates)
+        #decision may change with time alone, without any change to rules or asset
+        self.is_time_dependent = bool(self.datetime_start or self.datetime_end or any(isinstance(predicate, PayloadDatetimePredicate) for predicate in self.payload_predicates))
+        self.ip_range = perm.ip_range
+        self.ip_network = None
+        if self.ip_range:
+            try:
+                self.ip_network = ipaddress.ip_network(self.ip_range)
+            except ValueError:
+                self.ip_network = None
+
+    def matches_target(self, asset_id, stationinroute_id, station_id, route_id, asset_type_id):
+        return ((self.asset_id is None or self.asset_id == asset_id) and
+            (self.stationinroute_id is None or self.stationinroute_id == stationinroute_id) and
+            (self.station_id is None or self.station_id == station_id) and
+            (self.route_id is None or self.route_id == route_id) and
+            (self.asset_type_id is None or self.asset_type_id == asset_type_id))
+
+    def matches_subject(self, subject):
+        #subject is a dict made by get_subject
+        if self.is_supervisor and not subject['is_supervisor']:
+            return False
+        if self.is_operator and not subject['is_operator']:
+            return False
+        if self.is_creator and not subject['is_creator']:
+            return False
+        if self.is_authenticated_user and not subject['is_authenticated_user']:
+            return False
+        if self.user_id is not None and self.user_id != subject['user_id']:
+            return False
+        if self.group_id is not None and self.group_id not in subject['group_ids']:
+            return False
+        return True
+
+    def matches_payload(self, payload):
+        for predicate in self.payload_predicates:
+            if not predicate.matches(payload):
+                return False
+        return True
+
+    def __str__(self):
+        return "rule #"+str(self.pk)
+
+
+class IpRangeIndex:
+    """
+        ip_range of all rules as sorted disjoint integer segments per address family,
+        each segment holding pks of the rules whose network covers it; lookup is a bisect
+    """
+    def __init__(self, rules):
+        networks = {4:list(), 6:list()}
+        for rule in rules:
+            if rule.ip_network is not None:
+                networks[rule.ip_network.version].append((int(rule.ip_network.network_address), int(rule.ip_network.broadcast_address), rule.pk))
+
+        self.starts = dict()
+        self.segments = dict()
+        for version, items in networks.items():
+            #sweep over boundaries: every start and every point right after an end opens a new segment
+            opened = dict()
+            closed = dict()
+            for start, end, pk in items:
+                opened.setdefault(start, list()).append(pk)
+                closed.setdefault(end+1, list()).append(pk)
+            boundaries = sorted(set(opened.keys()) | set(closed.keys()))
+            active = dict() #pk -> networks of the rule covering the sweep point
+            starts = list()
+            segments = list()
+            for i in range(len(boundaries)-1):
+                boundary = boundaries[i]
+                for pk in closed.get(boundary, ()):
+                    active[pk] -= 1
+                    if active[pk] == 0:
+                        del active[pk]
+                for pk in opened.get(boundary, ()):
+                    active[pk] = active.get(pk, 0)+1
+                if len(active) == 0:
+                    continue
+                starts.append(boundary)
+                segments.append((boundary, boundaries[i+1]-1, frozenset(active.keys())))
+            self.starts[version] = starts
+            self.segments[version] = segments
+
+    def lookup(self, ip_address):
+        #pks of rules with ip_range containing ip_address
+        if not ip_address:
+            return frozenset()
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return frozenset()
+        value = int(address)
+        i = bisect_right(self.starts[address.version], value)-1
+        if i < 0:
+            return frozenset()
+        start, end, pks = self.segments[address.version][i]
+        if value > end:
+            return frozenset()
+        return pks
+
+
+class PermissionRuleIndex:
+    """
+        rules grouped by action and by their most specific target; candidates() gives every rule
+        whose action and targets fit, ordered by pk just like .first() of an unordered queryset
+    """
+    target_kinds = ('asset','stationinroute','station','route','asset_type')
+
+    def __init__(self, perms, stationinroutes, version=None):
+        self.version = version
+        self.created = time.time()
+        #last time the version was compared with the cache, see aget_rule_index
+        self.checked = self.created
+        self.rules = dict()
+        self.buckets = dict()
+        #stationinroute pk -> (station pk, route pk), saves a query per check
+        self.stationinroutes = dict()
+
+        for perm in perms:
+            rule = PermissionRule(perm)
+            self.rules[rule.pk] = rule
+            self.buckets.setdefault(self._bucket_key(rule), list()).append(rule)
+
+        for bucket in self.buckets.values():
+            bucket.sort(key=lambda rule: rule.pk)
+
+        for sr_id, station_id, route_id in stationinroutes:
+            self.stationinroutes[sr_id] = (station_id, route_id)
+
+        self.ip_ranges = IpRangeIndex(self.rules.values())
+
+        self.group_ids = frozenset(rule.group_id for rule in self.rules.values() if rule.group_id is not None)
+
+        #what rules of every action depend on, see get_access_audience
+        self.actions = dict()
+        for rule in self.rules.values():
+            action = self.actions.setdefault(rule.action, {'user_ids':set(),'group_ids':set(),'ip_rule_pks':set(),'is_creator':False,'is_operator':False,'is_supervisor':False})
+            if rule.user_id is not None:
+                action['user_ids'].add(rule.user_id)
+            if rule.group_id is not None:
+                action['group_ids'].add(rule.group_id)
+            if rule.ip_range:
+                action['ip_rule_pks'].add(rule.pk)
+            action['is_creator'] = action['is_creator'] or rule.is_creator
+            action['is_operator'] = action['is_operator'] or rule.is_operator
+            action['is_supervisor'] = action['is_supervisor'] or rule.is_supervisor
+
+    @classmethod
+    def load(cls, version=None):
+        from nexus.models import Nexus_permission, StationInRoute
+        perms = Nexus_permission.objects.all().order_by('pk')
+        stationinroutes = StationInRoute.objects.all().values_list('pk','station_id','route_id')
+        return cls(perms, stationinroutes, version)
+
+    def _bucket_key(self, rule):
+        for kind in self.target_kinds:
+            target_id = getattr(rule, kind+'_id')
+            if target_id is not None:
+                return (rule.action, kind, target_id)
+        return (rule.action, None, None)
+
+    def is_expired(self):
+        return time.time() - self.created > RULE_INDEX_MAX_AGE
+
+    def resolve_targets(self, asset=None, stationinroute=None, station=None, route=None, asset_type=None):
+        #returns ids of the check targets, derived from asset the way get_permissions_list does it
+        asset_id = asset.pk if asset else None
+        stationinroute_id = stationinroute.pk if stationinroute else None
+        station_id = station.pk if station else None
+        route_id = route.pk if route else None
+        asset_type_id = asset_type.pk if asset_type else None
+
+        source_sr_id = None
+        source_sr = None
+        if asset:
+            source_sr_id = asset.stationinroute_id
+            if stationinroute_id is None:
+                stationinroute_id = asset.stationinroute_id
+            if asset_type_id is None:
+                asset_type_id = asset.type_id
+        elif stationinroute:
+            source_sr_id = stationinroute.pk
+            source_sr = stationinroute
+
+        if source_sr_id is not None and (station_id is None or route_id is None):
+            if source_sr_id in self.stationinroutes:
+                sr_station_id, sr_route_id = self.stationinroutes[source_sr_id]
+            else:
+                if source_sr is None:
+                    source_sr = asset.stationinroute
+                sr_station_id, sr_route_id = source_sr.station_id, source_sr.route_id
+            if station_id is None:
+                station_id = sr_station_id
+            if route_id is None:
+                route_id = sr_route_id
+
+        return (asset_id, stationinroute_id, station_id, route_id, asset_type_id)
+
+    def candidates(self, action, targets):
+        if action and action.strip() != '':
+            action_key = action
+        else:
+            action_key = ''
+
+        bucket_keys = [(action_key, None, None)]
+        for kind, target_id in zip(self.target_kinds, targets):
+            if target_id is not None:
+                bucket_keys.append((action_key, kind, target_id))
+
+        result = list()
+        for bucket_key in bucket_keys:
+            for rule in self.buckets.get(bucket_key, ()):
+                if rule.matches_target(*targets):
+                    result.append(rule)
+        result.sort(key=lambda rule: rule.pk)
+        return result
+
+    def match(self, action, targets, subject, asset=None):
+        rules = list()
+        if asset:
+            payload = asset.payload or dict()
+            ip_rule_pks = self.ip_ranges.lookup(subject['ip_address'])
+        for rule in self.candidates(action, targets):
+            if not rule.matches_subject(subject):
+                continue
+            #payload_value and ip_range are evaluated only when an asset is checked
+            if asset:
+                if rule.ip_range and rule.pk not in ip_rule_pks:
+                    continue
+                if not rule.matches_payload(payload):
+                    continue
+            rules.append(rule)
+        return rules
+
+
+def _get_rule_index_version():
+    try:
+        version = cache.get(RULE_INDEX_VERSION_KEY)
+        if version is None:
+            cache.add(RULE_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(RULE_INDEX_VERSION_KEY)
+    except Exception as e:
+        print("permission rule index: cache is unavailable,", e)
+        version = None
+    return version
+
+
+def get_rule_index():
+    global _rule_index
+    version = _get_rule_index_version()
+    index = _rule_index
+    if index is None or index.version != version or index.is_expired():
+        with _rule_index_lock:
+            index = _rule_index
+            if index is None or index.version != version or index.is_expired():
+                index = PermissionRuleIndex.load(version)
+                _rule_index = index
+    index.checked = time.time()
+    return index
+
+
+def reload_rule_index():
+    #rebuilds this process' copy without changing the shared version, other workers keep theirs
+    global _rule_index
+    with _rule_index_lock:
+        _rule_index = PermissionRuleIndex.load(_get_rule_index_version())
+    return _rule_index
+
+
+def invalidate_rule_index():
+    global _rule_index
+    _rule_index = None
+    try:
+        cache.set(RULE_INDEX_VERSION_KEY, uuid.uuid4().hex, None)
+    except Exception as e:
+        print("permission rule index: cache is unavailable,", e)
+
+
+def _precedence(rule):
+    #default prohibition, default permission, prohibition, permission; lowest pk within each
+    return (not rule.is_default, not rule.is_prohibition, rule.pk)
+
+
+def _resolve_rules(rules):
+    #single pass over matched rules, returns (result, winning rule)
+    winner = None
+    for rule in rules:
+        if winner is None or _precedence(rule) < _precedence(winner):
+            winner = rule
+    if winner is None:
+        return False, None
+    return not winner.is_prohibition, winner
+
+
+def _resolve_queryset(perms):
+    #one ordered query, same precedence as _resolve_rules
+    winner = perms.order_by('-is_default','-is_prohibition','pk').first()
+    if winner is None:
+        return False, None
+    return not winner.is_prohibition, winner
+
+
+def _resolve_queryset_by_stages(perms):
+    #previous resolution with count()/first() per stage, kept for benchmark_permissions
+    result = False
+    result_permission = None
     prohibitions = perms.filter(is_prohibition=True)
     perms = perms.filter(is_prohibition=False)
 
@@ -460,35 +1368,909 @@ def perform_check(user, asset_type, route, station, stationinroute, asset, actio
     perms = perms.filter(is_default=False)
     prohibitions = prohibitions.filter(is_default=False)
     if (not result_permission) and (prohibitions.count() > 0):
-        #print("got false by prohibition")
         result_permission=prohibitions.first()
         result = False
-        #print(result_permission)
     if (not result_permission) and (perms.count() > 0):
-        #print("got true")
         result_permission=perms.first()
-        #print(result_permission)
         result = True
+    return result, result_permission
+
+
+#=====================================================================
+# permission check log
+#=====================================================================
+
+PERMISSION_LOG_FLUSH_SIZE = 100 #entries
+PERMISSION_LOG_FLUSH_INTERVAL = 5 #seconds
+PERMISSION_LOG_MAX_LENGTH = 10000 #entries kept in memory, the rest is dropped
+
+
+class PermissionLogBuffer:
+    """
+        field values of Nexus_permission_log_entry (pks only, see make_log_entry) gathered in memory
+        and written with bulk_create at the end of every request, or when flush_size entries are
+        collected or flush_interval passed since the last flush. Due flushes wait while a transaction
+        is open, so a rollback of someone's request doesn't take buffered entries of others with it.
+        Length is bounded by max_length, entries that don't fit are counted in dropped.
+        entry_datetime is auto_now, so it is the time of the flush rather than of the check
+    """
+    def __init__(self, flush_size=PERMISSION_LOG_FLUSH_SIZE, flush_interval=PERMISSION_LOG_FLUSH_INTERVAL, max_length=PERMISSION_LOG_MAX_LENGTH):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_length = max_length
+        self.entries = list()
+        self.dropped = 0
+        self.written = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, entry, flush=True):
+        self.extend([entry], flush)
+
+    def extend(self, entries, flush=True):
+        with self.lock:
+            free = self.max_length - len(self.entries)
+            if free < len(entries):
+                self.dropped += len(entries) - max(free, 0)
+                entries = entries[:max(free, 0)]
+            self.entries += entries
+        if flush:
+            self.flush_if_due()
+
+    def is_due(self):
+        return len(self.entries) >= self.flush_size or (len(self.entries) > 0 and time.time() - self.last_flush >= self.flush_interval)
+
+    def flush_if_due(self):
+        from django.db import connection
+        if connection.in_atomic_block:
+            return
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            entries = self.entries
+            self.entries = list()
+            self.last_flush = time.time()
+        if len(entries) == 0:
+            return 0
+        from nexus.models import Nexus_permission_log_entry
+        try:
+            Nexus_permission_log_entry.objects.bulk_create([Nexus_permission_log_entry(**fields) for fields in entries])
+        except Exception as e:
+            print("permission log: failed to write",len(entries),"entries,",e)
+            with self.lock:
+                self.dropped += len(entries)
+            return 0
+        with self.lock:
+            self.written += len(entries)
+        return len(entries)
+
+
+permission_log = PermissionLogBuffer()
+
+
+@receiver(request_finished, dispatch_uid='nexus_permission_log_flush')
+def flush_permission_log(sender, **kwargs):
+    #response is already sent and request transaction is over, write everything buffered
+    from django.db import connection, close_old_connections
+    if connection.in_atomic_block or len(permission_log.entries) == 0:
+        return
+    permission_log.flush()
+    #django's close_old_connections may have run before this receiver and the flush reopened
+    #the connection: close it the same way, so CONN_MAX_AGE is respected
+    close_old_connections()
+
+atexit.register(permission_log.flush)
+
+
+def is_logged(result_permission, result):
+    #result_permission is either Nexus_permission or PermissionRule
+    return (result_permission.logging == 3) or (result_permission.logging == 2 and result) or (result_permission.logging == 12 and not result)
+
+
+def make_log_entry(result_permission, result, user, action, asset=None, asset_type=None, route=None, station=None, stationinroute=None):
+    #Nexus_permission_log_entry field values; route, station and stationinroute aren't logged by the model
+    user_id = None
+    if user and not isinstance(user,AnonymousUser):
+        user_id = user.pk
+    return {
+        'permission_id':result_permission.pk,
+        'permission_action_sysname':action,
+        'entry_result':result,
+        'user_id':user_id,
+        'asset_type_id':asset_type.pk if asset_type else None,
+        'asset_id':asset.pk if asset else None,
+    }
+
+
+def _log_check(result_permission, result, user, asset_type, route, station, stationinroute, asset, action):
+    if is_logged(result_permission, result):
+        permission_log.add(make_log_entry(result_permission, result, user, action, asset, asset_type, route, station, stationinroute))
+
+
+#=====================================================================
+# decision cache
+#
+# decisions on assets are kept in django cache, shared by all workers. The key
+# is made of everything the decision depends on: rule index version, targets,
+# action, the user's role signature, ip segment and a generation token of the
+# asset that changes on every save. An entry expires at the nearest moment any
+# candidate rule could flip by time alone (datetime_start/end, DATETIME_ embargo
+# of the asset), DECISION_CACHE_TIMEOUT at most.
+# Enabled with NEXUS_PERMISSION_DECISION_CACHE = True.
+#=====================================================================
+
+DECISION_CACHE_SETTING = 'NEXUS_PERMISSION_DECISION_CACHE'
+DECISION_CACHE_TIMEOUT = 600 #seconds
+DECISION_CACHE_PREFIX = 'nexus:permissions:decision:'
+ASSET_GENERATION_PREFIX = 'nexus:permissions:asset_generation:'
+ASSET_GENERATION_TIMEOUT = 2*DECISION_CACHE_TIMEOUT #seconds, outlives every decision stamped with the generation
+
+
+def decision_cache_enabled():
+    from django.conf import settings
+    return getattr(settings, DECISION_CACHE_SETTING, False)
+
+
+def get_role_signature(context, index, action, asset, stationinroute, station, targets):
+    """
+        the part of the user permission rules of the action can see; users with the same
+        signature get the same decision on the asset
+    """
+    action_key = action if (action and action.strip() != '') else ''
+    action_info = index.actions.get(action_key, None)
+    if action_info is None:
+        return 'none'
+    signature = [str(context.is_authenticated_user)]
+    signature.append(str(context.user_id) if context.user_id in action_info['user_ids'] else '-')
+    signature.append(','.join(str(pk) for pk in sorted(context.group_ids & action_info['group_ids'])))
+    signature.append(','.join(str(pk) for pk in sorted(index.ip_ranges.lookup(context.ip_address) & action_info['ip_rule_pks'])))
+    if action_info['is_creator']:
+        signature.append(str(context.is_creator(asset)))
+    if action_info['is_operator'] or action_info['is_supervisor']:
+        user_info = context.get_user_info(asset, stationinroute, station, asset_station_id=targets[2])
+        signature.append(str(user_info['is_operator'])+str(user_info['is_supervisor']))
+    return '|'.join(signature)
+
+
+def get_decision_cache_key(index, action, targets, signature):
+    raw = '|'.join([str(index.version), str(action), ','.join(str(target) for target in targets), signature])
+    return DECISION_CACHE_PREFIX+hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def get_decision_timeout(index, action, targets, asset):
+    timeout = DECISION_CACHE_TIMEOUT
+    from django.utils import timezone
+    now = timezone.now()
+    naive_now = datetime.now()
+    payload = asset.payload or dict()
+    for rule in index.candidates(action, targets):
+        if not rule.is_time_dependent:
+            continue
+        for moment in [rule.datetime_start, rule.datetime_end]:
+            if moment and moment > now:
+                timeout = min(timeout, (moment-now).total_seconds())
+        for predicate in rule.payload_predicates:
+            if isinstance(predicate, PayloadDatetimePredicate):
+                moment = predicate.next_flip(payload, naive_now)
+                if moment:
+                    timeout = min(timeout, (moment-naive_now).total_seconds())
+    return max(int(timeout), 1)
+
+
+def get_asset_generation_key(asset_pk):
+    return ASSET_GENERATION_PREFIX+str(asset_pk)
 
-    #log
 
+def get_asset_generation(generation_key):
+    generation = uuid.uuid4().hex
+    try:
+        if not cache.add(generation_key, generation, ASSET_GENERATION_TIMEOUT):
+            generation = cache.get(generation_key) or generation
+    except Exception as e:
+        print("permission decision cache: cache is unavailable,", e)
+    return generation
+
+
+def invalidate_asset_decisions(asset):
+    #new generation token makes all cached decisions on the asset unreachable
+    if not decision_cache_enabled():
+        return
+    try:
+        cache.set(get_asset_generation_key(asset.pk), uuid.uuid4().hex, ASSET_GENERATION_TIMEOUT)
+    except Exception as e:
+        print("permission decision cache: cache is unavailable,", e)
+
+
+def _check_with_index(user, asset_type, route, station, stationinroute, asset, action):
+    index = get_rule_index()
+    targets = index.resolve_targets(asset, stationinroute, station, route, asset_type)
+    context = get_user_permission_context(user)
+
+    cache_key = None
+    generation = ''
+    if asset and decision_cache_enabled():
+        signature = get_role_signature(context, index, action, asset, stationinroute, station, targets)
+        cache_key = get_decision_cache_key(index, action, targets, signature)
+        generation_key = get_asset_generation_key(asset.pk)
+        try:
+            cached = cache.get_many([cache_key, generation_key])
+        except Exception as e:
+            print("permission decision cache: cache is unavailable,", e)
+            cached = dict()
+        generation = cached.get(generation_key, None)
+        if generation is None:
+            #expired or evicted: a new generation, decisions stamped with the lost one must not match
+            generation = get_asset_generation(generation_key)
+        elif cache_key in cached and cached[cache_key][0] == generation:
+            result, permission_pk = cached[cache_key][1:]
+            return result, index.rules.get(permission_pk, None)
+
+    subject = context.get_subject(context.get_user_info(asset, stationinroute, station, asset_station_id=targets[2] if asset else None))
+    result, result_permission = _resolve_rules(index.match(action, targets, subject, asset))
+
+    if cache_key:
+        value = (generation, result, result_permission.pk if result_permission else None)
+        try:
+            cache.set(cache_key, value, get_decision_timeout(index, action, targets, asset))
+        except Exception as e:
+            print("permission decision cache: cache is unavailable,", e)
+    return result, result_permission
+
+
+def perform_check(user, asset_type, route, station, stationinroute, asset, action, debug):
+    if debug:
+        #debug output is produced by queryset-based get_permissions_list
+        _stationinroute = stationinroute
+        _station=station
+        _route=route
+        _asset_type=asset_type
+        if asset:
+            if not asset_type:
+                _asset_type=asset.type
+            if not stationinroute:
+                _stationinroute=asset.stationinroute
+            if not route:
+                _route=asset.stationinroute.route
+            if not station:
+                _station = asset.stationinroute.station
+        perms = get_permissions_list(action=action,asset=asset,_stationinroute=_stationinroute,_station=_station,_route=_route,_asset_type=_asset_type,user=user,debug=debug)
+        result, result_permission = _resolve_queryset(perms)
+    else:
+        result, result_permission = _check_with_index(user, asset_type, route, station, stationinroute, asset, action)
+
+    #log
     if result_permission:
-        if (result_permission.logging == 3) or (result_permission.logging == 2 and result) or (result_permission.logging == 12 and not result):
-            from nexus.models import Nexus_permission_log_entry
-
-            entry = Nexus_permission_log_entry()
-            entry.permission=result_permission
-            entry.permission_action_sysname = action
-            entry.entry_result = result
-            if not isinstance(user,AnonymousUser):
-                entry.user = user
-            entry.asset_type = asset_type
-            entry.asset = asset
-            entry.station = station
-            entry.route = route
-            entry.stationinroute = stationinroute
-            entry.save()
-    
+        _log_check(result_permission, result, user, asset_type, route, station, stationinroute, asset, action)
 
     return result
 
+
+#=====================================================================
+# explain
+#=====================================================================
+
+EXPLAIN_MAX_LISTED = 50 #rule pks listed per stage, the rest is only counted
+
+
+def _describe_rule(rule):
+    description = {'pk':rule.pk,'is_default':rule.is_default,'is_prohibition':rule.is_prohibition,'action':rule.action,'logging':rule.logging}
+    for kind in PermissionRuleIndex.target_kinds+('user','group'):
+        if getattr(rule, kind+'_id') is not None:
+            description[kind] = getattr(rule, kind+'_id')
+    for flag in ['is_creator','is_operator','is_supervisor','is_authenticated_user']:
+        if getattr(rule, flag):
+            description[flag] = True
+    if rule.payload_value:
+        description['payload_value'] = rule.payload_value
+    if rule.ip_range:
+        description['ip_range'] = rule.ip_range
+    return description
+
+
+def explain_check(user=None, asset_type=None, route=None, station=None, stationinroute=None, asset=None, action=None, context=None):
+    """
+        perform_check with a structured account of the decision: rules eliminated by every
+        stage, the winning rule, stage timings and every query made. Nothing is cached or logged.
+        context is the user's UserPermissionContext, e.g. with another ip address
+    """
+    queries = list()
+    def record_query(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries.append({'sql':sql,'params':[str(param) for param in params] if params and not many else None,'time_ms':(time.perf_counter()-start)*1000})
+
+    from django.db import connection
+
+    stages = list()
+    def add_stage(name, remaining, test, started):
+        passed = [rule for rule in remaining if test(rule)]
+        passed_pks = set(rule.pk for rule in passed)
+        eliminated = [rule.pk for rule in remaining if rule.pk not in passed_pks]
+        stages.append({
+            'stage':name,
+            'eliminated_count':len(eliminated),
+            'eliminated':eliminated[:EXPLAIN_MAX_LISTED],
+            'remaining_count':len(passed),
+            'time_ms':(time.perf_counter()-started)*1000,
+        })
+        return passed
+
+    total_start = time.perf_counter()
+    with connection.execute_wrapper(record_query):
+        started = time.perf_counter()
+        index = get_rule_index()
+        stages.append({'stage':'rule index','rules':len(index.rules),'version':index.version,'time_ms':(time.perf_counter()-started)*1000})
+
+        started = time.perf_counter()
+        targets = index.resolve_targets(asset, stationinroute, station, route, asset_type)
+        if context is None:
+            context = get_user_permission_context(user)
+        subject = context.get_subject(context.get_user_info(asset, stationinroute, station, asset_station_id=targets[2] if asset else None))
+        stages.append({'stage':'user info','time_ms':(time.perf_counter()-started)*1000})
+
+        action_key = action if (action and action.strip() != '') else ''
+        rules = sorted(index.rules.values(), key=lambda rule: rule.pk)
+        started = time.perf_counter()
+        rules = add_stage('action', rules, lambda rule: rule.action == action_key, started)
+        started = time.perf_counter()
+        rules = add_stage('targets', rules, lambda rule: rule.matches_target(*targets), started)
+        started = time.perf_counter()
+        rules = add_stage('user, groups and roles', rules, lambda rule: rule.matches_subject(subject), started)
+        if asset:
+            started = time.perf_counter()
+            ip_rule_pks = index.ip_ranges.lookup(subject['ip_address'])
+            rules = add_stage('ip_range', rules, lambda rule: not rule.ip_range or rule.pk in ip_rule_pks, started)
+            started = time.perf_counter()
+            payload = asset.payload or dict()
+            rules = add_stage('payload_value', rules, lambda rule: rule.matches_payload(payload), started)
+
+        started = time.perf_counter()
+        result, winner = _resolve_rules(rules)
+        stages.append({'stage':'resolution','time_ms':(time.perf_counter()-started)*1000})
+
+    explain = {
+        'action':action,
+        'asset':asset.pk if asset else None,
+        'user':context.user_id,
+        'targets':dict(zip(PermissionRuleIndex.target_kinds, targets)),
+        'subject':{
+            'is_creator':subject['is_creator'],
+            'is_operator':subject['is_operator'],
+            'is_supervisor':subject['is_supervisor'],
+            'is_authenticated_user':subject['is_authenticated_user'],
+            'ip_address':subject['ip_address'],
+            'group_ids':sorted(subject['group_ids']),
+        },
+        'stages':stages,
+        'matched':[_describe_rule(rule) for rule in sorted(rules, key=_precedence)[:EXPLAIN_MAX_LISTED]],
+        'winner':_describe_rule(winner) if winner else None,
+        'result':result,
+        'queries':queries,
+        'query_time_ms':sum(query['time_ms'] for query in queries),
+        'total_ms':(time.perf_counter()-total_start)*1000,
+    }
+    return explain
+
+
+#=====================================================================
+# bulk checks
+#=====================================================================
+
+def load_deferred_asset_fields(assets, fields=('payload','meta')):
+    #AssetManager defers payload and meta, load them for the whole list with a single query
+    from nexus.models import Asset
+
+    pending = dict()
+    for asset in assets:
+        deferred = asset.get_deferred_fields()
+        if any(field in deferred for field in fields):
+            pending[asset.pk] = asset
+    if len(pending) == 0:
+        return
+    for row in Asset.objects.filter(pk__in=list(pending.keys())).values_list('pk',*fields):
+        asset = pending[row[0]]
+        for field, value in zip(fields, row[1:]):
+            setattr(asset, field, value)
+
+
+def check_permissions_bulk(user, assets, action, log=True, context=None):
+    """
+        same as perform_check with asset and action given for each item of assets;
+        returns {asset.pk: bool}. context is the user's UserPermissionContext, e.g. with another ip address
+    """
+    assets = list(assets)
+    results = dict()
+    if len(assets) == 0:
+        return results
+
+    load_deferred_asset_fields(assets)
+    if context is None:
+        context = get_user_permission_context(user)
+    index = get_rule_index()
+    log_entries = list()
+
+    for asset in assets:
+        targets = index.resolve_targets(asset=asset)
+        subject = context.get_subject(context.get_user_info(asset, asset_station_id=targets[2]))
+        result, result_permission = _resolve_rules(index.match(action, targets, subject, asset))
+        results[asset.pk] = result
+
+        if result_permission and log and is_logged(result_permission, result):
+            log_entries.append(make_log_entry(result_permission, result, context.user, action, asset))
+
+    if len(log_entries) > 0:
+        permission_log.extend(log_entries)
+
+    return results
+
+
+#=====================================================================
+# permission-filtered asset querysets
+#
+# rules of the action are turned into a single where clause:
+#   NOT default_prohibitions AND (default_permissions OR (NOT prohibitions AND permissions))
+# which is what perform_check gives for every asset. Conditions on the user are
+# evaluated in python beforehand, conditions on the asset become sql.
+#=====================================================================
+
+ASSET_TABLE = '"nexus_asset"'
+VISIBLE_ASSETS_CHUNK_SIZE = 500
+
+
+def _id_list_sql(column, ids):
+    ids = sorted(ids)
+    if len(ids) == 0:
+        return ('FALSE', [])
+    return (column+' IN ('+','.join(['%s']*len(ids))+')', ids)
+
+
+def _rule_asset_sql(rule, index, context):
+    """
+        (where, params) the asset must satisfy for the rule to apply to it, None if rule can't apply to
+        any asset for this user; payload_value evaluated in python (rule.payload_sql is None)
+        is left out of the condition, callers decide what to do with such rules
+    """
+    user = context.user
+    subject = context.get_subject({
+        #asset-dependent flags are turned into sql below
+        'is_creator':rule.is_creator and user is not None,
+        'is_operator':rule.is_operator,
+        'is_supervisor':rule.is_supervisor,
+        'is_authenticated_user':context.is_authenticated_user,
+        'ip_address':context.ip_address,
+    })
+    if not rule.matches_subject(subject):
+        return None
+    if rule.ip_range and rule.pk not in index.ip_ranges.lookup(context.ip_address):
+        return None
+    where = list()
+    params = list()
+    def add(condition):
+        where.append(condition[0])
+        params.extend(condition[1])
+
+    if rule.asset_id is not None:
+        add((ASSET_TABLE+'."id" = %s', [rule.asset_id]))
+    if rule.asset_type_id is not None:
+        add((ASSET_TABLE+'."type_id" = %s', [rule.asset_type_id]))
+    if rule.stationinroute_id is not None:
+        add((ASSET_TABLE+'."stationinroute_id" = %s', [rule.stationinroute_id]))
+
+    #station and route are those of asset's stationinroute
+    station_ids = None
+    if rule.station_id is not None:
+        station_ids = set([rule.station_id])
+    if rule.is_operator:
+        station_ids = context.operated_station_ids if station_ids is None else station_ids & context.operated_station_ids
+    if rule.is_supervisor:
+        station_ids = context.supervised_station_ids if station_ids is None else station_ids & context.supervised_station_ids
+    if station_ids is not None or rule.route_id is not None:
+        sr_ids = list()
+        for sr_id, (station_id, route_id) in index.stationinroutes.items():
+            if station_ids is not None and station_id not in station_ids:
+                continue
+            if rule.route_id is not None and route_id != rule.route_id:
+                continue
+            sr_ids.append(sr_id)
+        if len(sr_ids) == 0:
+            return None
+        add(_id_list_sql(ASSET_TABLE+'."stationinroute_id"', sr_ids))
+
+    if rule.is_creator:
+        #see UserPermissionContext.is_creator
+        meta = ASSET_TABLE+'."meta"'
+        add(("("+meta+" ->> 'creator' = %s OR "+meta+" ->> 'creator_str' = %s OR "+meta+" -> 'publication_creators' @> %s::jsonb)",
+            [str(user.pk), str(user.pk), json.dumps([{'pk':user.pk}])]))
+
+    if rule.payload_sql is not None:
+        add(rule.payload_sql)
+    if len(where) == 0:
+        return ('TRUE', [])
+    return ('COALESCE(('+' AND '.join(where)+'), FALSE)', params)
+
+
+def _get_action_rules_sql(action, index, context):
+    #[(rule, (where, params))] of the rules of the action that may apply to some asset
+    action_key = action if (action and action.strip() != '') else ''
+    rules_sql = list()
+    for rule in index.rules.values():
+        if rule.action != action_key:
+            continue
+        rule_sql = _rule_asset_sql(rule, index, context)
+        if rule_sql is not None:
+            rules_sql.append((rule, rule_sql))
+    return rules_sql
+
+
+def _join_or(conditions):
+    if len(conditions) == 0:
+        return ('FALSE', [])
+    params = list()
+    for condition in conditions:
+        params += condition[1]
+    return ('('+' OR '.join([condition[0] for condition in conditions])+')', params)
+
+
+def _visible_assets_where(rules_sql):
+    classes = {'default_prohibitions':list(),'default_perms':list(),'prohibitions':list(),'perms':list()}
+    for rule, rule_sql in rules_sql:
+        if rule.is_default:
+            classes['default_prohibitions' if rule.is_prohibition else 'default_perms'].append(rule_sql)
+        else:
+            classes['prohibitions' if rule.is_prohibition else 'perms'].append(rule_sql)
+    joined = dict((name, _join_or(conditions)) for name, conditions in classes.items())
+
+    where = ('(NOT '+joined['default_prohibitions'][0]+' AND ('+joined['default_perms'][0]+' OR (NOT '+joined['prohibitions'][0]+' AND '+joined['perms'][0]+')))')
+    params = joined['default_prohibitions'][1]+joined['default_perms'][1]+joined['prohibitions'][1]+joined['perms'][1]
+    return (where, params)
+
+
+def get_visible_assets_sql(user, action, index=None, context=None):
+    #(where, params) for Asset queryset, None if some of the rules is evaluated in python (see filter_visible_assets)
+    if index is None:
+        index = get_rule_index()
+    if context is None:
+        context = get_user_permission_context(user)
+    rules_sql = _get_action_rules_sql(action, index, context)
+    if any(rule.payload_sql is None for rule, rule_sql in rules_sql):
+        return None
+    return _visible_assets_where(rules_sql)
+
+
+def filter_visible_assets(queryset, user, action, ip_address=None):
+    """
+        Asset queryset narrowed to assets perform_check grants the action on.
+        Rules with payload_value evaluated in python (date formats) are left out of the sql:
+        only assets such a rule could apply to are loaded and checked with check_permissions_bulk,
+        the rest is decided by sql. ip_address overrides the one set on the user
+    """
+    index = get_rule_index()
+    context = get_user_permission_context(user)
+    if ip_address is not None:
+        context = context.with_ip_address(ip_address)
+    rules_sql = _get_action_rules_sql(action, index, context)
+    python_rules_sql = [(rule, rule_sql) for rule, rule_sql in rules_sql if rule.payload_sql is None]
+    if len(python_rules_sql) == 0:
+        where, params = _visible_assets_where(rules_sql)
+        return queryset.extra(where=[where], params=params)
+
+    #where none of the python rules applies, the others decide
+    exact = _visible_assets_where([item for item in rules_sql if item[0].payload_sql is not None])
+    undecided = _join_or([rule_sql for rule, rule_sql in python_rules_sql])
+    #best case for the rest: python permissions match, python prohibitions don't
+    possible = _visible_assets_where([item for item in rules_sql if item[0].payload_sql is not None or not item[0].is_prohibition])
+    candidates = queryset.extra(where=[undecided[0], possible[0]], params=undecided[1]+possible[1])
+
+    visible_ids = list()
+    chunk = list()
+    for asset in candidates.iterator(chunk_size=VISIBLE_ASSETS_CHUNK_SIZE):
+        chunk.append(asset)
+        if len(chunk) >= VISIBLE_ASSETS_CHUNK_SIZE:
+            visible_ids += [pk for pk, result in check_permissions_bulk(user, chunk, action, log=False, context=context).items() if result]
+            chunk = list()
+    if len(chunk) > 0:
+        visible_ids += [pk for pk, result in check_permissions_bulk(user, chunk, action, log=False, context=context).items() if result]
+
+    checked = _id_list_sql(ASSET_TABLE+'."id"', visible_ids)
+    where = '((NOT '+undecided[0]+' AND '+exact[0]+') OR '+checked[0]+')'
+    return queryset.extra(where=[where], params=undecided[1]+exact[1]+checked[1])
+
+
+#=====================================================================
+# materialized access table
+#
+# Nexus_permission_access keeps decisions for users that have nothing personal
+# in the rules of the action: no user-specific rules, no roles on the asset, no
+# matching ip_range. Such users get the decision of their audience - anonymous,
+# authenticated or a member of a single group referenced by the rules.
+# Rows are written offline by fill_access_table (management command
+# fill_permission_access), never by checks: a missing row is computed in memory.
+# Saves of permissions, stationinroutes and assets delete only the rows they may
+# change (see models.py). Decisions of time-dependent rules are never stored.
+# Enabled with NEXUS_PERMISSION_ACCESS_TABLE = True.
+#=====================================================================
+
+ACCESS_TABLE_SETTING = 'NEXUS_PERMISSION_ACCESS_TABLE'
+
+
+def access_table_enabled():
+    from django.conf import settings
+    return getattr(settings, ACCESS_TABLE_SETTING, False)
+
+
+def get_access_audience(context, index, asset, action):
+    #(audience, group_id) the user shares the decision with, None if decision is personal
+    action_key = action if (action and action.strip() != '') else ''
+    action_info = index.actions.get(action_key, None)
+    if action_info is None:
+        #no rules at all - the same for everyone
+        return ('anonymous', None) if not context.is_authenticated_user else ('authenticated', None)
+
+    if context.user_id is not None and context.user_id in action_info['user_ids']:
+        return None
+    if len(action_info['ip_rule_pks']) > 0 and len(action_info['ip_rule_pks'] & index.ip_ranges.lookup(context.ip_address)) > 0:
+        return None
+    if action_info['is_creator'] and context.is_creator(asset):
+        return None
+    if action_info['is_operator'] or action_info['is_supervisor']:
+        station_id = get_stationinroute_station_id(asset.stationinroute_id)
+        if action_info['is_operator'] and context.operates_station(station_id):
+            return None
+        if action_info['is_supervisor'] and context.supervises_station(station_id):
+            return None
+
+    if not context.is_authenticated_user:
+        return ('anonymous', None)
+    group_ids = context.group_ids & action_info['group_ids']
+    if len(group_ids) == 0:
+        return ('authenticated', None)
+    if len(group_ids) == 1:
+        return ('group', list(group_ids)[0])
+    return None
+
+
+def compute_audience_access(index, asset, action, audience, group_id):
+    #(result, rule) for a user with nothing but the audience, None if it can't be stored
+    targets = index.resolve_targets(asset=asset)
+    for rule in index.candidates(action, targets):
+        if rule.is_time_dependent:
+            return None
+    subject = {
+        'is_creator':False,
+        'is_operator':False,
+        'is_supervisor':False,
+        'is_authenticated_user':audience != 'anonymous',
+        'ip_address':None,
+        'user_id':None,
+        'group_ids':frozenset([group_id]) if group_id else frozenset(),
+    }
+    return _resolve_rules(index.match(action, targets, subject, asset))
+
+
+def check_asset_access(user, asset, action):
+    """
+        perform_check for a single asset, answered from Nexus_permission_access when possible
+    """
+    if not access_table_enabled():
+        return perform_check(user, None, None, None, None, asset, action, False)
+
+    from nexus.models import Nexus_permission_access
+
+    index = get_rule_index()
+    context = get_user_permission_context(user)
+    audience = get_access_audience(context, index, asset, action)
+    if audience is None:
+        return perform_check(user, None, None, None, None, asset, action, False)
+
+    action_key = action if (action and action.strip() != '') else ''
+    row = Nexus_permission_access.objects.filter(asset_id=asset.pk, permission_action_sysname=action_key, audience=audience[0], group_id=audience[1]).values_list('entry_result','permission_id').first()
+    if row is not None:
+        result = row[0]
+        result_permission = index.rules.get(row[1], None)
+    else:
+        #not filled yet or invalidated, the table is written by fill_access_table only
+        computed = compute_audience_access(index, asset, action, audience[0], audience[1])
+        if computed is None:
+            return perform_check(user, None, None, None, None, asset, action, False)
+        result, result_permission = computed
+
+    if result_permission:
+        _log_check(result_permission, result, user, None, None, None, None, asset, action)
+    return result
+
+
+def get_action_audiences(index, action):
+    #every (audience, group_id) that may have rows for the action
+    action_info = index.actions.get(action, None)
+    audiences = [('anonymous', None), ('authenticated', None)]
+    if action_info is not None:
+        audiences += [('group', group_id) for group_id in sorted(action_info['group_ids'])]
+    return audiences
+
+
+def fill_access_table(assets, actions, index=None):
+    """
+        replaces rows of assets (with payload and meta loaded) for actions in one transaction;
+        returns the number of rows written, None if rules changed meanwhile and nothing was written
+    """
+    from django.db import transaction
+    from nexus.models import Nexus_permission_access
+    if index is None:
+        index = get_rule_index()
+    rows = list()
+    for action in actions:
+        action_key = action if (action and action.strip() != '') else ''
+        audiences = get_action_audiences(index, action_key)
+        for asset in assets:
+            for audience, group_id in audiences:
+                computed = compute_audience_access(index, asset, action_key, audience, group_id)
+                if computed is None:
+                    #time-dependent, the same for every audience
+                    break
+                result, result_permission = computed
+                rows.append(Nexus_permission_access(
+                    asset_id=asset.pk,
+                    permission_action_sysname=action_key,
+                    audience=audience,
+                    group_id=group_id,
+                    entry_result=result,
+                    permission_id=result_permission.pk if result_permission else None,
+                    rule_index_version=index.version or '',
+                ))
+    action_keys = [action if (action and action.strip() != '') else '' for action in actions]
+    with transaction.atomic():
+        Nexus_permission_access.objects.filter(asset_id__in=[asset.pk for asset in assets], permission_action_sysname__in=action_keys).delete()
+        Nexus_permission_access.objects.bulk_create(rows)
+        #rows computed from rules saved meanwhile would escape their invalidation
+        if _get_rule_index_version() != index.version:
+            transaction.set_rollback(True)
+            return None
+    return len(rows)
+
+
+ACCESS_RULE_FIELDS = ['permission_action_sysname','asset_id','asset_type_id','stationinroute_id','station_id','route_id']
+
+
+def get_rule_access_filter(rule_fields):
+    #Q over Nexus_permission_access rows a rule with these field values (see ACCESS_RULE_FIELDS) may decide
+    action = rule_fields.get('permission_action_sysname', None)
+    query = Q(permission_action_sysname=action if (action and action.strip() != '') else '')
+    if rule_fields.get('asset_id', None) is not None:
+        query &= Q(asset_id=rule_fields['asset_id'])
+    if rule_fields.get('asset_type_id', None) is not None:
+        query &= Q(asset__type_id=rule_fields['asset_type_id'])
+    if rule_fields.get('stationinroute_id', None) is not None:
+        query &= Q(asset__stationinroute_id=rule_fields['stationinroute_id'])
+    if rule_fields.get('station_id', None) is not None:
+        query &= Q(asset__stationinroute__station_id=rule_fields['station_id'])
+    if rule_fields.get('route_id', None) is not None:
+        query &= Q(asset__stationinroute__route_id=rule_fields['route_id'])
+    return query
+
+
+def invalidate_access_rules(rules_fields):
+    #rows rules may decide, before and after a change of the rules
+    if not access_table_enabled() or len(rules_fields) == 0:
+        return
+    from nexus.models import Nexus_permission_access
+    query = Q()
+    for rule_fields in rules_fields:
+        query |= get_rule_access_filter(rule_fields)
+    Nexus_permission_access.objects.filter(query).delete()
+
+
+def invalidate_access_stationinroute(stationinroute_pk):
+    #station and route of assets there are taken from the stationinroute
+    if not access_table_enabled():
+        return
+    from nexus.models import Nexus_permission_access
+    Nexus_permission_access.objects.filter(asset__stationinroute_id=stationinroute_pk).delete()
+
+
+def invalidate_access_table(asset=None):
+    #rows of an asset after it is saved, every row if asset is None
+    if not access_table_enabled():
+        return
+    from nexus.models import Nexus_permission_access
+    if asset is None:
+        Nexus_permission_access.objects.all().delete()
+    else:
+        Nexus_permission_access.objects.filter(asset_id=asset.pk).delete()
+
+
+#=====================================================================
+# async checks
+#
+# django ORM and cache of this project (django 3.x) are synchronous and there is no
+# async ORM to use instead, so async checks run in memory only when everything they
+# need is already loaded: a recently verified rule index, user's groups and stations
+# and asset's payload/meta. Anything missing is loaded with a single sync_to_async
+# call, which still takes a thread - for the first check of an authenticated user
+# in a request and for assets with deferred payload (AssetManager defers it) that is
+# the common case; load assets with defer(None) and check a loaded user several times
+# to stay in the event loop. Anonymous checks of loaded assets never leave it.
+# request.user of AuthenticationMiddleware is lazy and reads the session and the
+# database on first use: aperform_check resolves it with sync_to_async, callers
+# that pass users around themselves should pass resolved ones.
+# Decision cache and access table are not used by the async path, the shared rule
+# index is only read.
+#=====================================================================
+
+ASYNC_RULE_INDEX_RECHECK = 2 #seconds the rule index is used without comparing its version
+
+
+async def aget_rule_index():
+    index = _rule_index
+    if index is not None and time.time() - index.checked < ASYNC_RULE_INDEX_RECHECK and not index.is_expired():
+        return index
+    return await sync_to_async(get_rule_index)()
+
+
+async def aresolve_user(user):
+    #lazy request.user is loaded in a thread, isinstance on it would query from the event loop
+    if issubclass(type(user), LazyObject) and user._wrapped is empty:
+        await sync_to_async(user._setup)()
+    return user
+
+
+def _is_check_loaded(index, context, asset):
+    #True if a check can be made without database or cache
+    if asset is not None:
+        deferred = asset.get_deferred_fields()
+        if 'payload' in deferred or 'meta' in deferred:
+            return False
+        #stationinroutes created after the index was built are read from the asset
+        if asset.stationinroute_id not in index.stationinroutes and not asset._meta.get_field('stationinroute').is_cached(asset):
+            return False
+    if context.user:
+        if context._group_ids is None or context._operated_station_ids is None or context._supervised_station_ids is None:
+            return False
+    return True
+
+
+def _load_check(index, context, asset):
+    #runs in a worker thread: loads into the asset and the context, the shared index is left alone
+    if asset is not None:
+        load_deferred_asset_fields([asset])
+        if asset.stationinroute_id not in index.stationinroutes:
+            asset.stationinroute
+    context.group_ids
+    context.operated_station_ids
+    context.supervised_station_ids
+
+
+async def aget_user_info(user, asset, stationinroute, station):
+    user = await aresolve_user(user)
+    index = await aget_rule_index()
+    context = get_user_permission_context(user)
+    if not _is_check_loaded(index, context, asset):
+        await sync_to_async(_load_check)(index, context, asset)
+    asset_station_id = index.resolve_targets(asset=asset)[2] if asset else None
+    return context.get_user_info(asset, stationinroute, station, asset_station_id=asset_station_id)
+
+
+async def aperform_check(user, asset_type, route, station, stationinroute, asset, action):
+    """
+        perform_check for async views, same semantics; log entries are buffered and written
+        with sync_to_async when the buffer is due. Takes a thread when user or asset data
+        is missing, see the comment above
+    """
+    user = await aresolve_user(user)
+    index = await aget_rule_index()
+    context = get_user_permission_context(user)
+    if not _is_check_loaded(index, context, asset):
+        await sync_to_async(_load_check)(index, context, asset)
+
+    targets = index.resolve_targets(asset, stationinroute, station, route, asset_type)
+    subject = context.get_subject(context.get_user_info(asset, stationinroute, station, asset_station_id=targets[2] if asset else None))
+    result, result_permission = _resolve_rules(index.match(action, targets, subject, asset))
+
+    if result_permission and is_logged(result_permission, result):
+        permission_log.add(make_log_entry(result_permission, result, user, action, asset, asset_type, route, station, stationinroute), flush=False)
+        if permission_log.is_due():
+            await sync_to_async(permission_log.flush_if_due)()
+    return result
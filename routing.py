@@ -0,0 +1,805 @@
+import time
+import uuid
+import json
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from django.core.cache import cache
+from nexus.modifications import get_compiled_modifications
+
+#=====================================================================
+# compiled routing requirements
+#
+# routing list of StationInRoute.properties is compiled once into route variants
+# holding requirement predicates with pre-normalized comparison values;
+# Route.check_routing_requirements evaluates them against asset payload.
+# Semantics are those of the former Route._check_atomic_requirement:
+# strings are compared stripped and lowercased, anything else as is;
+# the first compare key found (in REQUIREMENT_OPERATIONS order) decides.
+#=====================================================================
+
+ROUTING_VERSION_KEY = 'nexus:routing:version'
+ROUTING_CACHE_MAX_AGE = 300 #seconds, safety net for properties updated without post_save (queryset.update etc.)
+ROUTING_CACHE_SIZE = 2000 #stationinroutes kept compiled
+
+#order of the former if/elif chains
+REQUIREMENT_OPERATIONS = ['value_equals','value_equals_any','value_absent','value_not_equals','value_equals_payload_value','value_greater','value_less','item_count_equals','item_count_greater','item_count_less']
+#value_absent is not supported by dictionary requirements, they check plain presence instead
+DICTIONARY_REQUIREMENT_OPERATIONS = [operation for operation in REQUIREMENT_OPERATIONS if operation != 'value_absent']
+
+
+def normalize(value):
+    if isinstance(value, str):
+        return value.strip().lower()
+    return value
+
+
+class ValueMatcher:
+    """
+        value_equals with the expected value normalized once
+    """
+    def __init__(self, expected):
+        self.expected = expected
+        self.is_string = isinstance(expected, str)
+        self.normalized = normalize(expected)
+
+    def matches(self, item):
+        if self.is_string and isinstance(item, str):
+            return item.strip().lower() == self.normalized
+        return item == self.expected
+
+
+class AnyValueMatcher:
+    """
+        value_equals_any: string variants in a set of normalized values, the rest compared as is
+    """
+    def __init__(self, variants):
+        self.strings = set()
+        self.others = list()
+        for variant in variants:
+            if isinstance(variant, str):
+                self.strings.add(normalize(variant))
+            else:
+                self.others.append(variant)
+        self.variants = list(variants)
+
+    def matches(self, item):
+        if isinstance(item, str):
+            if item.strip().lower() in self.strings:
+                return True
+            return any(item == variant for variant in self.others)
+        return any(item == variant for variant in self.variants)
+
+
+def get_first_payload_value(payload, path):
+    #value_equals_payload_value compares only the first items
+    try:
+        if '.' in path:
+            key, subkey = path.split('.')[0], path.split('.')[1]
+            return payload[key][0][subkey]
+        return payload[path][0]
+    except:
+        return None
+
+
+def values_equal(item, value_to_compare):
+    if isinstance(item, str) and isinstance(value_to_compare, str):
+        return item.strip().lower() == value_to_compare.strip().lower()
+    return item == value_to_compare
+
+
+class RequirementPredicate:
+    def __init__(self, requirement):
+        self.title = requirement['title']
+
+    def matches(self, asset, payload):
+        return False
+
+    def check(self, asset, payload=None):
+        #result dict as returned by Route._check_requirement
+        if payload is None:
+            payload = asset.payload
+        return {'is_validated':self.matches(asset, payload), 'title':self.title}
+
+
+class StationFormfillPredicate(RequirementPredicate):
+    """
+        STATION_FORMFILL: required_fields of station's field template of asset type are in payload;
+        templates belong to the station, so they are looked up on every check
+    """
+    def matches(self, asset, payload):
+        result = True
+        try:
+            for key in asset.stationinroute.station.properties['field_templates'][asset.type.sysname].get('required_fields',[]):
+                if '.' not in key:
+                    if key not in payload:
+                        return False
+                else:#compound requirement
+                    master = key.split('.')[0]
+                    subkey = key.split('.')[1]
+                    if master not in payload:
+                        return False
+                    for item in payload[master]:
+                        if subkey not in item or item[subkey].strip() == '':
+                            result = False
+        except Exception as e:
+            print("ERROR checking sttion_formfill requirement",e)
+        return result
+
+
+class PayloadRequirementPredicate(RequirementPredicate):
+    """
+        requirement on values of payload[sysname]
+    """
+    operations = REQUIREMENT_OPERATIONS
+
+    def __init__(self, requirement):
+        super(PayloadRequirementPredicate, self).__init__(requirement)
+        self.sysname = requirement['sysname']
+        self.operation = None
+        for operation in self.operations:
+            if operation in requirement:
+                self.operation = operation
+                break
+        self.argument = requirement.get(self.operation, None) if self.operation else None
+        self.matcher = None
+        if self.operation in ['value_equals','value_not_equals']:
+            self.matcher = ValueMatcher(self.argument)
+        elif self.operation == 'value_equals_any':
+            self.matcher = AnyValueMatcher(self.argument)
+
+    def count_matches(self, payload):
+        #item_count_* compare the number of items of payload[sysname]
+        count = len(payload[self.sysname])
+        if self.operation == 'item_count_equals':
+            return count == self.argument
+        if self.operation == 'item_count_greater':
+            return count > self.argument
+        return count < self.argument
+
+    def matches(self, asset, payload):
+        operation = self.operation
+        sysname = self.sysname
+        if operation in ['value_equals','value_equals_any']:
+            if sysname in payload:
+                for item in payload[sysname]:
+                    if self.matcher.matches(item):
+                        return True
+            return False
+        if operation == 'value_absent':
+            return sysname not in payload
+        if operation == 'value_not_equals':
+            if sysname not in payload:
+                return True
+            for item in payload[sysname]:
+                if not self.matcher.matches(item):
+                    return True
+            return False
+        if operation == 'value_equals_payload_value':
+            return values_equal(payload[sysname][0], get_first_payload_value(payload, self.argument))
+        if operation in ['value_greater','value_less']:
+            #never implemented
+            return False
+        if operation in ['item_count_equals','item_count_greater','item_count_less']:
+            return self.count_matches(payload)
+        #trivial presence in payload
+        return sysname in payload
+
+
+class DictionaryRequirementPredicate(PayloadRequirementPredicate):
+    """
+        sysname is payload_key.dictionary_key, requirement holds if any dict item of
+        payload[payload_key] having dictionary_key fulfills it
+    """
+    operations = DICTIONARY_REQUIREMENT_OPERATIONS
+
+    def __init__(self, requirement):
+        super(DictionaryRequirementPredicate, self).__init__(requirement)
+        self.payload_key_name = self.sysname.split('.')[0]
+        self.dictionary_key_name = self.sysname.split('.')[1]
+
+    def matches(self, asset, payload):
+        if self.payload_key_name not in payload:
+            return False
+        operation = self.operation
+        for dict_value in payload[self.payload_key_name]:
+            if not isinstance(dict_value, dict) or self.dictionary_key_name not in dict_value:
+                continue
+            value = dict_value[self.dictionary_key_name]
+            if operation in ['value_equals','value_equals_any']:
+                if self.matcher.matches(value):
+                    return True
+            elif operation == 'value_not_equals':
+                if not self.matcher.matches(value):
+                    return True
+            elif operation == 'value_equals_payload_value':
+                if values_equal(value, get_first_payload_value(payload, self.argument)):
+                    return True
+            elif operation in ['value_greater','value_less']:
+                pass
+            elif operation in ['item_count_equals','item_count_greater','item_count_less']:
+                if self.count_matches(payload):
+                    return True
+            else:
+                return True
+        return False
+
+
+class AnyOfRequirementPredicate(RequirementPredicate):
+    """
+        sysname is a list/tuple, requirement holds if it holds for any of the names
+    """
+    def __init__(self, requirement):
+        super(AnyOfRequirementPredicate, self).__init__(requirement)
+        self.variants = list()
+        for requirement_variant in requirement['sysname']:
+            variant_requirement = dict(requirement)
+            variant_requirement['sysname'] = requirement_variant
+            self.variants.append(compile_atomic_requirement(variant_requirement))
+
+    def matches(self, asset, payload):
+        for variant in self.variants:
+            if variant.matches(asset, payload):
+                return True
+        return False
+
+
+def compile_atomic_requirement(requirement):
+    if requirement['sysname'] == 'STATION_FORMFILL':
+        return StationFormfillPredicate(requirement)
+    if '.' in requirement['sysname']:
+        return DictionaryRequirementPredicate(requirement)
+    return PayloadRequirementPredicate(requirement)
+
+
+def compile_requirement(requirement):
+    if isinstance(requirement['sysname'],tuple) or isinstance(requirement['sysname'],list):
+        return AnyOfRequirementPredicate(requirement)
+    return compile_atomic_requirement(requirement)
+
+
+class CompiledRouteVariant:
+    """
+        one item of StationInRoute.properties['routing'] with compiled requirements;
+        config is the item itself
+    """
+    def __init__(self, route_variant):
+        self.config = route_variant
+        self.destination_id = route_variant['destination_id']
+        self.auto_route = route_variant['auto_route']
+        self.requirements = [compile_requirement(requirement) for requirement in route_variant.get('requirements',list())]
+        self.payload_modifications = None
+        if 'payload_modifications' in route_variant:
+            self.payload_modifications = get_compiled_modifications(route_variant['payload_modifications'])
+
+    def check(self, asset, payload=None):
+        #result dict as returned by Route._check_route_variant
+        if payload is None:
+            payload = asset.payload
+        route_result = dict()
+        route_result['destination_id'] = self.destination_id
+        route_result['auto_route'] = self.auto_route
+        route_result['requirements'] = list()
+        if 'payload_modifications' in self.config:
+            route_result['payload_modifications'] = self.config['payload_modifications']
+        if 'asset_type_modifications' in self.config:
+            route_result['asset_type_modifications'] = self.config['asset_type_modifications']
+
+        is_validated = True
+        for requirement in self.requirements:
+            requirement_check_result = requirement.check(asset, payload)
+            route_result['requirements'].append(requirement_check_result)
+            if not requirement_check_result['is_validated']:
+                is_validated = False
+        route_result['is_validated'] = is_validated
+        return route_result
+
+
+def compile_routing(properties):
+    #compiled route variants of StationInRoute.properties
+    return [CompiledRouteVariant(route_variant) for route_variant in (properties or dict()).get('routing', list())]
+
+
+def validate_routing(properties):
+    """
+        problems of StationInRoute.properties['routing'] found by compiling it, as (errors, warnings)
+        lists of messages; errors break routing, warnings are payload_modifications items that are
+        skipped at runtime like they always were. See StationInRoute.clean
+    """
+    errors = list()
+    warnings = list()
+    routing = (properties or dict()).get('routing', list())
+    if not isinstance(routing, list):
+        return ["routing must be a list"], warnings
+    for index, route_variant in enumerate(routing):
+        if not isinstance(route_variant, dict):
+            errors.append("routing[%d]: must be a dict" % index)
+            continue
+        try:
+            compiled = CompiledRouteVariant(route_variant)
+        except KeyError as e:
+            errors.append("routing[%d]: %s is missing" % (index, e))
+            continue
+        except Exception as e:
+            errors.append("routing[%d]: %s" % (index, e))
+            continue
+        if compiled.payload_modifications is not None:
+            warnings += ["routing[%d]: %s" % (index, error) for error in compiled.payload_modifications.errors]
+        for modification in route_variant.get('asset_type_modifications', list()):
+            try:
+                old_type, new_type = modification.split('->')
+                if old_type != '*':
+                    int(old_type)
+                int(new_type)
+            except Exception:
+                errors.append("routing[%d]: asset_type_modifications %r: expected <type pk>-><type pk> or *-><type pk>" % (index, modification))
+    return errors, warnings
+
+
+_compiled_routing = OrderedDict() #stationinroute pk -> (version, created, compiled variants)
+_compiled_routing_lock = threading.Lock()
+
+
+def _get_routing_version():
+    try:
+        version = cache.get(ROUTING_VERSION_KEY)
+        if version is None:
+            cache.add(ROUTING_VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(ROUTING_VERSION_KEY)
+    except Exception as e:
+        print("routing: cache is unavailable,", e)
+        version = None
+    return version
+
+
+def get_compiled_routing(stationinroute):
+    """
+        compiled routing of a stationinroute, cached per process and kept on the instance
+        for the rest of the request; StationInRoute post_save changes the version
+    """
+    compiled = getattr(stationinroute, '_compiled_routing', None)
+    if compiled is not None:
+        return compiled
+
+    version = _get_routing_version()
+    with _compiled_routing_lock:
+        entry = _compiled_routing.get(stationinroute.pk, None)
+        if entry is not None and entry[0] == version and time.time()-entry[1] < ROUTING_CACHE_MAX_AGE:
+            _compiled_routing.move_to_end(stationinroute.pk)
+            compiled = entry[2]
+    if compiled is None:
+        compiled = compile_routing(stationinroute.properties)
+        if stationinroute.pk is not None:
+            with _compiled_routing_lock:
+                _compiled_routing[stationinroute.pk] = (version, time.time(), compiled)
+                while len(_compiled_routing) > ROUTING_CACHE_SIZE:
+                    _compiled_routing.popitem(last=False)
+    try:
+        stationinroute._compiled_routing = compiled
+    except:
+        pass
+    return compiled
+
+
+def invalidate_routing(stationinroute=None):
+    #after properties of a stationinroute change; every process recompiles on its next check
+    if stationinroute is not None:
+        stationinroute.__dict__.pop('_compiled_routing', None)
+    with _compiled_routing_lock:
+        _compiled_routing.clear()
+    try:
+        cache.set(ROUTING_VERSION_KEY, uuid.uuid4().hex, None)
+    except Exception as e:
+        print("routing: cache is unavailable,", e)
+
+
+#=====================================================================
+# routing scheduler
+#
+# assign_asset -> perform -> asset_action -> route_asset -> assign_asset ... used to
+# recurse once per hop. Route.route_asset and Station.assign_asset now run as steps
+# of a work queue: a call made while a step is running is queued and returns None
+# (none of the callers used the result), the outermost call drains the queue.
+# Steps queued by a step run before the steps queued earlier, which keeps the
+# depth-first order of the recursion. Asset saves made within a route or assign
+# step are deferred and written once when the step ends.
+#=====================================================================
+
+ROUTING_MAX_HOPS_SETTING = 'NEXUS_ROUTING_MAX_HOPS'
+ROUTING_MAX_HOPS = 100 #hops of a single asset within one scheduler run
+
+_scheduler_local = threading.local()
+
+
+class RoutingLimitExceeded(Exception):
+    pass
+
+
+class deferred_asset_saves:
+    """
+        asset.save() within the block only marks the asset, it is saved once on exit
+    """
+    def __init__(self, asset):
+        self.asset = asset
+
+    def __enter__(self):
+        self.was_deferred = getattr(self.asset, '_defer_save', False)
+        self.asset._defer_save = True
+        return self.asset
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.asset._defer_save = self.was_deferred
+        if not self.was_deferred and getattr(self.asset, '_save_pending', False):
+            self.asset._save_pending = False
+            self.asset.save()
+        return False
+
+
+def get_routing_state(asset):
+    """
+        asset position, type, operator, payload and meta (without history, which grows every hop);
+        arriving at the same state twice means a loop. Custom stations and assign_asset may change
+        only meta or the operator, such a revisit is a different state. Requirements depending on
+        something outside the asset can't be seen here, the hop limit covers those
+    """
+    meta = dict((key, value) for key, value in (asset.meta or dict()).items() if key != 'history')
+    content = json.dumps([asset.payload, meta], sort_keys=True, default=str)
+    return (asset.stationinroute_id, asset.type_id, asset.operator_id, hashlib.md5(content.encode('utf-8')).hexdigest())
+
+
+class RoutingScheduler:
+    def __init__(self, max_hops=None):
+        if max_hops is None:
+            from django.conf import settings
+            max_hops = getattr(settings, ROUTING_MAX_HOPS_SETTING, ROUTING_MAX_HOPS)
+        self.max_hops = max_hops
+        self.queue = deque()
+        self.children = None
+        self.hops = dict() #asset pk -> hops made
+        self.states = dict() #asset pk -> set of routing states the asset arrived at
+        self.steps = 0
+
+    def enqueue(self, func, args, kwargs):
+        self.children.append((func, args, kwargs))
+
+    def execute(self, func, args, kwargs):
+        self.children = list()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.steps += 1
+            #children of this step run before anything queued earlier
+            self.queue.extendleft(reversed(self.children))
+            self.children = None
+
+    def run(self, func, *args, **kwargs):
+        _scheduler_local.scheduler = self
+        try:
+            result = self.execute(func, args, kwargs)
+            while len(self.queue) > 0:
+                self.execute(*self.queue.popleft())
+        finally:
+            _scheduler_local.scheduler = None
+        return result
+
+    def register_hop(self, asset):
+        """
+            called by route_asset after the asset moved; raises RoutingLimitExceeded
+            if the asset made too many hops or came back to a state it has already been in
+        """
+        hops = self.hops.get(asset.pk, 0)+1
+        self.hops[asset.pk] = hops
+        if hops > self.max_hops:
+            raise RoutingLimitExceeded("asset #%s made more than %d routing hops" % (asset.pk, self.max_hops))
+        state = get_routing_state(asset)
+        states = self.states.setdefault(asset.pk, set())
+        if state in states:
+            raise RoutingLimitExceeded("asset #%s routing loop at stationinroute #%s" % (asset.pk, asset.stationinroute_id))
+        states.add(state)
+
+
+def get_routing_scheduler():
+    return getattr(_scheduler_local, 'scheduler', None)
+
+
+def schedule_routing_step(func, *args, **kwargs):
+    #runs func right away as the first step of a new scheduler or queues it in the running one
+    scheduler = get_routing_scheduler()
+    if scheduler is not None:
+        scheduler.enqueue(func, args, kwargs)
+        return None
+    return RoutingScheduler().run(func, *args, **kwargs)
+
+
+def register_routing_hop(asset):
+    scheduler = get_routing_scheduler()
+    if scheduler is not None:
+        scheduler.register_hop(asset)
+
+
+#=====================================================================
+# route graph
+#
+# routes, stationinroutes, their next_station_in_route links and routing edges
+# (destination_id of StationInRoute.properties['routing'], across routes too;
+# #RETURN# destinations are kept as markers) loaded with two queries and kept
+# per process under a cache-held version that saves of StationInRoute, Station
+# and Route change
+#=====================================================================
+
+ROUTE_GRAPH_VERSION_KEY = 'nexus:routing:graph_version'
+ROUTE_GRAPH_MAX_AGE = 300 #seconds, safety net for updates that bypass signals
+RETURN_DESTINATION = '#RETURN#'
+ROUTE_GRAPH_MAX_CYCLES = 1000 #cycles listed by find_cycles, their number may grow exponentially
+
+_route_graph = None
+_route_graph_lock = threading.Lock()
+
+
+class RouteGraphNode:
+    def __init__(self, pk, station_id, route_id, next_id, can_route_back, properties):
+        self.pk = pk
+        self.station_id = station_id
+        self.route_id = route_id
+        self.next_id = next_id
+        self.can_route_back = can_route_back
+        properties = properties or dict()
+        self.allow_adding_assets = bool(properties.get('allow_adding_assets',False))
+        self.has_routing = 'routing' in properties
+        #destination ids of routing variants in order, RETURN_DESTINATION for #RETURN#
+        self.destinations = list()
+        self.auto_destinations = list()
+        for route_variant in properties.get('routing',list()):
+            destination = route_variant.get('destination_id',None)
+            if destination != RETURN_DESTINATION:
+                try:
+                    destination = int(destination)
+                except:
+                    continue
+            self.destinations.append(destination)
+            if route_variant.get('auto_route',False):
+                self.auto_destinations.append(destination)
+
+    @property
+    def returns(self):
+        return RETURN_DESTINATION in self.destinations
+
+
+class RouteGraph:
+    def __init__(self, stationinroutes, force_return_station_ids, version=None):
+        self.version = version
+        self.created = time.time()
+        self.nodes = dict()
+        self.route_nodes = dict() #route pk -> stationinroute pks
+        self.station_nodes = dict() #station pk -> stationinroute pks
+        self.previous = dict() #stationinroute pk -> pks of stationinroutes with it as next_station_in_route
+        self.incoming = dict() #stationinroute pk -> pks of stationinroutes routing to it
+        self.force_return_station_ids = frozenset(force_return_station_ids)
+
+        for row in stationinroutes:
+            node = RouteGraphNode(*row)
+            self.nodes[node.pk] = node
+            self.route_nodes.setdefault(node.route_id, list()).append(node.pk)
+            self.station_nodes.setdefault(node.station_id, list()).append(node.pk)
+        for node in self.nodes.values():
+            if node.next_id is not None:
+                self.previous.setdefault(node.next_id, set()).add(node.pk)
+            for destination in node.destinations:
+                if destination != RETURN_DESTINATION:
+                    self.incoming.setdefault(destination, set()).add(node.pk)
+        for pks in self.route_nodes.values():
+            pks.sort()
+
+    @classmethod
+    def load(cls, version=None):
+        from nexus.models import StationInRoute, Station
+        stationinroutes = StationInRoute.objects.all().values_list('pk','station_id','route_id','next_station_in_route_id','can_route_back','properties')
+        force_return_station_ids = Station.objects.filter(properties__force_return=True).values_list('pk',flat=True)
+        return cls(stationinroutes, force_return_station_ids, version)
+
+    def is_expired(self):
+        return time.time()-self.created > ROUTE_GRAPH_MAX_AGE
+
+    def get_node(self, stationinroute_id):
+        try:
+            return self.nodes.get(int(stationinroute_id), None)
+        except:
+            return None
+
+    def neighbors(self, stationinroute_id, auto_only=False):
+        #routing destinations of a stationinroute, existing ones only
+        node = self.get_node(stationinroute_id)
+        if node is None:
+            return list()
+        destinations = node.auto_destinations if auto_only else node.destinations
+        return [destination for destination in destinations if destination in self.nodes]
+
+    def is_cross_route(self, stationinroute_id, destination_id):
+        node = self.get_node(stationinroute_id)
+        destination = self.get_node(destination_id)
+        return node is not None and destination is not None and node.route_id != destination.route_id
+
+    def is_force_return(self, stationinroute_id):
+        node = self.get_node(stationinroute_id)
+        return node is not None and node.station_id in self.force_return_station_ids
+
+    def get_stations_chain(self, route_id):
+        """
+            stationinroute pks of Route.get_stations_list: from the first stationinroute nobody points
+            to with next_station_in_route that allows adding assets, along next_station_in_route
+            while it stays in the route; a repeated stationinroute ends the chain
+        """
+        first = None
+        for pk in self.route_nodes.get(route_id, list()):
+            node = self.nodes[pk]
+            if pk not in self.previous and node.allow_adding_assets:
+                first = node
+                break
+        chain = list()
+        seen = set()
+        node = first
+        while node is not None and node.route_id == route_id and node.pk not in seen:
+            chain.append(node.pk)
+            seen.add(node.pk)
+            node = self.nodes.get(node.next_id, None) if node.next_id is not None else None
+        return chain
+
+    def get_entry_nodes(self, route_id):
+        #where assets enter the route: stationinroutes allowing to add assets
+        return [pk for pk in self.route_nodes.get(route_id, list()) if self.nodes[pk].allow_adding_assets]
+
+    def find_unreachable(self, route_id):
+        """
+            stationinroutes of the route no routing edge leads to from any entry point of any route;
+            routing into the route from other routes counts
+        """
+        reachable = set()
+        stack = list()
+        for other_route_id in self.route_nodes:
+            stack += self.get_entry_nodes(other_route_id)
+        while len(stack) > 0:
+            pk = stack.pop()
+            if pk in reachable:
+                continue
+            reachable.add(pk)
+            stack += [destination for destination in self.neighbors(pk) if destination not in reachable]
+        return [pk for pk in self.route_nodes.get(route_id, list()) if pk not in reachable]
+
+    def strongly_connected(self, nodes, auto_only=True):
+        #strongly connected components (sets of pks) of the subgraph of nodes, iterative Tarjan
+        nodes = set(nodes)
+        index = dict()
+        lowlink = dict()
+        on_stack = set()
+        stack = list()
+        components = list()
+        for root in sorted(nodes):
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter([pk for pk in self.neighbors(root, auto_only) if pk in nodes]))]
+            while len(work) > 0:
+                node, neighbors = work[-1]
+                destination = next(neighbors, None)
+                if destination is not None:
+                    if destination not in index:
+                        index[destination] = lowlink[destination] = len(index)
+                        stack.append(destination)
+                        on_stack.add(destination)
+                        work.append((destination, iter([pk for pk in self.neighbors(destination, auto_only) if pk in nodes])))
+                    elif destination in on_stack:
+                        lowlink[node] = min(lowlink[node], index[destination])
+                    continue
+                work.pop()
+                if len(work) > 0:
+                    lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        pk = stack.pop()
+                        on_stack.discard(pk)
+                        component.add(pk)
+                        if pk == node:
+                            break
+                    components.append(component)
+        return components
+
+    def find_cycles(self, route_id=None, auto_only=True, limit=ROUTE_GRAPH_MAX_CYCLES):
+        """
+            every elementary cycle of routing edges (automatic ones by default, those can loop without
+            an operator), each as a list of stationinroute pks starting at its lowest pk; only cycles
+            passing a stationinroute of route_id if given. Johnson's algorithm over strongly connected
+            components; stops after limit cycles, so a result of limit cycles may be incomplete
+        """
+        cycles = list()
+        for component in self.strongly_connected(self.nodes.keys(), auto_only):
+            if len(component) == 1:
+                pk = next(iter(component))
+                if pk not in self.neighbors(pk, auto_only):
+                    continue
+            #cycles of component whose lowest pk is start, then start is left out
+            for start in sorted(component):
+                remaining = set(pk for pk in component if pk >= start)
+                start_component = [nodes for nodes in self.strongly_connected(remaining, auto_only) if start in nodes][0]
+                self._find_circuits(start, start_component, auto_only, route_id, limit, cycles)
+                if len(cycles) >= limit:
+                    return cycles
+        return cycles
+
+    def _find_circuits(self, start, component, auto_only, route_id, limit, cycles):
+        #circuit search of Johnson's algorithm from start within component, iterative
+        blocked = set([start])
+        blocked_by = dict((pk, set()) for pk in component)
+        path = [start]
+        work = [(start, iter(sorted(pk for pk in self.neighbors(start, auto_only) if pk in component)))]
+        closed = [False]
+        while len(work) > 0:
+            node, neighbors = work[-1]
+            destination = next(neighbors, None)
+            if destination is not None:
+                if destination == start:
+                    closed[-1] = True
+                    if route_id is None or any(self.nodes[pk].route_id == route_id for pk in path):
+                        cycles.append(list(path))
+                        if len(cycles) >= limit:
+                            return
+                elif destination not in blocked:
+                    blocked.add(destination)
+                    path.append(destination)
+                    work.append((destination, iter(sorted(pk for pk in self.neighbors(destination, auto_only) if pk in component))))
+                    closed.append(False)
+                continue
+            work.pop()
+            path.pop()
+            found = closed.pop()
+            if found:
+                #unblock node and everything blocked because of it
+                unblock = [node]
+                while len(unblock) > 0:
+                    pk = unblock.pop()
+                    if pk in blocked:
+                        blocked.discard(pk)
+                        unblock += list(blocked_by[pk])
+                        blocked_by[pk].clear()
+                if len(closed) > 0:
+                    closed[-1] = True
+            else:
+                for pk in self.neighbors(node, auto_only):
+                    if pk in component:
+                        blocked_by[pk].add(node)
+
+
+def _get_route_graph_version():
+    try:
+        version = cache.get(ROUTE_GRAPH_VERSION_KEY)
+        if version is None:
+            cache.add(ROUTE_GRAPH_VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(ROUTE_GRAPH_VERSION_KEY)
+    except Exception as e:
+        print("route graph: cache is unavailable,", e)
+        version = None
+    return version
+
+
+def get_route_graph():
+    global _route_graph
+    version = _get_route_graph_version()
+    graph = _route_graph
+    if graph is None or graph.version != version or graph.is_expired():
+        with _route_graph_lock:
+            graph = _route_graph
+            if graph is None or graph.version != version or graph.is_expired():
+                graph = RouteGraph.load(version)
+                _route_graph = graph
+    return graph
+
+
+def invalidate_route_graph():
+    global _route_graph
+    _route_graph = None
+    try:
+        cache.set(ROUTE_GRAPH_VERSION_KEY, uuid.uuid4().hex, None)
+    except Exception as e:
+        print("route graph: cache is unavailable,", e)
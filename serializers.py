@@ -3,8 +3,9 @@ import json
 from django.db.models import Q
 from django.db.models.expressions import RawSQL
 from rest_framework import serializers, status
-from django.contrib.auth.models import User,Group
+from django.contrib.auth.models import User,Group,AnonymousUser
 from nexus.models import *
+from nexus.permissions import get_user_permission_context
 from hub_messages.models import Hub_message_template
 class AssetTypeFilterSerializer(serializers.HyperlinkedModelSerializer):
     descriptive_fieldset = serializers.SerializerMethodField()
@@ -181,7 +182,8 @@ class AssetSerializer(serializers.HyperlinkedModelSerializer):
                 except:
                     pass
         has_right = False
-        if (self.context['request'].user.pk == obj.meta.get('creator',0) and obj.stationinroute.station.properties.get('creator_operator',False)) or (self.context['request'].user == obj.operator) or (self.context['request'].user in obj.stationinroute.station.operators.all()) or (self.context['request'].user in obj.stationinroute.station.supervisors.all()):
+        user_context = get_user_permission_context(self.context['request'].user)
+        if (self.context['request'].user.pk == obj.meta.get('creator',0) and obj.stationinroute.station.properties.get('creator_operator',False)) or (self.context['request'].user == obj.operator) or user_context.operates_station(obj.stationinroute.station_id) or user_context.supervises_station(obj.stationinroute.station_id):
             has_right = True
 
         if self.context['request'].query_params.get('routing_info',False) and has_right:
@@ -204,8 +206,8 @@ class AssetSerializer(serializers.HyperlinkedModelSerializer):
                     destination_id = item['destination_id']
 
                 destination=StationInRoute.objects.get(pk=destination_id)
-                you_operate_it=self.context['request'].user in destination.station.operators.all()
-                you_supervise_it=self.context['request'].user in destination.station.supervisors.all()
+                you_operate_it=user_context.operates_station(destination.station_id)
+                you_supervise_it=user_context.supervises_station(destination.station_id)
                 dump = item.pop('destination_id',None)
                 if destination.route == obj.stationinroute.route:
                     destination_name = destination.station.station_name
@@ -223,10 +225,32 @@ class AssetSerializer(serializers.HyperlinkedModelSerializer):
         from nexus.views import publications_assettypes,REPOSITORY_ENTRANCE_STATION
         if obj.type.pk in publications_assettypes and RouteRecord.objects.filter(asset=obj).filter(stationinroute__station__id=REPOSITORY_ENTRANCE_STATION).count() > 0 and 'uuid' in obj.meta:
             representation['repository_link'] = '/repository/material/'+obj.meta['uuid']+'/'
-        
+
+        explain_action = self.context['request'].query_params.get('explain_permissions',None)
+        if explain_action and (user_context.supervises_station(obj.stationinroute.station_id) or user_context.supervises_route(obj.stationinroute.route_id)):
+            #supervisors can see how permission check is resolved, for themselves or for explain_user from explain_ip
+            from nexus.permissions import explain_check
+            explain_context = self.get_explain_context()
+            representation['permissions_explain'] = explain_check(user=explain_context.source, asset=obj, action=explain_action, context=explain_context)
 
         return representation
 
+    def get_explain_context(self):
+        #explained user and address are resolved once per request (context is shared by list items); request.user is left as is
+        if '_explain_context' not in self.context:
+            request = self.context['request']
+            if request.query_params.get('explain_user',None):
+                try:
+                    explain_user = User.objects.get(username=request.query_params['explain_user'])
+                except User.DoesNotExist:
+                    explain_user = AnonymousUser()
+                ip_address = request.query_params.get('explain_ip',None)
+            else:
+                explain_user = request.user
+                ip_address = request.query_params.get('explain_ip',get_client_ip(request))
+            self.context['_explain_context'] = get_user_permission_context(explain_user).with_ip_address(ip_address)
+        return self.context['_explain_context']
+
     title = serializers.SerializerMethodField()
     def get_title(self, obj):
         return obj.get_signature_string()
@@ -455,11 +479,12 @@ class AssetPublicationSerializer(serializers.HyperlinkedModelSerializer):
             return True
         if user == instance.operator:
             return True
-        if user in instance.stationinroute.station.operators.all():
+        user_context = get_user_permission_context(user)
+        if user_context.operates_station(instance.stationinroute.station_id):
             return True
-        if user in instance.stationinroute.station.supervisors.all():
+        if user_context.supervises_station(instance.stationinroute.station_id):
             return True
-        if user in instance.stationinroute.route.supervisors.all():
+        if user_context.supervises_route(instance.stationinroute.route_id):
             return True
 
         return False
@@ -791,7 +816,7 @@ class RouteSerializer(serializers.HyperlinkedModelSerializer):
 
     you_supervise_it = serializers.SerializerMethodField()
     def get_you_supervise_it(self,obj):
-        return self.context['request'].user in obj.supervisors.all()
+        return get_user_permission_context(self.context['request'].user).supervises_route(obj.pk)
 
     ui = serializers.SerializerMethodField()
     def get_ui(self,obj):
@@ -851,7 +876,7 @@ class RouteStationInRouteStationSerializer(serializers.HyperlinkedModelSerialize
 
     you_supervise_it = serializers.SerializerMethodField()
     def get_you_supervise_it(self,obj):
-        return self.context['request'].user in obj.supervisors.all()
+        return get_user_permission_context(self.context['request'].user).supervises_route(obj.pk)
 
     assets_quantity = serializers.SerializerMethodField()
     def get_assets_quantity(self,obj):
@@ -897,11 +922,11 @@ class StationSerializer(serializers.HyperlinkedModelSerializer):
 
     you_operate_it = serializers.SerializerMethodField()
     def get_you_operate_it(self,obj):
-        return self.context['request'].user in obj.operators.all()
+        return get_user_permission_context(self.context['request'].user).operates_station(obj.pk)
 
     you_supervise_it = serializers.SerializerMethodField()
     def get_you_supervise_it(self,obj):
-        return self.context['request'].user in obj.supervisors.all()
+        return get_user_permission_context(self.context['request'].user).supervises_station(obj.pk)
 
     auto_assign_mode_on = serializers.SerializerMethodField()
     def get_auto_assign_mode_on(self,obj):
@@ -1261,17 +1286,18 @@ class AssetHistoryRouteRecordSerializer(serializers.HyperlinkedModelSerializer):
         result = list()
         for item in obj.properties.get('notifications',list()):
             user = self.context['request'].user
+            user_context = get_user_permission_context(user)
             #result.append({'type':item.get('type',''),'status':item.get('status',''),"address":item.get("address","")})
             
-            if user in obj.stationinroute.station.supervisors.all():
+            if user_context.supervises_station(obj.stationinroute.station_id):
                 result.append({'type':item.get('type',''),'status':item.get('status',''),"address":item.get("address","")})
-            elif user in obj.stationinroute.station.operators.all() and item.get('recipient','creator') in ['creator','operator']:
+            elif user_context.operates_station(obj.stationinroute.station_id) and item.get('recipient','creator') in ['creator','operator']:
                 result.append({'type':item.get('type',''),'status':item.get('status',''),"address":item.get("address","")})
-            elif user in obj.stationinroute.station.operators.all() and item.get('recipient','creator') == 'creator':
+            elif user_context.operates_station(obj.stationinroute.station_id) and item.get('recipient','creator') == 'creator':
                 result.append({'type':item.get('type',''),'status':item.get('status',''),"address":item.get("address","")})
             elif user.pk == obj.asset.meta.get('creator',0) and item.get('recipient','creator') == 'creator':
                 result.append({'type':item.get('type',''),'status':item.get('status',''),"address":item.get("address","")})
-            elif user in obj.stationinroute.route.supervisors.all():
+            elif user_context.supervises_route(obj.stationinroute.route_id):
                 result.append({'type':item.get('type',''),'status':item.get('status',''),"address":item.get("address","")})
             
             
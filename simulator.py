@@ -0,0 +1,239 @@
+#=====================================================================
+# routing dry-run simulator
+#
+# follows automatic routing of asset snapshots (real assets or synthetic payloads)
+# through compiled routing of stationinroutes, optionally with proposed properties
+# instead of the saved ones, applying payload and asset type modifications in memory.
+# Nothing is saved: no route records, assignments, notifications or station.perform,
+# so what custom stations would do on arrival is not part of the result.
+# Chunks of assets may run in a process pool, see parallel.py.
+#=====================================================================
+
+import time
+import copy
+from collections import Counter
+from nexus.parallel import run_chunks, iterate_chunks
+from nexus import routing
+
+SIMULATION_CHUNK_SIZE = 500
+SIMULATION_MAX_HOPS = 50
+SIMULATION_MAX_LISTED_LOOPS = 20 #loop examples kept, the rest is only counted
+
+
+class RoutingSimulator:
+    """
+        properties maps stationinroute pk to proposed StationInRoute.properties;
+        stationinroutes and asset types are loaded once and operators once per chunk, so simulated hops
+        don't query the database except for #RETURN# destinations
+    """
+    def __init__(self, properties=None, max_hops=SIMULATION_MAX_HOPS):
+        from nexus.models import StationInRoute, AssetType
+        self.properties = dict((int(pk), value) for pk, value in (properties or dict()).items())
+        self.max_hops = max_hops
+        self.stationinroutes = dict((sr.pk, sr) for sr in StationInRoute.objects.all().select_related('station','route'))
+        self.asset_types = dict((asset_type.pk, asset_type) for asset_type in AssetType.objects.all())
+        self.operators = dict()
+        self.compiled = dict()
+        self.graph = routing.get_route_graph()
+        self.needs_operators = self.uses_operator_names()
+
+    def uses_operator_names(self):
+        #'~>' with %U appends the operator's username, operators are prefetched only then
+        from nexus.modifications import AppendTextOperation
+        for sr in self.stationinroutes.values():
+            for compiled_route in self.get_compiled_routing(sr):
+                if compiled_route.payload_modifications is None:
+                    continue
+                for operation in compiled_route.payload_modifications.operations:
+                    if isinstance(operation, AppendTextOperation) and '%U' in operation.str_format:
+                        return True
+        return False
+
+    def load_operators(self, operator_ids):
+        from django.contrib.auth.models import User
+        operator_ids = set(pk for pk in operator_ids if pk is not None and pk not in self.operators)
+        if len(operator_ids) > 0:
+            self.operators.update((user.pk, user) for user in User.objects.filter(pk__in=operator_ids).only('pk','username'))
+
+    def get_compiled_routing(self, sr):
+        if sr.pk not in self.compiled:
+            if sr.pk in self.properties:
+                self.compiled[sr.pk] = routing.compile_routing(self.properties[sr.pk])
+            else:
+                self.compiled[sr.pk] = routing.compile_routing(sr.properties)
+        return self.compiled[sr.pk]
+
+    def make_asset(self, pk, type_id, stationinroute_id, payload, meta, operator_id=None):
+        #unsaved copy of the asset, modifications never reach the database
+        from nexus.models import Asset
+        sr = self.stationinroutes[stationinroute_id]
+        asset = Asset(pk=pk, type=self.asset_types[type_id], route_id=sr.route_id, stationinroute=sr, operator_id=operator_id)
+        if operator_id in self.operators:
+            asset.operator = self.operators[operator_id]
+        asset.payload = copy.deepcopy(payload) if payload is not None else dict()
+        asset.meta = copy.deepcopy(meta) if meta is not None else dict()
+        #simulated asset is never debugged, debug output would flood the report
+        asset.meta.pop('debug', None)
+        return asset
+
+    def apply_asset_type_modifications(self, route_variant, asset):
+        #Route.process_asset_type_modifications with the types loaded in __init__, without prints and save
+        for modification in route_variant.get('asset_type_modifications', list()):
+            if '->' not in modification:
+                continue
+            type_names = modification.split('->')
+            try:
+                if type_names[0] != '*' and int(type_names[0]) != asset.type.pk:
+                    continue
+                asset.type = self.asset_types[int(type_names[1])]
+            except:
+                pass
+
+    def get_return_destination(self, asset, path):
+        #first route record of the asset like Route.route_asset does, simulated ones count too
+        from nexus.models import RouteRecord
+        if asset.pk is not None:
+            record = RouteRecord.objects.filter(asset_id=asset.pk).values_list('stationinroute_id',flat=True)[:1]
+            if len(record) > 0:
+                return record[0]
+        if len(path) > 1:
+            return path[0]
+        return None
+
+    def simulate(self, asset):
+        """
+            follows routing of a single asset; returns
+            {'path','destination','hops','stop','check_seconds','modification_seconds','evaluations'}
+        """
+        path = [asset.stationinroute_id]
+        states = set([routing.get_routing_state(asset)])
+        result = {'hops':0,'stop':'no_route','check_seconds':0.0,'modification_seconds':0.0,'evaluations':0}
+        while True:
+            sr = asset.stationinroute
+            start = time.time()
+            chosen = None
+            if not self.graph.is_force_return(sr.pk):
+                #force_return invalidates every variant, see Route.check_routing_requirements
+                for compiled_route in self.get_compiled_routing(sr):
+                    result['evaluations'] += 1
+                    if compiled_route.config.get('auto_route',False) and compiled_route.check(asset)['is_validated']:
+                        chosen = compiled_route
+                        break
+            result['check_seconds'] += time.time()-start
+            if chosen is None:
+                break
+
+            destination_id = chosen.config['destination_id']
+            if destination_id == '#RETURN#':
+                destination_id = self.get_return_destination(asset, path)
+            node = self.graph.get_node(destination_id)
+            if node is None or node.pk not in self.stationinroutes:
+                result['stop'] = 'bad_destination'
+                break
+            next_sr = self.stationinroutes[node.pk]
+
+            start = time.time()
+            asset.stationinroute = next_sr
+            sr.route.process_payload_modifications(chosen.config, asset, dry_run=True)
+            self.apply_asset_type_modifications(chosen.config, asset)
+            result['modification_seconds'] += time.time()-start
+
+            if next_sr.pk == sr.pk:
+                #same-station routing doesn't assign the asset, routing ends here
+                result['stop'] = 'same_station'
+                break
+            result['hops'] += 1
+            path.append(next_sr.pk)
+            if chosen.config.get('suspend_further_routing',False):
+                result['stop'] = 'suspended'
+                break
+            if result['hops'] >= self.max_hops:
+                result['stop'] = 'hop_limit'
+                break
+            state = routing.get_routing_state(asset)
+            if state in states:
+                result['stop'] = 'loop'
+                break
+            states.add(state)
+        result['path'] = path
+        result['destination'] = path[-1]
+        return result
+
+
+class SimulationReport:
+    def __init__(self):
+        self.assets = 0
+        self.destinations = Counter()
+        self.hops = Counter()
+        self.stops = Counter()
+        self.loops = list()
+        self.check_seconds = 0.0
+        self.modification_seconds = 0.0
+        self.evaluations = 0
+        self.failed = list()
+
+    def add(self, asset_pk, result):
+        self.assets += 1
+        self.destinations[result['destination']] += 1
+        self.hops[result['hops']] += 1
+        self.stops[result['stop']] += 1
+        self.check_seconds += result['check_seconds']
+        self.modification_seconds += result['modification_seconds']
+        self.evaluations += result['evaluations']
+        if result['stop'] == 'loop' and len(self.loops) < SIMULATION_MAX_LISTED_LOOPS:
+            self.loops.append((asset_pk, result['path']))
+
+    def merge(self, other):
+        self.assets += other.assets
+        self.destinations.update(other.destinations)
+        self.hops.update(other.hops)
+        self.stops.update(other.stops)
+        self.loops += other.loops[:max(SIMULATION_MAX_LISTED_LOOPS-len(self.loops), 0)]
+        self.check_seconds += other.check_seconds
+        self.modification_seconds += other.modification_seconds
+        self.evaluations += other.evaluations
+        self.failed += other.failed
+
+    def total_hops(self):
+        return sum(hops*count for hops, count in self.hops.items())
+
+
+# set in the parent before the pool is forked, read by simulate_chunk in workers
+_simulator = None
+
+
+def simulate_chunk(chunk):
+    #chunk is a list of (pk, type_id, stationinroute_id, payload, meta, operator_id)
+    report = SimulationReport()
+    if _simulator.needs_operators:
+        _simulator.load_operators(row[5] for row in chunk)
+    for row in chunk:
+        try:
+            asset = _simulator.make_asset(*row)
+            report.add(row[0], _simulator.simulate(asset))
+        except Exception as e:
+            report.failed.append((row[0], str(e)))
+    return report
+
+
+def simulate_rows(simulator, rows, processes=1, chunk_size=SIMULATION_CHUNK_SIZE, progress=None):
+    """
+        rows are (pk, type_id, stationinroute_id, payload, meta, operator_id) tuples, pk may be None
+        for synthetic assets; returns SimulationReport of all of them
+    """
+    global _simulator
+    _simulator = simulator
+    report = SimulationReport()
+    for chunk, result, seconds in run_chunks(simulate_chunk, iterate_chunks(rows, chunk_size), processes=processes):
+        if isinstance(result, Exception):
+            report.failed += [(row[0], str(result)) for row in chunk]
+        else:
+            report.merge(result)
+        if progress:
+            progress(report, seconds)
+    return report
+
+
+def get_asset_rows(queryset, chunk_size=SIMULATION_CHUNK_SIZE):
+    #snapshot rows of real assets, streamed
+    return queryset.order_by('pk').values_list('pk','type_id','stationinroute_id','payload','meta','operator_id').iterator(chunk_size=chunk_size)